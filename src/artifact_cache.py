@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+
+# Content-hash cache of stage outputs.
+# A manifest records the command of a stage (its parameters), the content
+# hashes of its input files, of its code (the script and the local modules it
+# imports) and of the outputs it wrote. A stage is reused when a new manifest
+# matches the stored one and its outputs are still as written; since the
+# inputs of a stage are the outputs of the stages before it, recomputing a
+# stage invalidates exactly the stages downstream of it.
+
+# (path, size, mtime) -> sha256, so files shared by many stages are read once
+_hash_memo = {}
+
+
+def file_hash(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_memo:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _hash_memo[key] = digest.hexdigest()
+    return _hash_memo[key]
+
+
+def path_hashes(paths):
+    """Hashes of the given files and of every file under the given directories, None for missing paths."""
+    hashes = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    hashes[file_path] = file_hash(file_path)
+        elif os.path.exists(path):
+            hashes[path] = file_hash(path)
+        else:
+            hashes[path] = None
+    return hashes
+
+
+def code_files(scripts):
+    """The given scripts and the modules of their directory they import, directly or not."""
+    files = []
+    pending = list(scripts)
+    while pending:
+        script = pending.pop()
+        if script in files:
+            continue
+        files.append(script)
+        script_dir = os.path.dirname(script)
+        with open(script) as f:
+            for module in re.findall(r"^\s*(?:from|import)\s+(\w+)", f.read(), re.MULTILINE):
+                module_path = os.path.join(script_dir, module + ".py")
+                if os.path.exists(module_path):
+                    pending.append(module_path)
+    return sorted(files)
+
+
+def build_manifest(command, inputs, code):
+    return {
+        "command": command,
+        "inputs": path_hashes(inputs),
+        "code": path_hashes(code_files(code)),
+    }
+
+
+def is_cached(manifest_path, manifest):
+    """Whether the stored manifest matches and all outputs it lists are unchanged."""
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        stored = json.load(f)
+    for key in ["command", "inputs", "code"]:
+        if stored.get(key) != manifest[key]:
+            return False
+    outputs = stored["outputs"]
+    return None not in outputs.values() and path_hashes(outputs.keys()) == outputs
+
+
+def write_manifest(manifest_path, manifest, outputs):
+    manifest = dict(manifest, outputs=path_hashes(outputs))
+    Path(manifest_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
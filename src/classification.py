@@ -4,175 +4,277 @@
 
 # imports
 import argparse
-import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-import csv, os, warnings, sys
+import math, os, shutil, warnings
+from threadpoolctl import threadpool_limits
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import LeaveOneOut, cross_val_predict, cross_validate, ParameterGrid
-from sklearn.metrics import classification_report, roc_auc_score, average_precision_score
-import shutil
-import json
+from sklearn.model_selection import LeaveOneOut, RepeatedStratifiedKFold, cross_validate, ParameterGrid
 from pathlib import Path
+from evaluation import (EVALUATIONS, KFOLD_MAX_SAMPLES, KFOLD_REPEATS, KFOLD_SPLITS, LOO_MAX_SAMPLES,
+                        evaluation_folds, evaluation_mode, evaluation_record, fold_backend, fold_jobs,
+                        held_out_proba, screen_matrix, write_outputs)
+from feature_store import copy_matrix, read_features
+from learner_names import LEARNERS, performance_prefix
+from learners import learner_classifier
+from logging_utils import get_logger, log_to
+from metabolome_store import read_registry
+from profiling import phase
+from screening import final_estimator, selected_columns, univariate_model
 
 # turn off spammy warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-def random_forest_classifier(in_path, case, control, out_dir, log_path):
+# Param grid to search for each food
+# Note: keep this lightweight to avoid very long runtimes.
+PARAM_GRID = {
+    "n_estimators": [200],
+    "oob_score": [True],
+    "random_state": [1],
+    "max_features": ["sqrt"],
+    "min_samples_leaf": [1, 3],
+}
+
+# Successive-halving search (search='halving') over a wider grid: every
+# candidate starts as a forest of HALVING_MIN_TREES trees fitted on all the
+# samples; each round keeps the best 1/HALVING_FACTOR of them by OOB score and
+# grows their forests HALVING_FACTOR times larger (warm_start), up to the trees
+# of PARAM_GRID, until HALVING_FINALISTS are left for the full evaluation.
+# The finalists were chosen by their OOB score, so their out-of-bag
+# predictions would flatter them: they are evaluated by k-fold instead.
+SEARCHES = ['grid', 'halving']
+HALVING_GRID = {
+    "max_features": ["sqrt", "log2", 0.3],
+    "max_depth": [None, 4, 8],
+    "min_samples_leaf": [1, 3, 5],
+    "class_weight": [None, "balanced"],
+}
+HALVING_MIN_TREES = 25
+HALVING_FACTOR = 3
+HALVING_FINALISTS = 2
+
+# joblib backends the LOO folds can be spread over (n_jobs > 1)
+CV_BACKENDS = ['loky', 'multiprocessing', 'threading']
+
+
+logger = get_logger('classification')
+
+def halving_schedule(n_candidates):
+    """(candidates, trees per forest) of every round of the successive-halving search."""
+    rounds = []
+    trees = HALVING_MIN_TREES
+    while n_candidates > HALVING_FINALISTS:
+        rounds.append((n_candidates, min(trees, PARAM_GRID['n_estimators'][0])))
+        n_candidates = max(HALVING_FINALISTS, math.ceil(n_candidates / HALVING_FACTOR))
+        trees *= HALVING_FACTOR
+    return rounds
+
+def halving_trees():
+    """Trees grown by the successive-halving search, and the most held at once."""
+    rounds = halving_schedule(len(ParameterGrid(HALVING_GRID)))
+    grown = previous_trees = 0
+    for n_candidates, trees in rounds:
+        grown += n_candidates * (trees - previous_trees)
+        previous_trees = trees
+    return grown, max(n_candidates * trees for n_candidates, trees in rounds)
+
+def forest_fits(n_samples, evaluation='auto', search='grid'):
+    """
+    Forests fitted to classify n_samples: every fold of the searched parameters,
+    whose predictions are reused, and the search rounds counted in full forests.
+    """
+    folds = evaluation_folds(n_samples, evaluation, search)
+    if search == 'grid':
+        return len(ParameterGrid(PARAM_GRID)) * folds
+    return HALVING_FINALISTS * folds + halving_fits()
+
+def forests_held(n_samples, evaluation='auto', search='grid'):
+    """
+    Full forests held at once to classify n_samples: the fold forests of a
+    parameter set and the best one, or the search round holding the most trees.
+    """
+    held = evaluation_folds(n_samples, evaluation, search) + 1
+    if search == 'halving':
+        held = max(held, math.ceil(halving_trees()[1] / PARAM_GRID['n_estimators'][0]))
+    return held
+
+def halving_fits():
+    """Trees grown by the successive-halving search, counted in full forests."""
+    return math.ceil(halving_trees()[0] / PARAM_GRID['n_estimators'][0])
+
+def classification_cost(n_rows, n_cols, evaluation='auto', search='grid'):
+    """
+    Relative cost of classifying an (n_rows x n_cols) matrix: its forest fits,
+    whose splits sort n_rows samples over sqrt(n_cols) candidate features.
+    """
+    return forest_fits(n_rows, evaluation, search) * n_rows * math.sqrt(max(n_cols, 1))
+
+def evaluate_forest(rfc, X, y_true, mode, cv_jobs):
+    """
+    Fits the forest rfc, alone or behind its univariate filter, as the
+    evaluation mode requires, returning the fitted models and the held-out
+    class probabilities of every sample.
+    """
+    if mode == 'oob':
+        rfc.fit(X, y_true)
+        return [rfc], final_estimator(rfc).oob_decision_function_
+    if mode == 'loo':
+        cv = LeaveOneOut()
+    else:
+        cv = RepeatedStratifiedKFold(n_splits=KFOLD_SPLITS, n_repeats=KFOLD_REPEATS, random_state=1)
+    cv_result = cross_validate(
+        rfc,
+        X,
+        y_true,
+        scoring=None,
+        cv=cv,
+        n_jobs=cv_jobs,
+        return_estimator=True,
+        return_indices=True,
+    )
+    return cv_result["estimator"], held_out_proba(cv_result, X)
+
+def halving_search(X, y_true, n_jobs):
+    """
+    Successive-halving search over HALVING_GRID, returning the parameters of
+    the HALVING_FINALISTS candidates left, best first. Ties keep the grid order.
+    """
+    base = {key: values[0] for key, values in PARAM_GRID.items() if key not in HALVING_GRID}
+    candidates = [dict(base, **params) for params in ParameterGrid(HALVING_GRID)]
+    forests = [RandomForestClassifier(**params, warm_start=True, n_jobs=n_jobs) for params in candidates]
+    for n_candidates, trees in halving_schedule(len(candidates)):
+        # warm_start only fits the trees added since the previous round
+        for forest in forests:
+            forest.set_params(n_estimators=trees).fit(X, y_true)
+        order = sorted(range(n_candidates), key=lambda i: -forests[i].oob_score_)
+        logger.info('Halving round: %d candidates with %d trees, best OOB score %.3f (%s)',
+                    n_candidates, trees, forests[order[0]].oob_score_,
+                    {key: candidates[order[0]][key] for key in HALVING_GRID})
+        keep = order[:max(HALVING_FINALISTS, math.ceil(n_candidates / HALVING_FACTOR))]
+        candidates = [candidates[i] for i in keep]
+        forests = [forests[i] for i in keep]
+    return candidates
+
+def tune_random_forest(X, registry, case, control, out_dir, n_jobs=1, backend='loky',
+                       evaluation='auto', search='grid', plots=True, screen=False, univariate_k=None):
+    """Tunes and evaluates a random forest on the feature matrix X (indexed by registry sample).
+
+    The parameters are searched over PARAM_GRID, every point fully evaluated,
+    or by successive halving over HALVING_GRID (search). The performance is
+    estimated by LOO, repeated stratified k-fold or the out-of-bag predictions
+    (evaluation, 'auto' by the number of samples). The folds are fitted on
+    n_jobs cores through the joblib backend; the forests are seeded, so the
+    results do not depend on n_jobs. With screen, the non-finite, constant
+    and duplicate columns are dropped first; univariate_k keeps the k columns
+    with the best ANOVA F score, selected in every fold. Every output is
+    written to the existing out_dir, under the current log; the figures only
+    with plots, report.py draws them later from the numeric outputs
+    otherwise. Returns the performance metrics.
+    """
     classes = {case: 1, control: 0}
-    df = pd.read_csv(in_path, sep='\t')
-        
-    df['class'] = df['sample_group'].apply(lambda x: 1 if x == case else 0)
     
-    y_true = np.array(df['class'].values)
-    X = df.set_index('sample_id').drop(columns=['class', 'sample_group'])
-    print(X.shape, y_true.shape)
+    sample_group = registry['sample_group'].loc[X.index]
+    y_true = (sample_group == case).to_numpy().astype(int)
     
-    old_cwd = os.getcwd()
-    try:
-        if os.path.exists(out_dir):
-            shutil.rmtree(out_dir)
-        os.makedirs(out_dir)
-        os.chdir(out_dir)
-
-        # Param grid to search for each food
-        # Note: keep this lightweight to avoid very long runtimes and
-        # avoid joblib multiprocessing issues in some environments.
-        param_grid = {
-            "n_estimators": [200],
-            "oob_score": [True],
-            "n_jobs": [1],
-            "random_state": [1],
-            "max_features": ["sqrt"],
-            "min_samples_leaf": [1, 3],
-        }
-
-        # Ensure the log directory exists before opening the file
-        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
-        log_file = open(log_path, 'w')
-
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        try:
-            sys.stdout = log_file
-            sys.stderr = log_file
-
-            # Grid search
-            best_rf = None
-            best_params = None
-            for params in ParameterGrid(param_grid):
-                rfc = RandomForestClassifier()
-                rfc.set_params(**params)
-
-                # Perform LOO evaluation for this parameter set
-                cv_result = cross_validate(
-                    rfc,
-                    X.values,
-                    y_true,
-                    scoring=None,
-                    cv=LeaveOneOut(),
-                    n_jobs=1,
-                    return_estimator=True,
-                )
-
-                # Update the best parameters
-                estimators = cv_result["estimator"]
-                for estimator in estimators:
-                    if best_rf is None or estimator.oob_score_ > best_rf.oob_score_:
-                        best_rf = estimator
-                        best_params = params
-
-            print(case, 'vs', control, "-> Best parameters from grid search:", best_params)
-
-            # Cross-val predict probabilities using leave one out and our new best parameters
+    # every output file is named <out_dir>/<case>.<control>.*
+    prefix = os.path.join(out_dir, performance_prefix(case, control))
+    logger.info('%s vs %s: %d samples, %d features', case, control, X.shape[0], X.shape[1])
+    X, screening = screen_matrix(X, screen, univariate_k, out_dir)
+
+    mode = evaluation_mode(len(X), evaluation, search)
+    if mode != evaluation_mode(len(X), evaluation):
+        logger.warning('The halving finalists are ranked by OOB score; their performance is estimated by '
+                       + 'k-fold instead of out-of-bag')
+    logger.info('Performance estimated by %s', mode)
+    if univariate_k and mode == 'oob':
+        logger.warning('The univariate filter is fitted on every sample with out-of-bag evaluation')
+    if search == 'grid':
+        candidates = list(ParameterGrid(PARAM_GRID))
+    else:
+        with phase('halving search', out_dir=out_dir, shape=list(X.shape), fits=halving_fits()), \
+                threadpool_limits(limits=1):
+            candidates = halving_search(X.values, y_true, n_jobs)
+    # the grid point is chosen by OOB score, so with several of them its
+    # out-of-bag metrics are those of the selection
+    post_selection = mode == 'oob' and len(candidates) > 1
+    if post_selection:
+        logger.warning('The grid point is chosen by OOB score; its out-of-bag performance is optimistic '
+                       + '(use --evaluation kfold for held-out folds)')
+    cv_jobs, forest_jobs = fold_jobs(n_jobs, evaluation_folds(len(X), mode))
+    # the cores are shared out between folds and trees, one BLAS/OpenMP thread each
+    with phase('forest fitting', out_dir=out_dir, shape=list(X.shape), evaluation=mode,
+               fits=len(candidates) * evaluation_folds(len(X), mode), n_jobs=n_jobs), \
+            fold_backend(backend, cv_jobs), threadpool_limits(limits=1):
+        # Full evaluation of the candidate parameters
+        best_rf = None
+        best_params = None
+        y_proba = None
+        for params in candidates:
             rfc = RandomForestClassifier()
-            rfc.set_params(**best_params)
-            y_proba = cross_val_predict(
-                rfc,
-                X.values,
-                y_true,
-                cv=LeaveOneOut(),
-                n_jobs=1,
-                method="predict_proba",
-            )
-
-            np.savetxt(fname=case + '.' + control + '.classifier_prediction.tsv', header=case + '\t' + control, X=y_proba, delimiter='\t')
-            
-            y_pred = [score.argmax() for score in y_proba]
-            
-            metric = classification_report(y_true, y_pred, target_names=[control, case], output_dict=True)
-            metric['auroc'] = round(roc_auc_score(y_true, y_proba[:, 1]), 2)
-            metric['auprc'] = round(average_precision_score(y_true, y_proba[:, 1]), 2)
-            
-            metric_file = open(case + '.' + control + '.classifier_performance.json', 'w')
-            # Write metrics and force flush/close immediately to avoid data loss
-            json.dump(metric, metric_file)
-            metric_file.flush()
-            os.fsync(metric_file.fileno())
-            metric_file.close()
-            
-            print('Accuracy', metric['accuracy'])
-            print('AUROC', metric['auroc'])
-            print('AUPRC', metric['auprc'])
-
-            # Plot feature importance graph
-            feature_idxs = np.argsort(best_rf.feature_importances_)[::-1]
-            plt.figure(figsize=(5, 5))
-            plt.title(case + 'Feature Importances')
-            plt.xlabel("Feature #")
-            plt.ylabel("Feature Importance")
-            plt.plot(sorted(best_rf.feature_importances_, reverse=True))
-            plt.savefig(case + '.' + control + '.feature-importance.png')
-            plt.close()
-            best_features = X.columns[feature_idxs[:10]]
-            print('Top-10 features for', case, ':', best_features)
-
-            # feature means per group write-out
-            classes = {0: control, 1: case}
-            X_gb = X.copy().iloc[:, feature_idxs]
-            X_gb["group"] = list(map(lambda i: classes[i], y_true))
-            print("group", X_gb["group"])
-            X_gb.groupby("group").mean().to_csv(case + '.' + control + '.feature-mean.csv')
-            X_gb.groupby("group").std().to_csv(case + '.' + control + '.feature-std.csv')
-
-            # Feautre importances write out + figure generation
-            best_features_list = list(
-                zip(
-                    [X.columns[idx] for idx in feature_idxs],
-                    [best_rf.feature_importances_[idx] for idx in feature_idxs],
-                )
-            )
-            #best_features_per_food[food] = best_features_list
-            with open(case + '.' + control + '.feature-importance.csv', "w") as f:
-                w = csv.writer(f)
-                w.writerow(["Feature", "Importance"])
-                for idx in feature_idxs:
-                    w.writerow([X.columns[idx], best_rf.feature_importances_[idx]])
-
-            # plot features
-            for feature in best_features:
-                fig, ax = plt.subplots(figsize=(5, 5))
-                sns.boxplot(
-                    data=X_gb, x="group", y=feature, linewidth=2.5, width=0.4, ax=ax
-                )
-                ax.set_xlabel("Treatment group")
-                ax.set_ylabel("Relative concentration")
-                fig.suptitle(feature, size=22)
-                fig.savefig(case + '.' + control + '.' + feature + '.boxplot.png', bbox_inches="tight")
-                plt.close(fig)
-        finally:
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
-            log_file.flush()
-            log_file.close()
-    finally:
-        os.chdir(old_cwd)
-    
+            rfc.set_params(**params, n_jobs=forest_jobs)
+            model = univariate_model(rfc, univariate_k, X.shape[1])
+
+            # Evaluate this parameter set
+            estimators, params_proba = evaluate_forest(model, X.values, y_true, mode, cv_jobs)
+
+            # Update the best parameters
+            for estimator in estimators:
+                oob_score = final_estimator(estimator).oob_score_
+                if best_rf is None or oob_score > final_estimator(best_rf).oob_score_:
+                    best_rf = estimator
+                    best_params = params
+
+            # Keep the held-out probabilities of the best parameters so far; refitting
+            # them would train the same (seeded) forests on the same folds again
+            if best_params is params:
+                y_proba = params_proba
+
+        logger.info('%s vs %s -> Best parameters from grid search: %s', case, control, best_params)
+
+    # the columns left out by the univariate filter have no importance
+    importances = np.zeros(X.shape[1])
+    importances[selected_columns(best_rf, X.shape[1])] = final_estimator(best_rf).feature_importances_
+    records = {'learner': 'forest', 'evaluation': evaluation_record(mode, post_selection),
+               'search': {'method': search, 'best_params': best_params}, 'screening': screening}
+    return write_outputs(prefix, X, y_true, y_proba, importances, case, control, records, plots)
+
+def random_forest_classifier(X, registry, case, control, out_dir, log_path, n_jobs=1, backend='loky',
+                             evaluation='auto', search='grid', plots=True, screen=False, univariate_k=None):
+    """tune_random_forest into out_dir, which is recreated, logging to log_path."""
+    return classify(X, registry, case, control, out_dir, log_path, learners=['forest'], n_jobs=n_jobs,
+                    backend=backend, evaluation=evaluation, search=search, plots=plots, screen=screen,
+                    univariate_k=univariate_k)['forest']
+
+def classify(X, registry, case, control, out_dir, log_path, learners=('forest',), n_jobs=1, backend='loky',
+             evaluation='auto', search='grid', plots=True, screen=False, univariate_k=None):
+    """
+    Classifies the feature matrix X with every learner of learners (the
+    forest or those of learners.py) into out_dir, which is recreated,
+    logging to log_path; returns the performance metrics by learner.
+    """
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    performance = {}
+    # the log is opened after the cleanup, as it may be inside out_dir
+    with log_to(log_path):
+        for learner in learners:
+            if learner == 'forest':
+                performance[learner] = tune_random_forest(
+                    X, registry, case, control, out_dir, n_jobs=n_jobs, backend=backend, evaluation=evaluation,
+                    search=search, plots=plots, screen=screen, univariate_k=univariate_k)
+            else:
+                performance[learner] = learner_classifier(
+                    X, registry, case, control, out_dir, learner, n_jobs=n_jobs, backend=backend,
+                    evaluation=evaluation, plots=plots, screen=screen, univariate_k=univariate_k)
+    return performance
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--in_path", type=str,
-                        help="path to input features in .tsv format",
+                        help="path to input features: a .tsv, a memory-mapped .npy matrix or a combination (.json)",
+                        required=True, default=None)
+    parser.add_argument("--met_store_path", type=str,
+                        help="path to the columnar store holding the sample registry",
                         required=True, default=None)
     parser.add_argument("--case", type=str,
                         help="name of the case group",
@@ -186,17 +288,47 @@ def parse_args():
     parser.add_argument("--log_path", type=str,
                         help="path to log file",
                         required=True, default=None)
+    parser.add_argument("--n_jobs", type=int,
+                        help="number of cores the LOO folds are fitted on (default: 1)",
+                        required=False, default=1)
+    parser.add_argument("--backend", type=str, choices=CV_BACKENDS,
+                        help="joblib backend of the LOO folds with --n_jobs > 1 (default: loky)",
+                        required=False, default='loky')
+    parser.add_argument("--evaluation", type=str, choices=EVALUATIONS,
+                        help="estimator of the performance: LeaveOneOut, repeated stratified k-fold or out-of-bag "
+                        + f"(default: auto, LOO up to {LOO_MAX_SAMPLES} samples, k-fold up to {KFOLD_MAX_SAMPLES})",
+                        required=False, default='auto')
+    parser.add_argument("--search", type=str, choices=SEARCHES,
+                        help="parameter search: every point of the small grid fully evaluated, or successive halving "
+                        + "over a wider grid by OOB score, only the finalists fully evaluated (default: grid)",
+                        required=False, default='grid')
+    parser.add_argument("--screen", action="store_true",
+                        help="drop the non-finite, constant and perfectly correlated (duplicate) columns "
+                        + "before fitting; the number removed by each step is recorded in the performance json")
+    parser.add_argument("--univariate_k", type=int,
+                        help="keep the k columns with the best ANOVA F score, selected inside every "
+                        + "evaluation fold (default: every column)",
+                        required=False, default=None)
+    parser.add_argument("--no_plots", action="store_true",
+                        help="only write the numeric outputs; report.py draws the figures from them later")
+    parser.add_argument("--learners", type=str, nargs='+', choices=LEARNERS,
+                        help="learners the features are classified with; every learner but the forest writes "
+                        + "its outputs as <case>.<control>.<learner>.* (default: forest)",
+                        required=False, default=['forest'])
     args = parser.parse_args()
     return args
 
 def main(args):
     Path(args.out_dir).mkdir(parents=True, exist_ok=True)
     # Run classifier first (may recreate the out_dir). Then copy the input for provenance.
-    random_forest_classifier(args.in_path, args.case, args.control, args.out_dir, args.log_path)
+    registry = read_registry(args.met_store_path)
+    classify(read_features(args.in_path), registry, args.case, args.control, args.out_dir, args.log_path,
+             learners=args.learners, n_jobs=args.n_jobs, backend=args.backend, evaluation=args.evaluation,
+             search=args.search, plots=not args.no_plots, screen=args.screen, univariate_k=args.univariate_k)
     try:
-        shutil.copy(args.in_path, args.out_dir)
+        copy_matrix(args.in_path, args.out_dir)
     except Exception as e:
-        print(f"Warning: failed to copy input to output dir: {e}")
+        logger.warning('Failed to copy input to output dir: %s', e)
     
 if __name__ == "__main__":
     main(parse_args())
@@ -1,18 +1,29 @@
 import argparse
-import pandas as pd
 from pathlib import Path
-import sys
-import re
+from feature_store import MATRIX_SUFFIX, append_matrix, baseline_path, write_combination, write_matrix
+from features import change_features, reported_reactions
+from logging_utils import get_logger, log_to
+from metabolome_store import append_tsv, pending_samples, read_change_tensor, read_metadata
+from profiling import phase
+from reaction_sets import hash_path, input_hashes, read_changed_reactions, read_met_to_id, read_reaction_set, reusable_columns, write_input_hashes
+
+logger = get_logger('compute-change-feature')
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--react_set_path", type=str,
                         help="path to a reaction set in .tsv format",
                         required=True, default=None)
-    parser.add_argument("--met_change_path", type=str,
-                        help="path to metabolite concentration change in .tsv format", required=True, default=None)
+    parser.add_argument("--met_store_path", type=str,
+                        help="path to the columnar store of preprocessed metabolome", required=True, default=None)
     parser.add_argument("--valid_met_path", type=str,
                         help="path to list of human-gem overlapped metabolites in .tsv format", required=True, default=None)
+    parser.add_argument("--append", action='store_true',
+                        help="only compute the samples appended to the store since the existing outputs in out_dir were written")
+    parser.add_argument("--changed_reactions_path", type=str,
+                        help="path to the reactions changed by preprocess-gem.py --incremental; " + \
+                        "columns of the other reactions are reused from the existing outputs in out_dir (if the file exists)",
+                        required=False, default=None)
     
     parser.add_argument("--log_path", type=str,
                         help="path to log file",
@@ -21,87 +32,58 @@ def parse_args():
                         help="path to output dir",
                         required=True, default=None)
     args = parser.parse_args()
+    if(args.append and args.changed_reactions_path is not None):
+        parser.error('--append cannot be combined with --changed_reactions_path')
     return args
 
-def str_to_set(cell):
-    cell = ''.join(c for c in cell if c not in "'{}")
-    if(len(cell) == 0):
-        return {}
-    cell = set(cell.split(', '))
-    if('set()' in cell):
-        cell.remove('set()')
-    return cell
-
 def main(args):
     Path(args.out_dir).mkdir(parents=True, exist_ok=True)
     
-    orig_stdout = sys.stdout
-    log_file = open(args.log_path, 'w')
-    sys.stdout = log_file
-    
-    print('react_set_path', args.react_set_path)
-    print('met_change_path', args.met_change_path)
-    print('valid_met_path', args.valid_met_path)
-    print('log_path', args.log_path)
-    print('out_dir', args.out_dir)
-    
-    change_df = pd.read_csv(args.met_change_path, sep='\t', index_col='key')
-       
-    change_df = change_df.sort_index().sort_index(axis=1)
-
-    id_df = pd.read_csv(args.valid_met_path, sep='\t')
-    met_to_id = dict(zip(id_df.MET_ID, id_df.ID))
-    
+    with log_to(args.log_path):
+        for name, value in vars(args).items():
+            logger.info('%s %s', name, value)
+        
+        metadata = read_metadata(args.met_store_path)
+        contrasts = metadata['contrasts']
     
+        # features are row-wise, so appended samples are computed on their own
+        out_path = args.out_dir + '/reaction.change.tsv'
+        matrix_path = args.out_dir + '/reaction.change' + MATRIX_SUFFIX
+        append = args.append and Path(out_path).exists() and Path(matrix_path).exists()
+        new_samples = pending_samples(args.met_store_path, out_path) if append else None
+        logger.info('new_samples %s', new_samples)
+        changes, samples, mets = read_change_tensor(args.met_store_path, metadata=metadata, samples=new_samples)
+        logger.info('changes %s, contrasts %s', changes.shape, contrasts)
 
-    react_set_df = pd.read_csv(args.react_set_path, sep='\t')
-
-    react_set_df['Measured_Substrate'] = react_set_df['Measured_Substrate'].apply(lambda x: str_to_set(x))
-    react_set_df['Measured_Product'] = react_set_df['Measured_Product'].apply(lambda x: str_to_set(x))
+        met_to_id = read_met_to_id(args.valid_met_path)
+        react_set_df = read_reaction_set(args.react_set_path)
+        logger.info('react_set_df %s', react_set_df.shape)
 
-    rc1_df_dict = {}
-    for idx, rxn in react_set_df.iterrows():
-        rc1_col = 0
-        print(rxn)
-        for s in rxn['Measured_Substrate']:
-            if(not s in met_to_id):
-                print('s', s, idx, rxn['Measured_Substrate'], rxn)
-            rc1_col = rc1_col - change_df[met_to_id[s]]
-        for p in rxn['Measured_Product']:
-            if(not p in met_to_id):
-                print('p', p, idx, rxn['Measured_Product'], rxn)
-            rc1_col = rc1_col + change_df[met_to_id[p]]
-        rc1_df_dict[rxn['RXN_ID']] = rc1_col
-    rc1_df = pd.DataFrame(rc1_df_dict)
-    rc1_df.index = change_df.index
+        # only the first reactions are reported; those unchanged since the previous run are reused
+        react_ids = reported_reactions(react_set_df)
+        hashes = None if append else input_hashes(changes, mets, react_set_df, met_to_id, react_ids)
+        reused_ids, reused_df = [], None
+        if(args.changed_reactions_path is not None and Path(args.changed_reactions_path).exists()):
+            changed = read_changed_reactions(args.changed_reactions_path)
+            reused_ids, reused_df = reusable_columns(out_path, react_ids, changed, samples, contrasts, hashes)
+        logger.info('%d reused reactions', len(reused_ids))
     
-    rc1_df = rc1_df.iloc[:, :2]
+        with phase('change features', reactions=len(react_set_df)):
+            rc1_df, _ = change_features(changes, samples, mets, react_set_df, met_to_id, contrasts, reused_ids, reused_df)
     
-    df1 = rc1_df.reset_index(names='index')
-    sample_split = df1['index'].str.rsplit(":", n=1, expand=True)
-    if sample_split.shape[1] != 2:
-        raise ValueError(
-            "Unexpected sample index format encountered while splitting into sample_id and sample_group"
-        )
-    df1[['sample_id', 'sample_group']] = sample_split
-    df1 = df1.set_index(['sample_id', 'sample_group'])
-    df1 = df1.drop(columns='index')
-    df1.to_csv(args.out_dir + '/reaction.change.tsv', sep='\t', index=True)
-    
-    df2 = pd.concat([change_df, rc1_df], axis=1)
-    df2 = df2.reset_index(names='index')
-    sample_split = df2['index'].str.rsplit(":", n=1, expand=True)
-    if sample_split.shape[1] != 2:
-        raise ValueError(
-            "Unexpected sample index format encountered while splitting into sample_id and sample_group"
-        )
-    df2[['sample_id', 'sample_group']] = sample_split
-    df2 = df2.set_index(['sample_id', 'sample_group'])
-    df2 = df2.drop(columns='index')
-    df2.to_csv(args.out_dir + '/metabolite.reaction.change.tsv', sep='\t', index=True)
-        
-    sys.stdout = orig_stdout
-    log_file.close()
+        # the classification reads the memory-mapped matrix; the metabolite+reaction
+        # matrix references the metabolite block instead of copying it
+        # the input hashes only cover the samples they were computed on
+        if(append):
+            append_tsv(rc1_df, out_path)
+            append_matrix(rc1_df, matrix_path)
+            Path(hash_path(out_path)).unlink(missing_ok=True)
+        else:
+            rc1_df.to_csv(out_path, sep='\t', index=True)
+            write_matrix(rc1_df, matrix_path)
+            write_input_hashes(hashes, out_path)
+        write_combination(args.out_dir + '/metabolite.reaction.change.json',
+                          [baseline_path(args.met_store_path), matrix_path])
     
 if __name__ == "__main__":
     main(parse_args())
@@ -1,7 +1,32 @@
 import argparse
-import pandas as pd
 from pathlib import Path
-import sys
+from feature_store import (
+    MATRIX_SUFFIX,
+    append_matrix,
+    baseline_path,
+    write_combination,
+    write_matrix,
+)
+from features import ratio_features, reported_reactions
+from logging_utils import get_logger, log_to
+from metabolome_store import (
+    append_tsv,
+    pending_samples,
+    read_change_tensor,
+    read_metadata,
+)
+from profiling import phase
+from reaction_sets import (
+    hash_path,
+    input_hashes,
+    read_changed_reactions,
+    read_met_to_id,
+    read_reaction_set,
+    reusable_columns,
+    write_input_hashes,
+)
+
+logger = get_logger("compute-ratio-feature")
 
 
 def parse_args():
@@ -14,9 +39,9 @@ def parse_args():
         default=None,
     )
     parser.add_argument(
-        "--met_change_path",
+        "--met_store_path",
         type=str,
-        help="path to metabolite concentration change in .tsv format",
+        help="path to the columnar store of preprocessed metabolome",
         required=True,
         default=None,
     )
@@ -27,6 +52,19 @@ def parse_args():
         required=True,
         default=None,
     )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="only compute the samples appended to the store since the existing outputs in out_dir were written",
+    )
+    parser.add_argument(
+        "--changed_reactions_path",
+        type=str,
+        help="path to the reactions changed by preprocess-gem.py --incremental; "
+        + "columns of the other reactions are reused from the existing outputs in out_dir (if the file exists)",
+        required=False,
+        default=None,
+    )
 
     parser.add_argument(
         "--log_path", type=str, help="path to log file", required=True, default=None
@@ -36,97 +74,76 @@ def parse_args():
     )
 
     args = parser.parse_args()
+    if args.append and args.changed_reactions_path is not None:
+        parser.error("--append cannot be combined with --changed_reactions_path")
     return args
 
 
-def str_to_set(cell):
-    cell = "".join(c for c in cell if c not in "'{}")
-    cell = set(cell.split(", "))
-    if "set()" in cell:
-        cell.remove("set()")
-    return cell
-
-
-def cross_product(set1, set2):
-    product = []
-    for s1 in set1:
-        for s2 in set2:
-            product.append((s1, s2))
-    return product
-
-
 def main(args):
     Path(args.out_dir).mkdir(parents=True, exist_ok=True)
 
-    orig_stdout = sys.stdout
-    orig_stderr = sys.stderr
-    log_file = open(args.log_path, "w")
-    sys.stdout = log_file
-    sys.stderr = log_file
-
-    change_df = pd.read_csv(args.met_change_path, sep="\t", index_col="key")
-    change_df = change_df.sort_index().sort_index(axis=1)
-
-    id_df = pd.read_csv(args.valid_met_path, sep="\t")
-    met_to_hmdb = dict(zip(id_df.MET_ID, id_df.ID))
+    with log_to(args.log_path):
+        for name, value in vars(args).items():
+            logger.info("%s %s", name, value)
 
-    react_set_df = pd.read_csv(args.react_set_path, sep="\t")
-    react_set_df["Measured_Substrate"] = react_set_df["Measured_Substrate"].apply(
-        lambda x: str_to_set(x)
-    )
-    react_set_df["Measured_Product"] = react_set_df["Measured_Product"].apply(
-        lambda x: str_to_set(x)
-    )
+        metadata = read_metadata(args.met_store_path)
+        contrasts = metadata["contrasts"]
 
-    react_set_df["Measured_Product_Substrate_Pair"] = react_set_df.apply(
-        lambda x: cross_product(x["Measured_Product"], x["Measured_Substrate"]), axis=1
-    )
-
-    react_col = 0
-
-    er1_df_dict = {}
-    for idx, rxn in react_set_df.iterrows():
-        er1_col = 0
-        for pair in rxn["Measured_Product_Substrate_Pair"]:
-            if not (pair[0] in met_to_hmdb):
-                print("pair[0]", pair[0], rxn["Measured_Product_Substrate_Pair"])
-            hmdb_product = met_to_hmdb[pair[0]]
-            if not (pair[1] in met_to_hmdb):
-                print("pair[1]", pair[1], rxn["Measured_Product_Substrate_Pair"])
-            hmdb_substrate = met_to_hmdb[pair[1]]
-            er1_col = er1_col + (change_df[hmdb_product] / change_df[hmdb_substrate])
-        er1_df_dict[rxn["RXN_ID"]] = er1_col
-
-    er1_df = pd.DataFrame(er1_df_dict)
-
-    er1_df = er1_df.iloc[:, :2]
-
-    df1 = er1_df.reset_index(names="index")
-    sample_split = df1["index"].str.rsplit(":", n=1, expand=True)
-    if sample_split.shape[1] != 2:
-        raise ValueError(
-            "Unexpected sample index format encountered while splitting into sample_id and sample_group"
+        # features are row-wise, so appended samples are computed on their own
+        out_path = args.out_dir + "/reaction.ratio.tsv"
+        matrix_path = args.out_dir + "/reaction.ratio" + MATRIX_SUFFIX
+        append = (
+            args.append and Path(out_path).exists() and Path(matrix_path).exists()
+        )
+        new_samples = pending_samples(args.met_store_path, out_path) if append else None
+        logger.info("new_samples %s", new_samples)
+        changes, samples, mets = read_change_tensor(
+            args.met_store_path, metadata=metadata, samples=new_samples
+        )
+        logger.info("changes %s, contrasts %s", changes.shape, contrasts)
+
+        met_to_hmdb = read_met_to_id(args.valid_met_path)
+        react_set_df = read_reaction_set(args.react_set_path)
+
+        # only the first reactions are reported; those unchanged since the
+        # previous run are reused
+        react_ids = reported_reactions(react_set_df)
+        hashes = (
+            None
+            if append
+            else input_hashes(changes, mets, react_set_df, met_to_hmdb, react_ids)
         )
-    df1[["sample_id", "sample_group"]] = sample_split
-    df1 = df1.set_index(["sample_id", "sample_group"])
-    df1 = df1.drop(columns="index")
-    df1.to_csv(args.out_dir + "/reaction.ratio.tsv", sep="\t", index=True)
-
-    df2 = pd.concat([change_df, er1_df], axis=1)
-    df2 = df2.reset_index(names="index")
-    sample_split = df2["index"].str.rsplit(":", n=1, expand=True)
-    if sample_split.shape[1] != 2:
-        raise ValueError(
-            "Unexpected sample index format encountered while splitting into sample_id and sample_group"
+        reused_ids, reused_df = [], None
+        if args.changed_reactions_path is not None and Path(
+            args.changed_reactions_path
+        ).exists():
+            changed = read_changed_reactions(args.changed_reactions_path)
+            reused_ids, reused_df = reusable_columns(
+                out_path, react_ids, changed, samples, contrasts, hashes
+            )
+        logger.info("%d reused reactions", len(reused_ids))
+
+        with phase("ratio features", reactions=len(react_set_df)):
+            er1_df, _ = ratio_features(
+                changes, samples, mets, react_set_df, met_to_hmdb, contrasts, reused_ids, reused_df
+            )
+
+        # the classification reads the memory-mapped matrix; the
+        # metabolite+reaction matrix references the metabolite block instead
+        # of copying it; the input hashes only cover the samples they were
+        # computed on
+        if append:
+            append_tsv(er1_df, out_path)
+            append_matrix(er1_df, matrix_path)
+            Path(hash_path(out_path)).unlink(missing_ok=True)
+        else:
+            er1_df.to_csv(out_path, sep="\t", index=True)
+            write_matrix(er1_df, matrix_path)
+            write_input_hashes(hashes, out_path)
+        write_combination(
+            args.out_dir + "/metabolite.reaction.ratio.json",
+            [baseline_path(args.met_store_path), matrix_path],
         )
-    df2[["sample_id", "sample_group"]] = sample_split
-    df2 = df2.set_index(["sample_id", "sample_group"])
-    df2 = df2.drop(columns="index")
-    df2.to_csv(args.out_dir + "/metabolite.reaction.ratio.tsv", sep="\t", index=True)
-
-    sys.stdout = orig_stdout
-    sys.stderr = orig_stderr
-    log_file.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+import contextlib
+import csv
+import json
+import os
+import warnings
+import numpy as np
+from joblib import parallel_config
+from sklearn.metrics import average_precision_score, classification_report, roc_auc_score
+from logging_utils import get_logger
+from profiling import phase
+from report import TOP_FEATURES, TOP_FEATURES_SUFFIX, plot_classification
+from resampling import CONFIDENCE, resample_metrics
+from screening import SCREENING_STEPS, screen_features
+
+# Evaluation shared by every learner of the classification (the random forest
+# of classification.py and the learners of learners.py): the estimator of the
+# performance, the joblib backend of the parallel folds, the screening of the
+# feature matrix and the outputs written for every classification.
+
+# columns constant within a fold have no F score
+warnings.filterwarnings(action='ignore', category=UserWarning, module='sklearn.feature_selection')
+warnings.filterwarnings(action='ignore', category=RuntimeWarning, module='sklearn.feature_selection')
+
+# Estimators of the performance: LeaveOneOut up to LOO_MAX_SAMPLES samples,
+# repeated stratified k-fold up to KFOLD_MAX_SAMPLES, then the out-of-bag
+# predictions of a single forest fitted on every sample. 'auto' picks one by
+# the number of samples.
+EVALUATIONS = ['auto', 'loo', 'kfold', 'oob']
+LOO_MAX_SAMPLES = 100
+KFOLD_MAX_SAMPLES = 1000
+KFOLD_SPLITS = 5
+KFOLD_REPEATS = 3
+
+logger = get_logger('evaluation')
+
+def evaluation_mode(n_samples, evaluation='auto', search='grid'):
+    """Estimator of the performance of a matrix of n_samples: 'loo', 'kfold' or 'oob' (not after halving)."""
+    if evaluation == 'auto':
+        if n_samples <= LOO_MAX_SAMPLES:
+            evaluation = 'loo'
+        elif n_samples <= KFOLD_MAX_SAMPLES:
+            evaluation = 'kfold'
+        else:
+            evaluation = 'oob'
+    if evaluation == 'oob' and search == 'halving':
+        return 'kfold'
+    return evaluation
+
+def evaluation_folds(n_samples, evaluation='auto', search='grid'):
+    """Forests fitted per parameter set to evaluate a matrix of n_samples."""
+    mode = evaluation_mode(n_samples, evaluation, search)
+    return {'loo': n_samples, 'kfold': KFOLD_SPLITS * KFOLD_REPEATS, 'oob': 1}[mode]
+
+def evaluation_record(mode, post_selection=False):
+    """
+    Description of an estimator of the performance, written with the metrics;
+    post_selection marks metrics computed from the same predictions the
+    parameters were chosen by, which are optimistic.
+    """
+    record = {'estimator': mode}
+    if mode == 'kfold':
+        record.update(splits=KFOLD_SPLITS, repeats=KFOLD_REPEATS)
+    if post_selection:
+        record['post_selection'] = True
+    return record
+
+def fold_jobs(n_jobs, n_folds):
+    """Splits n_jobs cores into (folds fitted in parallel, forest jobs per fold)."""
+    cv_jobs = max(1, min(n_jobs, n_folds))
+    return cv_jobs, max(1, n_jobs // cv_jobs)
+
+def fold_backend(backend, cv_jobs):
+    """
+    joblib configuration of the folds fitted on cv_jobs processes: the backend,
+    with one BLAS/OpenMP thread in each loky worker, where the threadpool
+    limits of the parent do not reach, so that the cores are not oversubscribed.
+    """
+    if cv_jobs <= 1:
+        return contextlib.nullcontext()
+    inner_threads = {'inner_max_num_threads': 1} if backend == 'loky' else {}
+    return parallel_config(backend=backend, **inner_threads)
+
+def held_out_proba(cv_result, X):
+    """
+    Held-out class probabilities of every sample from the fold estimators of a
+    cross_validate result, averaged over the repeats holding it out.
+    """
+    y_proba = np.zeros((len(X), len(cv_result["estimator"][0].classes_)))
+    counts = np.zeros(len(X))
+    for estimator, test_idx in zip(cv_result["estimator"], cv_result["indices"]["test"]):
+        y_proba[test_idx] += estimator.predict_proba(X[test_idx])
+        counts[test_idx] += 1
+    return y_proba / counts[:, np.newaxis]
+
+def screen_matrix(X, screen, univariate_k, out_dir):
+    """
+    Screens the columns of X (screen) ahead of every learner, returning the
+    screened matrix and the record of the columns each step removes.
+    """
+    screening = {'columns': X.shape[1]}
+    if screen:
+        with phase('screening', out_dir=out_dir, shape=list(X.shape)):
+            X, removed = screen_features(X)
+        screening.update(removed)
+        logger.info('Screening removed %d non-finite, %d constant and %d duplicate columns; %d left',
+                    *[removed[step] for step in SCREENING_STEPS], X.shape[1])
+    screening['univariate_k'] = univariate_k
+    screening['kept'] = min(univariate_k or X.shape[1], X.shape[1])
+    screening['univariate'] = X.shape[1] - screening['kept']
+    if screening['univariate']:
+        logger.info('The univariate filter keeps %d of %d columns in every fold', screening['kept'], X.shape[1])
+    return X, screening
+
+def write_outputs(prefix, X, y_true, y_proba, importances, case, control, records, plots=True):
+    """
+    Writes the predictions, the performance metrics (with records), the
+    feature importances and the group statistics of a classification to the
+    files <prefix>.*, and their figures with plots; returns the metrics.
+    """
+    out_dir = os.path.dirname(prefix)
+    np.savetxt(fname=prefix + '.classifier_prediction.tsv', header=case + '\t' + control, X=y_proba, delimiter='\t')
+    
+    y_pred = [score.argmax() for score in y_proba]
+    
+    metric = classification_report(y_true, y_pred, target_names=[control, case], output_dict=True)
+    metric['auroc'] = round(roc_auc_score(y_true, y_proba[:, 1]), 2)
+    metric['auprc'] = round(average_precision_score(y_true, y_proba[:, 1]), 2)
+    # the groups, what the labels of the outputs are read back by (resampling.py)
+    metric.update(case=case, control=control)
+    metric.update(records)
+    # bootstrap intervals and permutation p-values of the metrics, from the held-out probabilities
+    metric['resampling'] = resample_metrics(y_true, y_proba)
+    
+    metric_file = open(prefix + '.classifier_performance.json', 'w')
+    # Write metrics and force flush/close immediately to avoid data loss
+    json.dump(metric, metric_file)
+    metric_file.flush()
+    os.fsync(metric_file.fileno())
+    metric_file.close()
+    
+    logger.info('Accuracy %s, AUROC %s, AUPRC %s', metric['accuracy'], metric['auroc'], metric['auprc'])
+    logger.info('AUROC %d%% interval %s, permutation p-value %s', CONFIDENCE * 100,
+                metric['resampling']['auroc']['ci'], metric['resampling']['auroc']['p_value'])
+
+    feature_idxs = np.argsort(importances)[::-1]
+    best_features = X.columns[feature_idxs[:TOP_FEATURES]]
+    logger.info('Top-10 features for %s: %s', case, list(best_features))
+
+    # feature means per group write-out
+    classes = {0: control, 1: case}
+    X_gb = X.copy().iloc[:, feature_idxs]
+    X_gb["group"] = list(map(lambda i: classes[i], y_true))
+    X_gb.groupby("group").mean().to_csv(prefix + '.feature-mean.csv')
+    X_gb.groupby("group").std().to_csv(prefix + '.feature-std.csv')
+    # the samples of the top features, what their boxplots are drawn from
+    X_gb[list(best_features) + ["group"]].to_csv(prefix + TOP_FEATURES_SUFFIX, sep='\t')
+
+    # Feautre importances write out
+    best_features_list = list(
+        zip(
+            [X.columns[idx] for idx in feature_idxs],
+            [importances[idx] for idx in feature_idxs],
+        )
+    )
+    #best_features_per_food[food] = best_features_list
+    with open(prefix + '.feature-importance.csv', "w") as f:
+        w = csv.writer(f)
+        w.writerow(["Feature", "Importance"])
+        for idx in feature_idxs:
+            w.writerow([X.columns[idx], importances[idx]])
+
+    if plots:
+        with phase('plotting', out_dir=out_dir):
+            plot_classification(prefix, case)
+    return metric
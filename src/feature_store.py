@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+# Memory-mapped feature matrices for the classification.
+# A feature stage writes every matrix as <name>.npy, a float32 array, next to
+# <name>.index.json, its sample (row) and column index. Readers map the array
+# read-only (np.load with mmap_mode="r"): nothing is parsed or converted, the
+# DataFrame and X.values are views of the mapping, and the workers classifying
+# matrices share its pages through the page cache. float32 is the precision
+# the forests are fitted in anyway (sklearn trees convert X to it).
+# A combination of matrices, the metabolite+reaction features, is a <name>.json
+# listing its parts instead of a copy of them: the metabolite block is written
+# once by the preprocessing (metabolite.npy, next to the metabolome store) and
+# referenced by the combination of every reaction set and feature kind.
+# Reading a combination does copy: its parts are stacked into one in-memory
+# array (a single copy, the parts already on its samples are not reindexed),
+# so the metabolite+reaction matrices are not views of the mappings.
+
+MATRIX_SUFFIX = ".npy"
+INDEX_SUFFIX = ".index.json"
+COMBINATION_SUFFIX = ".json"
+DTYPE = np.float32
+BASELINE_NAME = "metabolite" + MATRIX_SUFFIX
+
+
+def baseline_path(met_store_path):
+    """Path of the metabolite block written next to the metabolome store."""
+    return os.path.join(os.path.dirname(met_store_path), BASELINE_NAME)
+
+
+def index_path(path):
+    return path[: -len(MATRIX_SUFFIX)] + INDEX_SUFFIX
+
+
+def store_files(path):
+    """Files holding the matrix of path: a .npy array and its index, or a single file."""
+    if path.endswith(MATRIX_SUFFIX):
+        return [path, index_path(path)]
+    return [path]
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb" if path.endswith(MATRIX_SUFFIX) else "w") as f:
+        write(f)
+    # workers still mapping the previous array keep reading it
+    os.replace(tmp_path, path)
+
+
+def write_matrix(df, path):
+    """Writes a feature matrix to path (.npy) and its index."""
+    values = np.ascontiguousarray(df.to_numpy(dtype=DTYPE))
+    index = {
+        "index_name": df.index.name,
+        "samples": df.index.tolist(),
+        "columns": [str(column) for column in df.columns],
+    }
+    _write_atomic(path, lambda f: np.save(f, values))
+    _write_atomic(index_path(path), lambda f: json.dump(index, f))
+
+
+def read_index(path):
+    with open(index_path(path)) as f:
+        return json.load(f)
+
+
+def read_matrix(path):
+    """Feature matrix of a .npy array, as a DataFrame over a read-only memory map."""
+    values = np.load(path, mmap_mode="r")
+    index = read_index(path)
+    return pd.DataFrame(
+        values,
+        index=pd.Index(index["samples"], name=index["index_name"]),
+        columns=index["columns"],
+        copy=False,
+    )
+
+
+def append_matrix(df, path):
+    """Appends the rows of df to an existing matrix, in its column order."""
+    previous = read_matrix(path)
+    write_matrix(pd.concat([previous, df[previous.columns].astype(DTYPE)]), path)
+
+
+def write_combination(path, parts):
+    """Writes a combination of the matrices of parts, referenced relative to path."""
+    out_dir = os.path.dirname(os.path.abspath(path))
+    combination = {"parts": [os.path.relpath(os.path.abspath(part), out_dir) for part in parts]}
+    _write_atomic(path, lambda f: json.dump(combination, f, indent=4))
+
+
+def combination_parts(path):
+    """Paths of the matrices combined by path."""
+    with open(path) as f:
+        parts = json.load(f)["parts"]
+    return [os.path.normpath(os.path.join(os.path.dirname(path), part)) for part in parts]
+
+
+def copy_matrix(path, out_dir):
+    """Copies the matrix of path to out_dir; a combination is rewritten to reference the same parts."""
+    if path.endswith(COMBINATION_SUFFIX):
+        write_combination(os.path.join(out_dir, os.path.basename(path)), combination_parts(path))
+        return
+    for file_path in store_files(path):
+        shutil.copy(file_path, out_dir)
+
+
+def combine(matrices):
+    """The columns of matrices side by side, on the samples of the last one, in a new array."""
+    samples = matrices[-1].index
+    # hstack copies every part once; .loc would copy the reindexed ones first
+    values = np.hstack(
+        [(matrix if matrix.index.equals(samples) else matrix.loc[samples]).to_numpy() for matrix in matrices]
+    )
+    columns = [column for matrix in matrices for column in matrix.columns]
+    return pd.DataFrame(values, index=samples, columns=columns)
+
+
+def read_features(path, read=None):
+    """
+    Feature matrix of a .tsv, a .npy array or a combination (.json); read
+    opens the .npy parts of a combination (read_matrix by default).
+    """
+    read = read or read_matrix
+    if path.endswith(MATRIX_SUFFIX):
+        return read(path)
+    if path.endswith(COMBINATION_SUFFIX):
+        return combine([read_features(part, read) for part in combination_parts(path)])
+    return pd.read_csv(path, sep="\t", index_col="sample")
+
+
+def matrix_shape(path):
+    """(rows, columns) of a feature matrix, from its index, without reading it."""
+    if path.endswith(MATRIX_SUFFIX):
+        index = read_index(path)
+        return len(index["samples"]), len(index["columns"])
+    if path.endswith(COMBINATION_SUFFIX):
+        shapes = [matrix_shape(part) for part in combination_parts(path)]
+        return shapes[-1][0], sum(n_cols for _, n_cols in shapes)
+    with open(path) as f:
+        n_cols = len(f.readline().split("\t")) - 1
+        n_rows = sum(1 for _ in f)
+    return n_rows, n_cols
@@ -0,0 +1,283 @@
+import logging
+import numpy as np
+import pandas as pd
+import networkx as nx
+import scipy.sparse as sp
+from metabolome_store import contrast_columns, contrast_frame, contrast_label
+from profiling import phase
+from logging_utils import get_logger
+from reaction_sets import incidence_matrix, pair_indices
+
+# Change, Ratio and Prob features of the preprocessed metabolome and a
+# reaction set, computed in memory. The compute-*-feature.py scripts read
+# their inputs from the store and reaction set files, call these functions
+# and write the returned frames; the pipeline can also call them directly.
+
+# only the first reactions of a reaction set are reported as features
+REPORTED_REACTIONS = 2
+
+logger = get_logger('features')
+
+def reported_reactions(react_set_df):
+    return list(react_set_df['RXN_ID'][:REPORTED_REACTIONS])
+
+def change_features(changes, samples, mets, react_set_df, met_to_id, contrasts, reused_ids=(), reused_df=None):
+    """Change features of every sample and contrast.
+
+    changes is the (sample x contrast x metabolite) change tensor with
+    metabolites labelled by standard identifier. The columns of the reactions
+    in reused_ids are taken from reused_df instead of being recomputed.
+    Returns the reaction features and the metabolite + reaction features.
+    """
+    react_ids = reported_reactions(react_set_df)
+    if(reused_df is None):
+        reused_df = pd.DataFrame(index=samples)
+    react_set_df = react_set_df.iloc[:REPORTED_REACTIONS]
+    react_set_df = react_set_df[~react_set_df['RXN_ID'].isin(reused_ids)]
+
+    # (metabolite x reaction) signs: +1 for measured products, -1 for measured substrates
+    stoich = incidence_matrix(react_set_df, 'Measured_Product', met_to_id, mets) - \
+        incidence_matrix(react_set_df, 'Measured_Substrate', met_to_id, mets)
+
+    # reaction change of every sample and contrast in one product
+    n_samples, n_contrasts, n_mets = changes.shape
+    rc1 = (changes.reshape(-1, n_mets) @ stoich).reshape(n_samples, n_contrasts, stoich.shape[1])
+
+    rc1_df = contrast_frame(rc1, samples, list(react_set_df['RXN_ID']), contrasts)
+    rc1_df = pd.concat([rc1_df, reused_df], axis=1)[contrast_columns(react_ids, contrasts)]
+
+    change_df = contrast_frame(changes, samples, list(mets), contrasts)
+    df2 = pd.concat([change_df, rc1_df], axis=1)
+    return rc1_df, df2
+
+def ratio_features(changes, samples, mets, react_set_df, met_to_id, contrasts, reused_ids=(), reused_df=None):
+    """Ratio features of every sample and contrast, with the arguments and returns of change_features."""
+    react_ids = reported_reactions(react_set_df)
+    if(reused_df is None):
+        reused_df = pd.DataFrame(index=samples)
+    react_set_df = react_set_df.iloc[:REPORTED_REACTIONS]
+    react_set_df = react_set_df[~react_set_df['RXN_ID'].isin(reused_ids)]
+
+    # every measured (product, substrate) pair and the reaction it belongs to
+    product_idx, substrate_idx, react_idx = pair_indices(react_set_df, met_to_id, mets)
+    logger.info('%d measured (product, substrate) pairs', len(react_idx))
+
+    # product / substrate change of every pair, sample and contrast at once,
+    # then summed per reaction through a sparse (pair x reaction) indicator
+    # so that inf/nan of one pair stays within its own reaction
+    n_samples, n_contrasts, _ = changes.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pair_ratio = changes[:, :, product_idx] / changes[:, :, substrate_idx]
+    pair_to_react = sp.csr_array((np.ones(len(react_idx)), (np.arange(len(react_idx)), react_idx)),
+                                 shape=(len(react_idx), len(react_set_df)))
+    er1 = (pair_ratio.reshape(n_samples * n_contrasts, len(react_idx)) @ pair_to_react).reshape(
+        n_samples, n_contrasts, len(react_set_df))
+
+    er1_df = contrast_frame(er1, samples, list(react_set_df['RXN_ID']), contrasts)
+    er1_df = pd.concat([er1_df, reused_df], axis=1)[contrast_columns(react_ids, contrasts)]
+
+    change_df = contrast_frame(changes, samples, list(mets), contrasts)
+    df2 = pd.concat([change_df, er1_df], axis=1)
+    return er1_df, df2
+
+def build_network(base, end, samples, mets, react_set_df, met_to_hmdb):
+    """Builds the weighted sample-metabolite-reaction edges of one contrast.
+
+    base and end are (sample x metabolite) arrays. Nodes are the samples,
+    one increase (M+) and one decrease (M-) node per metabolite and the
+    reactions; edges are returned as (source, target, weight) arrays of node
+    positions.
+    """
+    n_samples = len(samples)
+    n_mets = len(mets)
+    nodes = list(samples) + [met + '+' for met in mets] + [met + '-' for met in mets] + list(react_set_df['RXN_ID'])
+    inc_offset = n_samples
+    dec_offset = n_samples + n_mets
+    react_offset = n_samples + 2 * n_mets
+
+    change = end - base
+    change_direction = change > 0 # True(1) -> increase (M+ node), False(0) -> decrease (M- node)
+    change_magnitude = np.abs(change)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sample_met_inc = change_magnitude / end # if end concentration is zero
+        sample_met_dec = change_magnitude / base
+    sample_met_inc[~np.isfinite(sample_met_inc)] = 0
+    sample_met_dec[~np.isfinite(sample_met_dec)] = 0
+
+    sample_met_weight = np.where(change_direction, sample_met_inc, sample_met_dec)
+    with np.errstate(over='ignore'):
+        sample_met_weight = np.exp(sample_met_weight)
+    sample_met_prob = sample_met_weight / sample_met_weight.sum(axis=1, keepdims=True)
+
+    sample_pos, met_pos = np.indices((n_samples, n_mets))
+    met_node = np.where(change_direction, inc_offset, dec_offset) + met_pos
+    srcs = [sample_pos.ravel()]
+    dsts = [met_node.ravel()]
+    weights = [sample_met_prob.ravel()]
+
+    # metabolite -> sample: softmax over the samples changing in the node's direction
+    for offset, direction, magnitude in [(inc_offset, change_direction, sample_met_inc),
+                                         (dec_offset, ~change_direction, sample_met_dec)]:
+        with np.errstate(over='ignore', invalid='ignore'):
+            met_weight = np.exp(np.where(direction, magnitude, -np.inf))
+            met_weight = met_weight / met_weight.sum(axis=0, keepdims=True)
+        sample_idx, met_idx = np.nonzero(direction)
+        srcs.append(offset + met_idx)
+        dsts.append(sample_idx)
+        weights.append(met_weight[sample_idx, met_idx])
+
+    # reaction -> metabolite: substrates to M- nodes, products to M+ nodes, weighted by 1 / measured count
+    substrate = incidence_matrix(react_set_df, 'Measured_Substrate', met_to_hmdb, mets).tocoo()
+    product = incidence_matrix(react_set_df, 'Measured_Product', met_to_hmdb, mets).tocoo()
+    react_weight = 1 / react_set_df['Measured_Metabolite_Count'].to_numpy()
+
+    mismatch = react_set_df['Measured_Metabolite_Count'].to_numpy() != (substrate.sum(axis=0) + product.sum(axis=0))
+    if(mismatch.any()):
+        logger.warning('Count mismatch of %d reactions', mismatch.sum())
+        logger.debug('Count mismatch %s', list(react_set_df['RXN_ID'][mismatch]))
+
+    for offset, incidence in [(dec_offset, substrate), (inc_offset, product)]:
+        srcs.append(react_offset + incidence.col)
+        dsts.append(offset + incidence.row)
+        weights.append(react_weight[incidence.col])
+
+    # metabolite -> reaction: uniform over the reactions the node is mapped to
+    for offset, incidence in [(dec_offset, substrate), (inc_offset, product)]:
+        react_count = np.bincount(incidence.row, minlength=n_mets)
+        srcs.append(offset + incidence.row)
+        dsts.append(react_offset + incidence.col)
+        weights.append(1 / react_count[incidence.row])
+        no_react = np.flatnonzero(react_count == 0)
+        logger.info('No reaction mapped to %d metabolite nodes', len(no_react))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Unmapped metabolite nodes %s', [nodes[offset + i] for i in no_react])
+
+    return nodes, np.concatenate(srcs), np.concatenate(dsts), np.concatenate(weights)
+
+def build_graph(nodes, src, dst, weight):
+    G = nx.DiGraph()
+    G.add_weighted_edges_from(zip([nodes[i] for i in src], [nodes[i] for i in dst], weight))
+    return G
+
+def personalized_pagerank(src, dst, weight, n_nodes, sources, removed, alpha, max_iter=1000, tol=1.0e-6):
+    """Random walks with restart from every node in sources, solved together.
+
+    Mirrors networkx.pagerank with a single-node personalization: the graph is
+    restricted to the nodes with edges that are not in removed (and are not
+    isolated afterwards), edge weights are normalized per source node and the
+    mass of dangling nodes restarts at the personalization node. Rows are
+    iterated until each one meets the networkx convergence criterion.
+    Returns the (source x kept node) probabilities and the kept node positions.
+    """
+    keep = np.zeros(n_nodes, dtype=bool)
+    keep[src] = True
+    keep[dst] = True
+    keep[removed] = False
+    edge_keep = keep[src] & keep[dst]
+    src, dst, weight = src[edge_keep], dst[edge_keep], weight[edge_keep]
+    degree = np.bincount(src, minlength=n_nodes) + np.bincount(dst, minlength=n_nodes)
+    keep &= degree > 0
+
+    kept = np.flatnonzero(keep)
+    pos = np.full(n_nodes, -1)
+    pos[kept] = np.arange(len(kept))
+    N = len(kept)
+
+    A = sp.csr_array((weight, (pos[src], pos[dst])), shape=(N, N))
+    S = A.sum(axis=1)
+    dangling = S == 0
+    S[~dangling] = 1.0 / S[~dangling]
+    A = sp.diags_array(S) @ A
+
+    personalization = np.zeros((len(sources), N))
+    personalization[np.arange(len(sources)), pos[sources]] = 1.0
+    x = np.full((len(sources), N), 1.0 / N)
+    active = np.arange(len(sources))
+    for _ in range(max_iter):
+        xlast = x[active]
+        p = personalization[active]
+        x_active = alpha * (xlast @ A + xlast[:, dangling].sum(axis=1, keepdims=True) * p) + (1 - alpha) * p
+        x[active] = x_active
+        err = np.abs(x_active - xlast).sum(axis=1)
+        active = active[err >= N * tol]
+        if(len(active) == 0):
+            return x, kept
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
+def compute_prob_features(nodes, src, dst, weight, samples, registry, case, control, alpha):
+    logger.info('Prob features of %s vs %s', case, control)
+    
+    sample_group = registry['sample_group']
+    case_samples = set([s for s in samples if (sample_group[s] == case)])
+    control_samples = set([s for s in samples if (sample_group[s] == control)])
+    study_samples = sorted(case_samples.union(control_samples))
+    invalid_samples = sorted(set(samples).difference(study_samples))
+    
+    logger.info('%d case samples, %d control samples, %d other samples', len(case_samples), len(control_samples), len(invalid_samples))
+    logger.debug('Other samples %s', invalid_samples)
+    
+    sample_pos = {s: i for i, s in enumerate(samples)}
+    prob, kept = personalized_pagerank(src, dst, weight, len(nodes),
+                                       [sample_pos[s] for s in study_samples],
+                                       [sample_pos[s] for s in invalid_samples], alpha)
+    
+    df = pd.DataFrame(prob, index=pd.Index(study_samples, name='sample'), columns=[nodes[i] for i in kept])
+    
+    return df
+
+def prob_features(levels, changes, samples, mets, timepoints, contrasts, registry, react_set_df, met_to_id, case, control, alpha):
+    """Prob features of the case and control samples, one network per contrast.
+
+    levels and changes are the (sample x timepoint x metabolite) and
+    (sample x contrast x metabolite) tensors of the store.
+    Returns the equilibrium probabilities of all nodes, the reaction features,
+    the metabolite + reaction features and the network of every contrast
+    label.
+    """
+    eq_prob_dfs = []
+    prob_dfs = []
+    graphs = {}
+    for contrast in contrasts:
+        label = contrast_label(contrast)
+        base = levels[:, timepoints.index(contrast[0]), :]
+        end = levels[:, timepoints.index(contrast[1]), :]
+        
+        with phase('graph build', contrast=label):
+            nodes, src, dst, weight = build_network(base, end, list(samples), list(mets), react_set_df, met_to_id)
+            logger.info('%s: %d nodes, %d edges', label, len(nodes), len(src))
+        
+            G = build_graph(nodes, src, dst, weight)
+            node_label = {}
+            for n in G.nodes:
+                if n in registry.index:
+                    node_label[n] = 'sample'
+                elif n.endswith('+') or n.endswith('-'):
+                    node_label[n] = 'metabolite'
+                else:
+                    node_label[n] = 'reaction'
+            nx.set_node_attributes(G, node_label, name='label')
+            graphs[label] = G
+        react_nodes = sorted([n for n, l in node_label.items() if l == 'reaction'])
+        
+        solves = int(registry['sample_group'].loc[list(samples)].isin([case, control]).sum())
+        with phase('RWR', contrast=label, nodes=len(nodes), edges=len(src), solves=solves):
+            eq_prob_df = compute_prob_features(nodes, src, dst, weight, list(samples), registry,
+                                               case, control, alpha)
+        
+        prob_df = eq_prob_df[react_nodes]
+        prob_df = prob_df.iloc[:, :REPORTED_REACTIONS]
+        
+        if(len(contrasts) > 1):
+            eq_prob_df = eq_prob_df.add_suffix('@' + label)
+            prob_df = prob_df.add_suffix('@' + label)
+        eq_prob_dfs.append(eq_prob_df)
+        prob_dfs.append(prob_df)
+    
+    prob_df = pd.concat(prob_dfs, axis=1)
+    change_df = contrast_frame(changes, samples, list(mets), contrasts)
+    
+    logger.info('change_df %s, prob_df %s', change_df.shape, prob_df.shape)
+    
+    df3 = pd.concat([change_df, prob_df], axis=1)
+    return pd.concat(eq_prob_dfs, axis=1), prob_df, df3, graphs
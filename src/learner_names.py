@@ -0,0 +1,12 @@
+# Learners a classification can be run with (the forest of classification.py
+# and the learners of learners.py) and the names of their outputs: every
+# learner but the forest writes <case>.<control>.<learner>.*, next to the
+# forest's <case>.<control>.*. Kept apart so that the summaries and the
+# command lines can name the learners without importing them.
+
+LEARNERS = ["forest", "logistic", "ridge", "hgb"]
+
+
+def performance_prefix(case, control, learner="forest"):
+    """Name of the output files of a classification by learner: <case>.<control>[.<learner>]."""
+    return case + "." + control + ("" if learner == "forest" else "." + learner)
@@ -0,0 +1,265 @@
+import copy
+import os
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.feature_selection import SelectKBest, f_classif
+from sklearn.inspection import permutation_importance
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import LeaveOneOut, RepeatedStratifiedKFold, cross_validate
+from threadpoolctl import threadpool_limits
+from evaluation import (
+    KFOLD_REPEATS,
+    KFOLD_SPLITS,
+    evaluation_mode,
+    evaluation_record,
+    fold_backend,
+    fold_jobs,
+    held_out_proba,
+    screen_matrix,
+    write_outputs,
+)
+from learner_names import performance_prefix
+from logging_utils import get_logger
+from profiling import phase
+from resampling import auroc
+from screening import univariate_model
+
+# Cheap learners benchmarked next to the random forest.
+# ridge: a ridge classifier (targets -1/+1) whose LOO predictions come in
+# closed form from its hat matrix H = J/n + K (K + alpha I)^-1, K the Gram
+# matrix of the centered samples: one eigendecomposition of K gives the LOO
+# decision values (H y - diag(H) y) / (1 - diag(H)) of every alpha of
+# RIDGE_ALPHAS without a refit, and the alpha with the highest LOO AUROC is
+# kept (inside every fold for k-fold), ties going to the lowest LOO log-loss.
+# The squared error of the -1/+1 targets is not used: it favours the largest
+# alphas, where the ridge is close to its intercept, whose LOO predictions
+# (the mean of the other samples) rank the samples exactly in reverse.
+# The edge of the alpha chosen on every sample is recorded as "grid_edge" in
+# the search record of the performance json. logistic: an L2-regularized
+# logistic regression whose fold fits start from its solution on every sample
+# (warm_start), a few iterations away from theirs. hgb: a histogram gradient
+# boosting classifier, evaluated on the folds like the forest.
+# The linear learners see the columns standardized over every sample, which
+# involves no labels, so that the folds share one design; with a univariate
+# filter their columns differ by fold and every fold is fitted from scratch.
+# A learner writes the outputs of the forest under <case>.<control>.<learner>.*
+# next to the forest's <case>.<control>.*; out-of-bag evaluation has no
+# counterpart for them and becomes k-fold.
+
+RIDGE_ALPHAS = np.logspace(-2, 4, 13)
+LOGISTIC_C = 1.0
+LOGISTIC_MAX_ITER = 1000
+# leaves of the gradient boosting: its default of 20 samples leaves the
+# trees of small studies without a split (the forest grid uses 1 and 3)
+HGB_MIN_SAMPLES_LEAF = 3
+# permutations of every column for the importances of the gradient boosting
+PERMUTATION_REPEATS = 5
+
+logger = get_logger("learners")
+
+
+def standardize(values):
+    """Columns of values centered and scaled to unit variance; constant columns are only centered."""
+    values = np.asarray(values, dtype=np.float64)
+    std = values.std(axis=0)
+    return (values - values.mean(axis=0)) / np.where(std > 0, std, 1.0)
+
+
+def decision_proba(decision):
+    """Class probabilities [control, case] of decision values, through the logistic function."""
+    case_proba = 1 / (1 + np.exp(-decision))
+    return np.column_stack([1 - case_proba, case_proba])
+
+
+def ridge_loo(Z, y_true):
+    """
+    Closed-form LOO decision values of the ridge classifiers of RIDGE_ALPHAS
+    on Z: returns the alpha with the highest LOO AUROC (then the lowest LOO
+    log-loss), its LOO decision values and its fit on every sample,
+    (coefficients, intercept).
+    """
+    n_samples = len(Z)
+    target = 2.0 * y_true - 1
+    means = Z.mean(axis=0)
+    centered = Z - means
+    # the unpenalized intercept adds J/n to the hat matrix of the centered samples
+    eigenvalues, U = np.linalg.eigh(centered @ centered.T)
+    eigenvalues = np.clip(eigenvalues, 0, None)
+    projected = U.T @ (target - target.mean())
+    # (alpha x sample) LOO decision values
+    shrinkage = eigenvalues / (eigenvalues + RIDGE_ALPHAS[:, np.newaxis])
+    fitted = target.mean() + (shrinkage * projected) @ U.T
+    leverage = 1.0 / n_samples + shrinkage @ (U**2).T
+    loo = (fitted - leverage * target) / (1 - leverage)
+    aurocs = auroc(np.broadcast_to(y_true == 1, loo.shape), loo)
+    case_proba = 1 / (1 + np.exp(-loo))
+    log_losses = -np.log(np.where(y_true == 1, case_proba, 1 - case_proba)).mean(axis=1)
+    best = np.lexsort((log_losses, -aurocs))[0]
+    alpha = RIDGE_ALPHAS[best]
+    coef = centered.T @ (U @ (projected / (eigenvalues + alpha)))
+    return alpha, loo[best], (coef, target.mean() - means @ coef)
+
+
+def grid_edge(alpha):
+    """'lower' or 'upper' when alpha is at an end of RIDGE_ALPHAS, None inside the grid."""
+    if alpha == RIDGE_ALPHAS[0]:
+        return "lower"
+    if alpha == RIDGE_ALPHAS[-1]:
+        return "upper"
+    return None
+
+
+def fold_splits(mode, y_true):
+    """(train, test) indices of the folds of the evaluation mode ('loo' or 'kfold')."""
+    if mode == "loo":
+        return list(LeaveOneOut().split(y_true))
+    cv = RepeatedStratifiedKFold(n_splits=KFOLD_SPLITS, n_repeats=KFOLD_REPEATS, random_state=1)
+    return list(cv.split(np.zeros(len(y_true)), y_true))
+
+
+def selected(Z, y_true, univariate_k):
+    """Columns of Z kept by the univariate filter fitted on (Z, y_true); every column without one."""
+    if not univariate_k or univariate_k >= Z.shape[1]:
+        return np.ones(Z.shape[1], dtype=bool)
+    return SelectKBest(f_classif, k=univariate_k).fit(Z, y_true).get_support()
+
+
+def linear_fit(learner, Z, y_true):
+    """
+    Fits a linear learner on Z, returning a function of the class
+    probabilities of new samples and the coefficients.
+    """
+    if learner == "ridge":
+        _, _, (coef, intercept) = ridge_loo(Z, y_true)
+        return lambda Z_new: decision_proba(Z_new @ coef + intercept), coef
+    model = LogisticRegression(C=LOGISTIC_C, max_iter=LOGISTIC_MAX_ITER).fit(Z, y_true)
+    return model.predict_proba, model.coef_[0]
+
+
+def linear_fold_proba(learner, Z, y_true, splits, univariate_k):
+    """Held-out probabilities of a linear learner refitted on every fold, behind its univariate filter."""
+    y_proba = np.zeros((len(Z), 2))
+    counts = np.zeros(len(Z))
+    for train_idx, test_idx in splits:
+        columns = selected(Z[train_idx], y_true[train_idx], univariate_k)
+        predict_proba, _ = linear_fit(learner, Z[train_idx][:, columns], y_true[train_idx])
+        y_proba[test_idx] += predict_proba(Z[test_idx][:, columns])
+        counts[test_idx] += 1
+    return y_proba / counts[:, np.newaxis]
+
+
+def warm_started_proba(Z, y_true, splits):
+    """
+    Held-out probabilities of a logistic regression on every fold of splits,
+    each fit warm-started from the fit on every sample, which is returned too.
+    """
+    full = LogisticRegression(C=LOGISTIC_C, max_iter=LOGISTIC_MAX_ITER).fit(Z, y_true)
+    y_proba = np.zeros((len(Z), 2))
+    counts = np.zeros(len(Z))
+    for train_idx, test_idx in splits:
+        model = copy.deepcopy(full).set_params(warm_start=True).fit(Z[train_idx], y_true[train_idx])
+        y_proba[test_idx] += model.predict_proba(Z[test_idx])
+        counts[test_idx] += 1
+    return full, y_proba / counts[:, np.newaxis]
+
+
+def evaluate_linear(learner, X, y_true, mode, univariate_k):
+    """
+    Held-out probabilities, importances (absolute coefficients on the
+    standardized columns, of the fit on every sample) and chosen parameters
+    of a linear learner; those of the ridge include the grid_edge of the
+    alpha chosen on every sample.
+    """
+    Z = standardize(X)
+    splits = fold_splits(mode, y_true)
+    columns = selected(Z, y_true, univariate_k)
+    importances = np.zeros(Z.shape[1])
+    if learner == "ridge" and mode == "loo" and columns.all():
+        alpha, decision, (coef, _) = ridge_loo(Z, y_true)
+        importances[:] = np.abs(coef)
+        return decision_proba(decision), importances, {"alpha": float(alpha), "grid_edge": grid_edge(alpha)}
+    if learner == "logistic" and columns.all():
+        full, y_proba = warm_started_proba(Z, y_true, splits)
+        importances[:] = np.abs(full.coef_[0])
+        return y_proba, importances, {"C": LOGISTIC_C}
+    y_proba = linear_fold_proba(learner, Z, y_true, splits, univariate_k)
+    if learner == "logistic":
+        _, coef = linear_fit(learner, Z[:, columns], y_true)
+        importances[columns] = np.abs(coef)
+        return y_proba, importances, {"C": LOGISTIC_C}
+    alpha, _, (coef, _) = ridge_loo(Z[:, columns], y_true)
+    importances[columns] = np.abs(coef)
+    # the alpha of the ridge differs by fold
+    return y_proba, importances, {"alpha": None, "grid_edge": grid_edge(alpha)}
+
+
+def evaluate_boosting(X, y_true, mode, univariate_k, n_jobs, backend="loky"):
+    """
+    Held-out probabilities of the gradient boosting on the folds, fitted on
+    n_jobs cores through the joblib backend like those of the forest, and the
+    permutation importances of its fit on every sample.
+    """
+    boosting = HistGradientBoostingClassifier(min_samples_leaf=HGB_MIN_SAMPLES_LEAF, random_state=1)
+    model = univariate_model(boosting, univariate_k, X.shape[1])
+    splits = fold_splits(mode, y_true)
+    cv_jobs, _ = fold_jobs(n_jobs, len(splits))
+    with fold_backend(backend, cv_jobs):
+        cv_result = cross_validate(
+            model,
+            X,
+            y_true,
+            cv=splits,
+            n_jobs=cv_jobs,
+            return_estimator=True,
+            return_indices=True,
+        )
+    model.fit(X, y_true)
+    permuted = permutation_importance(model, X, y_true, n_repeats=PERMUTATION_REPEATS, random_state=1)
+    params = {"min_samples_leaf": HGB_MIN_SAMPLES_LEAF}
+    return held_out_proba(cv_result, X), np.clip(permuted.importances_mean, 0, None), params
+
+
+def learner_classifier(X, registry, case, control, out_dir, learner, n_jobs=1, backend="loky", evaluation="auto",
+                       plots=True, screen=False, univariate_k=None):
+    """
+    Evaluates the learner (logistic, ridge or hgb) on the feature matrix X
+    like tune_random_forest, on the same screening and folds, writing
+    its outputs to out_dir under <case>.<control>.<learner>.*; returns the
+    performance metrics.
+    """
+    sample_group = registry["sample_group"].loc[X.index]
+    y_true = (sample_group == case).to_numpy().astype(int)
+    prefix = os.path.join(out_dir, performance_prefix(case, control, learner))
+    logger.info("%s vs %s by %s: %d samples, %d features", case, control, learner, X.shape[0], X.shape[1])
+    X, screening = screen_matrix(X, screen, univariate_k, out_dir)
+    mode = evaluation_mode(len(X), evaluation)
+    if mode == "oob":
+        mode = "kfold"
+    logger.info("Performance estimated by %s", mode)
+    with phase("fitting " + learner, out_dir=out_dir, shape=list(X.shape), evaluation=mode), \
+            threadpool_limits(limits=1):
+        if learner == "hgb":
+            y_proba, importances, params = evaluate_boosting(
+                X.values, y_true, mode, univariate_k, n_jobs, backend
+            )
+        else:
+            y_proba, importances, params = evaluate_linear(learner, X.values, y_true, mode, univariate_k)
+    # the alpha of the ridge is chosen by its closed-form LOO AUROC
+    search_record = {"method": "loo" if learner == "ridge" else None}
+    if learner == "ridge":
+        edge = search_record["grid_edge"] = params.pop("grid_edge")
+        if edge is not None:
+            logger.info("%s vs %s -> ridge alpha at the %s edge of its grid", case, control, edge)
+    search_record["best_params"] = params
+    logger.info("%s vs %s -> %s parameters: %s", case, control, learner, params)
+
+    if importances.sum() > 0:
+        importances = importances / importances.sum()
+    records = {
+        "learner": learner,
+        "evaluation": evaluation_record(mode),
+        "search": search_record,
+        "screening": screening,
+    }
+    return write_outputs(prefix, X, y_true, y_proba, importances, case, control, records, plots)
+
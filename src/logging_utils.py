@@ -0,0 +1,64 @@
+import contextlib
+import logging
+import os
+import pathlib
+
+# Logging of the pipeline stages.
+# Modules and scripts log through their own logger (get_logger("features"))
+# instead of printing to a reassigned sys.stdout, and log_to() sends the
+# records of every stage, and the warnings, to a log file while a script or
+# stage runs. The level comes from PIPELINE_LOG_LEVEL (pipeline.py --log_level),
+# INFO by default: per-item diagnostics of the hot loops are logged at DEBUG
+# with lazy %-formatting, so they cost nothing unless asked for, and stages
+# log summary counts at INFO instead.
+
+LOG_LEVEL_ENV = "PIPELINE_LOG_LEVEL"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+ROOT_LOGGER = "pipeline"
+
+
+def get_logger(stage):
+    return logging.getLogger(f"{ROOT_LOGGER}.{stage}")
+
+
+def log_level():
+    return os.environ.get(LOG_LEVEL_ENV, "INFO").upper()
+
+
+@contextlib.contextmanager
+def log_to(target, mode="w"):
+    """
+    Sends the records of every stage and the warnings to target, a path or an
+    open stream, instead of the current log while in the context; exceptions
+    leaving the context are logged with their traceback.
+    """
+    if isinstance(target, (str, os.PathLike)):
+        pathlib.Path(target).parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(target, mode=mode)
+    else:
+        handler = logging.StreamHandler(target)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger(ROOT_LOGGER)
+    warnings_logger = logging.getLogger("py.warnings")
+    # the innermost log receives the records, like the stdout it replaces
+    saved = [(logger, logger.handlers[:], logger.level, logger.propagate) for logger in [root, warnings_logger]]
+    for logger in [root, warnings_logger]:
+        logger.handlers = [handler]
+        logger.setLevel(log_level())
+        logger.propagate = False
+    logging.captureWarnings(True)
+    try:
+        yield root
+    except Exception:
+        root.exception("Failed")
+        raise
+    finally:
+        handler.close()
+        for logger, handlers, level, propagate in saved:
+            logger.handlers = handlers
+            logger.setLevel(level)
+            logger.propagate = propagate
+        if not root.handlers:
+            logging.captureWarnings(False)
@@ -0,0 +1,198 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+STORE_NAME = 'metabolome.feather'
+STORE_VERSION = 4
+METADATA_KEY = b'gem-met'
+
+# Single columnar store for the preprocessed metabolome.
+# Every matrix is kept once, keyed by metabolite name, in a column named
+# '<kind>/<metabolite name>'. Kinds are the timepoints (base and end for a
+# two-timepoint study) and one change matrix per contrast, a (from, to) pair
+# of timepoints stored as 'change:<to>-<from>'.
+# Rows follow the sample registry: an integer 'sample' column mapped once to
+# 'sample_id' and a categorical 'sample_group', so feature matrices downstream
+# are indexed (and aligned) by the integer sample instead of
+# 'sample_id:sample_group' strings.
+# The schema metadata records the kinds, all preprocessed metabolite names and
+# the name -> standard identifier map of the gem-overlapped metabolites, so
+# readers can select one kind and/or the gem-overlapped subset without parsing
+# the rest of the file.
+# It also keeps the fitted preprocessing parameters (missing value counts of
+# every candidate metabolite per timepoint and the imputation minimums), so
+# newly enrolled samples can be appended without refitting them.
+
+def column_name(kind, met):
+    return kind + '/' + met
+
+def contrast_label(contrast):
+    return contrast[1] + '-' + contrast[0]
+
+def change_kind(contrast):
+    return 'change:' + contrast_label(contrast)
+
+def build_contrasts(timepoints, contrast='consecutive'):
+    """Pairs every timepoint with its predecessor ('consecutive') or with the first one ('baseline')."""
+    if(contrast == 'consecutive'):
+        return [(timepoints[i - 1], timepoints[i]) for i in range(1, len(timepoints))]
+    if(contrast == 'baseline'):
+        return [(timepoints[0], timepoints[i]) for i in range(1, len(timepoints))]
+    raise ValueError(f"Unknown contrast {contrast}")
+
+def change_tensor(levels, timepoints, contrasts):
+    """Subtracts the (sample x timepoint x metabolite) levels of every contrast at once."""
+    tp_pos = {tp: i for i, tp in enumerate(timepoints)}
+    from_idx = [tp_pos[a] for a, b in contrasts]
+    to_idx = [tp_pos[b] for a, b in contrasts]
+    return levels[:, to_idx, :] - levels[:, from_idx, :]
+
+def build_registry(samples):
+    """Builds the sample registry from a frame with sample_id and sample_group columns, in row order."""
+    registry = pd.DataFrame({
+        'sample_id': samples['sample_id'].astype(str).to_numpy(),
+        'sample_group': pd.Categorical(samples['sample_group'].astype(str)),
+    })
+    registry.index.name = 'sample'
+    return registry
+
+def _store_table(matrices, registry, mets):
+    index = registry.index
+    arrays = [
+        pa.array(index.to_numpy(dtype='int64')),
+        pa.array(registry['sample_id'].to_numpy()),
+        pa.DictionaryArray.from_pandas(registry['sample_group']),
+    ]
+    names = ['sample', 'sample_id', 'sample_group']
+    for kind, df in matrices.items():
+        df = df.loc[index, mets]
+        for met in mets:
+            arrays.append(pa.array(df[met].to_numpy(dtype='float64')))
+            names.append(column_name(kind, met))
+    return pa.Table.from_arrays(arrays, names=names)
+
+def write_store(path, matrices, name_to_id, registry, timepoints, contrasts, preprocessing=None, compression='lz4'):
+    """Writes a dict of kind -> DataFrame (indexed by registry sample, same columns) to a feather store."""
+    first = next(iter(matrices.values()))
+    mets = list(first.columns)
+
+    metadata = {
+        'version': STORE_VERSION,
+        'kinds': list(matrices.keys()),
+        'timepoints': list(timepoints),
+        'contrasts': [list(contrast) for contrast in contrasts],
+        'metabolites': mets,
+        'name_to_id': {name: name_to_id[name] for name in mets if name in name_to_id},
+        'preprocessing': preprocessing,
+    }
+    table = _store_table(matrices, registry, mets)
+    table = table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata)})
+    feather.write_feather(table, path, compression=compression)
+
+def append_store(path, matrices, registry, metadata, compression='lz4'):
+    """Appends the rows of new registry samples to an existing store and replaces its metadata.
+
+    matrices must hold every kind of the store with the store's metabolites.
+    """
+    table = feather.read_table(path)
+    new_table = _store_table({kind: matrices[kind] for kind in metadata['kinds']}, registry, metadata['metabolites'])
+    new_table = new_table.cast(table.schema.remove_metadata())
+    table = pa.concat_tables([table.replace_schema_metadata(None), new_table]).combine_chunks()
+    table = table.replace_schema_metadata({METADATA_KEY: json.dumps(metadata)})
+    feather.write_feather(table, path, compression=compression)
+
+def read_metadata(path):
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads(schema.metadata[METADATA_KEY])
+
+def read_registry(path):
+    """Reads the sample registry indexed by the integer sample."""
+    table = feather.read_table(path, columns=['sample', 'sample_id', 'sample_group'], memory_map=True)
+    return table.to_pandas().set_index('sample')
+
+def read_matrix(path, kind, gem_overlapped=True, by='id', metadata=None, samples=None):
+    """Reads one kind of matrix indexed by the integer sample.
+
+    With gem_overlapped=True only the gem-overlapped metabolites are read and
+    columns are labelled by standard identifier (by='id') or by name (by='name').
+    Otherwise all preprocessed metabolites are read and labelled by name.
+    samples optionally restricts the rows to the given registry samples.
+    """
+    if metadata is None:
+        metadata = read_metadata(path)
+    if(kind == 'change' and len(metadata['contrasts']) == 1):
+        kind = change_kind(metadata['contrasts'][0])
+    if kind not in metadata['kinds']:
+        raise ValueError(f"Unknown matrix kind {kind}; store has {metadata['kinds']}")
+
+    if gem_overlapped:
+        mets = list(metadata['name_to_id'].keys())
+    else:
+        mets = metadata['metabolites']
+        by = 'name'
+
+    columns = ['sample'] + [column_name(kind, met) for met in mets]
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    if samples is not None:
+        table = table.filter(pc.is_in(table['sample'], value_set=pa.array(samples, type=pa.int64())))
+    df = table.to_pandas().set_index('sample')
+    if by == 'id':
+        df.columns = [metadata['name_to_id'][met] for met in mets]
+    else:
+        df.columns = mets
+    return df.sort_index().sort_index(axis=1)
+
+def read_tensor(path, kinds, metadata=None, samples=None):
+    """Stacks the gem-overlapped matrices of kinds into a (sample x kind x metabolite id) array."""
+    if metadata is None:
+        metadata = read_metadata(path)
+    dfs = [read_matrix(path, kind, metadata=metadata, samples=samples) for kind in kinds]
+    tensor = np.stack([df.to_numpy() for df in dfs], axis=1)
+    return tensor, dfs[0].index, dfs[0].columns
+
+def frame_tensor(matrices, kinds, name_to_id):
+    """In-memory counterpart of read_tensor for a dict of kind -> DataFrame labelled by metabolite name."""
+    dfs = [matrices[kind][list(name_to_id)].rename(columns=name_to_id).sort_index().sort_index(axis=1) for kind in kinds]
+    tensor = np.stack([df.to_numpy() for df in dfs], axis=1)
+    return tensor, dfs[0].index, dfs[0].columns
+
+def read_level_tensor(path, metadata=None, samples=None):
+    if metadata is None:
+        metadata = read_metadata(path)
+    return read_tensor(path, metadata['timepoints'], metadata=metadata, samples=samples)
+
+def read_change_tensor(path, metadata=None, samples=None):
+    if metadata is None:
+        metadata = read_metadata(path)
+    kinds = [change_kind(contrast) for contrast in metadata['contrasts']]
+    return read_tensor(path, kinds, metadata=metadata, samples=samples)
+
+def contrast_frame(values, index, columns, contrasts):
+    """Flattens a (sample x contrast x column) array into a DataFrame.
+
+    With a single contrast the columns keep their names; otherwise every
+    column is suffixed with '@<contrast label>', contrast by contrast.
+    """
+    if(len(contrasts) == 1):
+        return pd.DataFrame(values[:, 0, :], index=index, columns=columns)
+    return pd.DataFrame(values.reshape(values.shape[0], -1), index=index, columns=contrast_columns(columns, contrasts))
+
+def contrast_columns(columns, contrasts):
+    """Column labels of contrast_frame for the given columns and contrasts."""
+    if(len(contrasts) == 1):
+        return list(columns)
+    return [col + '@' + contrast_label(contrast) for contrast in contrasts for col in columns]
+
+def pending_samples(path, out_path):
+    """Registry samples of the store missing from the rows of an existing feature .tsv file."""
+    done = pd.read_csv(out_path, sep='\t', index_col=0, usecols=[0]).index
+    return read_registry(path).index.difference(done).tolist()
+
+def append_tsv(df, path):
+    """Appends the rows of df to an existing .tsv file, in the column order of its header."""
+    columns = pd.read_csv(path, sep='\t', index_col=0, nrows=0).columns
+    df[columns].to_csv(path, sep='\t', mode='a', header=False)
@@ -1,30 +1,39 @@
 import argparse
+import functools
 import os
 import pathlib
 import sys
-import subprocess
-
-
-def execute_command(command, log_file):
-    """Executes a command, logs its output, and prints to stderr on failure."""
-    log_file.write(f"--- Running command: {command} ---\n")
-
-    process = subprocess.Popen(
-        command, shell=True, stdout=log_file, stderr=log_file, text=True
-    )
-    process.communicate()
-
-    if process.returncode != 0:
-        # On failure, also write to the main script's stderr
-        sys.stderr.write(f"--- Command failed: {command} ---\n")
-        sys.stderr.write(f"--- Return Code: {process.returncode} ---\n")
-        # The output is already in the log file, so we don't write it to stderr here.
-        # We could, however, read the last few lines of the log file and print them.
-        # For now, we'll just point the user to the log file.
-        sys.stderr.write(f"--- See log file for details: {log_file.name} ---\n")
-        sys.stderr.flush()
-
-    return process.returncode
+from classification import CV_BACKENDS, SEARCHES
+from evaluation import EVALUATIONS
+from feature_store import MATRIX_SUFFIX, baseline_path, store_files
+from learner_names import LEARNERS
+from logging_utils import LOG_LEVEL_ENV, LOG_LEVELS, log_to
+from planner import plan_pipeline, plan_report
+from profiling import (
+    CAPTURE_ENV,
+    CAPTURE_KINDS,
+    PROFILE_ENV,
+    profile_table,
+    profiled_task,
+    read_phases,
+    read_profile,
+    write_profile,
+)
+from resources import classification_memory, graph_memory
+from task_graph import add_task, run_tasks
+from work_queue import wait_queue, write_queue
+from worker_pool import task_executor
+from workflow import run_workflow
+
+# exit status of preprocess-metabolome.py --append when a full rebuild is required
+REBUILD_EXIT_CODE = 3
+
+# reaction sets of every kind of feature
+FEATURE_SETS = {
+    "change": [1, 2, 3, 4, 7, 8, 9],
+    "ratio": [2, 4, 7, 8, 9],
+    "prob": list(range(1, 10)),
+}
 
 
 def parse_args():
@@ -36,16 +45,39 @@ def parse_args():
         "--base_path",
         type=str,
         help="path to baseline metabolomics in tsv format",
-        required=True,
+        required=False,
         default=None,
     )
     parser.add_argument(
         "--end_path",
         type=str,
         help="path to end metabolomics in tsv format",
-        required=True,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--timepoint_paths",
+        type=str,
+        nargs="+",
+        help="paths to metabolomics of every timepoint in tsv format, in visit order (instead of base_path and end_path)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--timepoint_names",
+        type=str,
+        nargs="+",
+        help="names of the timepoints in timepoint_paths",
+        required=False,
         default=None,
     )
+    parser.add_argument(
+        "--contrast",
+        type=str,
+        help="compute features for every consecutive pair of timepoints or against the first one",
+        choices=["consecutive", "baseline"],
+        default="consecutive",
+    )
 
     parser.add_argument(
         "--case", type=str, help="name of the case group", required=True, default=None
@@ -118,6 +150,209 @@ def parse_args():
         default=None,
     )
 
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="append the given samples to the previous run in out_dir, reusing its fitted preprocessing; "
+        + "Change and Ratio features are only computed for the new samples",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="update the reaction sets of the previous run in out_dir for the metabolites added or removed, "
+        + "and reuse the Change and Ratio columns of the reactions left unchanged",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of tasks run in parallel (default: number of cpus)",
+        required=False,
+        default=os.cpu_count(),
+    )
+
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        help="memory in MB the parallel tasks may use together, the largest tasks starting first "
+        + "(default: 90%% of the memory)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--cpu_budget",
+        type=int,
+        help="cpus the parallel tasks may use together (default: workers)",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--classification_jobs",
+        type=int,
+        help="number of cores the LOO folds of every classification are fitted on; the classification task "
+        + "counts as that many cpus against --cpu_budget (default: 1)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--classification_workers",
+        type=int,
+        help="number of processes classifying the feature matrices, each fitting on --classification_jobs "
+        + "cores; the classification task counts as workers x jobs cpus (default: 1)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--classification_backend",
+        type=str,
+        help="joblib backend of the LOO folds with --classification_jobs > 1 (default: loky)",
+        choices=CV_BACKENDS,
+        required=False,
+        default="loky",
+    )
+    parser.add_argument(
+        "--evaluation",
+        type=str,
+        help="estimator of the classification performance: LeaveOneOut, repeated stratified k-fold or "
+        + "out-of-bag (default: auto, chosen by the number of samples and recorded in the performance json)",
+        choices=EVALUATIONS,
+        required=False,
+        default="auto",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        help="parameter search of the classifications: every point of the small grid evaluated in full, or "
+        + "successive halving over max_features, max_depth, min_samples_leaf and class_weight by OOB score, "
+        + "growing the surviving forests, with only the finalists evaluated in full (default: grid)",
+        choices=SEARCHES,
+        required=False,
+        default="grid",
+    )
+    parser.add_argument(
+        "--learners",
+        type=str,
+        nargs="+",
+        help="learners every feature matrix is classified with: the random forest, L2-regularized logistic "
+        + "regression, ridge classification (closed-form LOO) and histogram gradient boosting; the summary "
+        + "shows the first one, and with several all of them side by side (default: forest)",
+        choices=LEARNERS,
+        required=False,
+        default=["forest"],
+    )
+    parser.add_argument(
+        "--screen",
+        action="store_true",
+        help="drop the non-finite, constant and perfectly correlated (duplicate) columns of every feature "
+        + "matrix before the classification; the columns removed by each step are recorded in the performance json",
+    )
+    parser.add_argument(
+        "--univariate_k",
+        type=int,
+        help="keep the k columns of every feature matrix with the best ANOVA F score, selected inside every "
+        + "evaluation fold (default: every column)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--no_plots",
+        action="store_true",
+        help="only write the numeric outputs of the classifications and summaries, without the figures; "
+        + "report.py --in_dir <out_dir> draws them later",
+    )
+
+    parser.add_argument(
+        "--pool",
+        action="store_true",
+        help="run the tasks in warm worker processes that import the scientific libraries once, "
+        + "instead of a new interpreter per task",
+    )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        help="path of the socket of a running worker daemon (worker_pool.py serve) to run the tasks on",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        help="write the tasks to a work queue in this directory on a shared filesystem and wait for "
+        + "workers on any node (work_queue.py work --queue_dir <dir>) to execute them",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--log_level",
+        type=str,
+        help="level of the logs of the stages (default: INFO); DEBUG also logs the per-item diagnostics "
+        + "of the hot loops (metabolite mappings, reaction rows, unmapped nodes)",
+        choices=LOG_LEVELS,
+        required=False,
+        default="INFO",
+    )
+    parser.add_argument(
+        "--profile_table",
+        action="store_true",
+        help="write a table of the wall time, CPU time, peak RSS and input and output sizes of every task "
+        + "and phase at the end of the log (always written to profile/profile.json under out_dir)",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        help="also capture a cProfile or tracemalloc profile of every task, written to profile/ under out_dir",
+        choices=CAPTURE_KINDS,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--capture_tasks",
+        type=str,
+        nargs="+",
+        help="names of the tasks captured with --capture (default: all tasks)",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="rerun every task instead of reusing the outputs of tasks whose inputs, parameters and code are unchanged",
+    )
+
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="do not run anything: preprocess in memory and report the samples, metabolites, reactions, "
+        + "network sizes, RWR solves, forest fits, memory and expected runtime of the run "
+        + "(also written to plan.json under out_dir)",
+    )
+    parser.add_argument(
+        "--plan_history",
+        type=str,
+        nargs="+",
+        help="output directories of previous runs whose profiles estimate the runtime with --plan "
+        + "(default: out_dir)",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--in_process",
+        action="store_true",
+        help="run every stage in this process, passing intermediate results in memory instead of files "
+        + "(no parallel tasks, caching, --append or --incremental)",
+    )
+    parser.add_argument(
+        "--persist",
+        action="store_true",
+        help="with --in_process, also write the preprocessed metabolome, reaction sets and features to out_dir",
+    )
+
     parser.add_argument(
         "--script_dir",
         type=str,
@@ -134,71 +369,86 @@ def parse_args():
     )
 
     args = parser.parse_args()
+    if args.timepoint_paths is None and (args.base_path is None or args.end_path is None):
+        parser.error("either --base_path and --end_path or --timepoint_paths is required")
+    if args.in_process and (args.append or args.incremental):
+        parser.error("--in_process cannot be combined with --append or --incremental")
+    if args.in_process and (args.pool or args.daemon):
+        parser.error("--in_process cannot be combined with --pool or --daemon")
+    if args.in_process and args.queue_dir:
+        parser.error("--in_process cannot be combined with --queue_dir")
+    if args.persist and not args.in_process:
+        parser.error("--persist requires --in_process")
     return args
 
 
-def run_pipeline(args, log_file):
-    """
-    Executes the full pipeline, returning True on success and False on failure.
-    """
+def add_preprocess_task(tasks, args, prefix=""):
+    """Adds the metabolome preprocessing of the study in args, named with prefix."""
+    task_log_dir = os.path.join(args.out_dir, "logs")
+
     # preprocess metabolome
     met_out_dir = os.path.join(args.out_dir, "preprocess", "metabolome")
-    met_log_path = os.path.join(met_out_dir, "preprocess-metabolome.log")
+    met_log_path = os.path.join(
+        met_out_dir,
+        "preprocess-metabolome.append.log" if args.append else "preprocess-metabolome.log",
+    )
+    if args.timepoint_paths is None:
+        timepoint_options = ["--base_path", args.base_path, "--end_path", args.end_path]
+    else:
+        timepoint_options = ["--timepoint_paths"] + args.timepoint_paths
+        if args.timepoint_names is not None:
+            timepoint_options += ["--timepoint_names"] + args.timepoint_names
+        timepoint_options += ["--contrast", args.contrast]
+
+    append_option = ["--append"] if args.append else []
     command = (
-        "python3 -W ignore "
-        + os.path.join(args.script_dir, "preprocess-metabolome.py")
-        + " --base_path "
-        + args.base_path
-        + " --end_path "
-        + args.end_path
-        + " --missing_pct "
-        + str(args.missing_pct)
-        + " --user_met_id_path "
-        + args.user_met_id_path
-        + " --user_met_name_col "
-        + args.user_met_name_col
-        + " --user_met_id_col "
-        + args.user_met_id_col
-        + " --gem_path "
-        + args.gem_path
-        + " --gem_met_id_path "
-        + args.gem_met_id_path
-        + " --gem_met_id_col "
-        + args.gem_met_id_col
-        + " --log_path "
-        + met_log_path
-        + " --out_dir "
-        + met_out_dir
-    )
-
-    if execute_command(command, log_file) != 0:
-        return False
-    log_file.write("--- Preprocessing metabolome complete. ---\n")
+        ["python3", "-W", "ignore", os.path.join(args.script_dir, "preprocess-metabolome.py")]
+        + timepoint_options
+        + ["--missing_pct", str(args.missing_pct)]
+        + ["--user_met_id_path", args.user_met_id_path]
+        + ["--user_met_name_col", args.user_met_name_col]
+        + ["--user_met_id_col", args.user_met_id_col]
+        + ["--gem_path", args.gem_path]
+        + ["--gem_met_id_path", args.gem_met_id_path]
+        + ["--gem_met_id_col", args.gem_met_id_col]
+        + ["--log_path", met_log_path]
+        + ["--out_dir", met_out_dir]
+        + append_option
+    )
 
-    # preprocessing human-gem
-    valid_met_path = os.path.join(met_out_dir, "gem_overlapped_metabolites.tsv")
-    gem_out_dir = os.path.join(args.out_dir, "preprocess", "gem")
-    gem_log_path = os.path.join(gem_out_dir, "preprocess-gem.log")
+    add_task(
+        tasks,
+        prefix + "preprocess-metabolome",
+        command,
+        os.path.join(task_log_dir, "preprocess-metabolome.log"),
+        inputs=(
+            [args.base_path, args.end_path]
+            if args.timepoint_paths is None
+            else args.timepoint_paths
+        )
+        + [args.user_met_id_path, args.gem_path, args.gem_met_id_path],
+        outputs=[met_out_dir],
+        code=[os.path.join(args.script_dir, "preprocess-metabolome.py")],
+    )
 
-    command = (
-        "python3 -W ignore "
-        + os.path.join(args.script_dir, "preprocess-gem.py")
-        + " --gem_path "
-        + args.gem_path
-        + " --valid_met_path "
-        + valid_met_path
-        + " --log_path "
-        + gem_log_path
-        + " --out_dir "
-        + gem_out_dir
-    )
-
-    if execute_command(command, log_file) != 0:
-        return False
-    log_file.write("--- Preprocessing gem complete. ---\n")
+
+def add_feature_tasks(tasks, args, feature_deps, prefix=""):
+    """
+    Adds the features of every reaction set, the classification and the summary
+    of the study in args, once the tasks in feature_deps built its reaction sets.
+    """
+    task_log_dir = os.path.join(args.out_dir, "logs")
 
     # compute features
-    met_change_path = os.path.join(met_out_dir, "gem_overlapped_change_id.tsv")
+    met_out_dir = os.path.join(args.out_dir, "preprocess", "metabolome")
+    valid_met_path = os.path.join(met_out_dir, "gem_overlapped_metabolites.tsv")
+    gem_out_dir = os.path.join(args.out_dir, "preprocess", "gem")
+    append_option = ["--append"] if args.append else []
+    met_store_path = os.path.join(met_out_dir, "metabolome.feather")
+    changed_reactions_path = os.path.join(gem_out_dir, "changed-reactions.tsv")
+    feature_option = append_option
+    if args.incremental and not args.append:
+        feature_option = ["--changed_reactions_path", changed_reactions_path]
     feature_out_dir = os.path.join(args.out_dir, "feature")
 
     react_set_paths = {}
@@ -213,134 +463,392 @@ def run_pipeline(args, log_file):
             feature_out_dir, f"reaction-set-{react_set_no}"
         )
 
+    # feature tasks and matrices read by the classification
+    feature_tasks = []
+    feature_paths = []
+
     # change
-    for react_set_no in [1, 2, 3, 4, 7, 8, 9]:
+    for react_set_no in FEATURE_SETS["change"]:
         change_out_dir = os.path.join(react_set_out_dirs[react_set_no], "change")
         change_log_path = os.path.join(change_out_dir, "compute-change-feature.log")
 
-        command = (
-            "python3 -W ignore "
-            + os.path.join(args.script_dir, "compute-change-feature.py")
-            + " --react_set_path "
-            + react_set_paths[react_set_no]
-            + " --met_change_path "
-            + met_change_path
-            + " --valid_met_path "
-            + valid_met_path
-            + " --log_path "
-            + change_log_path
-            + " --out_dir "
-            + change_out_dir
+        command = [
+            "python3",
+            "-W",
+            "ignore",
+            os.path.join(args.script_dir, "compute-change-feature.py"),
+            "--react_set_path",
+            react_set_paths[react_set_no],
+            "--met_store_path",
+            met_store_path,
+            "--valid_met_path",
+            valid_met_path,
+            "--log_path",
+            change_log_path,
+            "--out_dir",
+            change_out_dir,
+        ] + feature_option
+        add_task(
+            tasks,
+            f"{prefix}change-{react_set_no}",
+            command,
+            os.path.join(task_log_dir, f"change-{react_set_no}.log"),
+            deps=feature_deps,
+            inputs=[react_set_paths[react_set_no], met_store_path, valid_met_path],
+            outputs=[change_out_dir],
+            code=[os.path.join(args.script_dir, "compute-change-feature.py")],
         )
-        if execute_command(command, log_file) != 0:
-            return False
+        feature_tasks.append(f"{prefix}change-{react_set_no}")
+        feature_paths += [
+            os.path.join(change_out_dir, "reaction.change" + MATRIX_SUFFIX),
+            os.path.join(change_out_dir, "metabolite.reaction.change.json"),
+        ]
 
     # ratio
-    for react_set_no in [2, 4, 7, 8, 9]:
+    for react_set_no in FEATURE_SETS["ratio"]:
         ratio_out_dir = os.path.join(react_set_out_dirs[react_set_no], "ratio")
         ratio_log_path = os.path.join(ratio_out_dir, "compute-ratio-feature.log")
 
-        command = (
-            "python3 -W ignore "
-            + os.path.join(args.script_dir, "compute-ratio-feature.py")
-            + " --react_set_path "
-            + react_set_paths[react_set_no]
-            + " --met_change_path "
-            + met_change_path
-            + " --valid_met_path "
-            + valid_met_path
-            + " --log_path "
-            + ratio_log_path
-            + " --out_dir "
-            + ratio_out_dir
+        command = [
+            "python3",
+            "-W",
+            "ignore",
+            os.path.join(args.script_dir, "compute-ratio-feature.py"),
+            "--react_set_path",
+            react_set_paths[react_set_no],
+            "--met_store_path",
+            met_store_path,
+            "--valid_met_path",
+            valid_met_path,
+            "--log_path",
+            ratio_log_path,
+            "--out_dir",
+            ratio_out_dir,
+        ] + feature_option
+        add_task(
+            tasks,
+            f"{prefix}ratio-{react_set_no}",
+            command,
+            os.path.join(task_log_dir, f"ratio-{react_set_no}.log"),
+            deps=feature_deps,
+            inputs=[react_set_paths[react_set_no], met_store_path, valid_met_path],
+            outputs=[ratio_out_dir],
+            code=[os.path.join(args.script_dir, "compute-ratio-feature.py")],
         )
-        if execute_command(command, log_file) != 0:
-            return False
-
-    # prob
-    for react_set_no in range(1, 10):
+        feature_tasks.append(f"{prefix}ratio-{react_set_no}")
+        feature_paths += [
+            os.path.join(ratio_out_dir, "reaction.ratio" + MATRIX_SUFFIX),
+            os.path.join(ratio_out_dir, "metabolite.reaction.ratio.json"),
+        ]
+
+    # prob (the network spans all samples, so it is always recomputed)
+    for react_set_no in FEATURE_SETS["prob"]:
         prob_out_dir = os.path.join(react_set_out_dirs[react_set_no], "prob")
         prob_log_path = os.path.join(prob_out_dir, "compute-prob-feature.log")
-        command = (
-            "python3 -W ignore "
-            + os.path.join(args.script_dir, "compute-prob-feature.py")
-            + " --base_path "
-            + os.path.join(met_out_dir, "gem_overlapped_base_id.tsv")
-            + " --end_path "
-            + os.path.join(met_out_dir, "gem_overlapped_end_id.tsv")
-            + " --met_change_path "
-            + met_change_path
-            + " --react_set_path "
-            + react_set_paths[react_set_no]
-            + " --valid_met_path "
-            + valid_met_path
-            + " --alpha "
-            + str(args.alpha)
-            + " --case "
-            + args.case
-            + " --control "
-            + args.control
-            + " --log_path "
-            + prob_log_path
-            + " --out_dir "
-            + prob_out_dir
+        command = [
+            "python3",
+            "-W",
+            "ignore",
+            os.path.join(args.script_dir, "compute-prob-feature.py"),
+            "--met_store_path",
+            met_store_path,
+            "--react_set_path",
+            react_set_paths[react_set_no],
+            "--valid_met_path",
+            valid_met_path,
+            "--alpha",
+            str(args.alpha),
+            "--case",
+            args.case,
+            "--control",
+            args.control,
+            "--log_path",
+            prob_log_path,
+            "--out_dir",
+            prob_out_dir,
+        ]
+        add_task(
+            tasks,
+            f"{prefix}prob-{react_set_no}",
+            command,
+            os.path.join(task_log_dir, f"prob-{react_set_no}.log"),
+            deps=feature_deps,
+            inputs=[react_set_paths[react_set_no], met_store_path, valid_met_path],
+            outputs=[prob_out_dir],
+            code=[os.path.join(args.script_dir, "compute-prob-feature.py")],
+            memory=functools.partial(
+                graph_memory, react_set_paths[react_set_no], met_store_path
+            ),
         )
-        if execute_command(command, log_file) != 0:
-            return False
+        feature_tasks.append(f"{prefix}prob-{react_set_no}")
+        feature_paths += [
+            os.path.join(prob_out_dir, "reaction.prob" + MATRIX_SUFFIX),
+            os.path.join(prob_out_dir, "metabolite.reaction.prob.json"),
+        ]
 
     # classification
     classification_out_dir = os.path.join(args.out_dir, "classification")
     classification_log_path = os.path.join(classification_out_dir, "classification.log")
-    command = (
-        "python3 -W ignore "
-        + os.path.join(args.script_dir, "run_classification.py")
-        + " --met_path "
-        + os.path.join(met_out_dir, "metabolite.tsv")
-        + " --feature_dir "
-        + feature_out_dir
-        + " --case "
-        + args.case
-        + " --control "
-        + args.control
-        + " --script_dir "
-        + args.script_dir
-        + " --out_dir "
-        + classification_out_dir
-        + " --log_path "
-        + classification_log_path
-    )
-
-    if execute_command(command, log_file) != 0:
-        return False
+    command = [
+        "python3",
+        "-W",
+        "ignore",
+        os.path.join(args.script_dir, "run_classification.py"),
+        "--met_path",
+        baseline_path(met_store_path),
+        "--met_store_path",
+        met_store_path,
+        "--feature_dir",
+        feature_out_dir,
+        "--case",
+        args.case,
+        "--control",
+        args.control,
+        "--script_dir",
+        args.script_dir,
+        "--out_dir",
+        classification_out_dir,
+        "--log_path",
+        classification_log_path,
+        "--n_jobs",
+        str(args.classification_jobs),
+        "--backend",
+        args.classification_backend,
+        "--evaluation",
+        args.evaluation,
+        "--search",
+        args.search,
+        "--workers",
+        str(args.classification_workers),
+    ]
+    if args.learners != ["forest"]:
+        command += ["--learners"] + args.learners
+    if args.screen:
+        command.append("--screen")
+    if args.univariate_k:
+        command += ["--univariate_k", str(args.univariate_k)]
+    if args.no_plots:
+        command.append("--no_plots")
+    # the arrays and indexes of the matrices, and the metabolite block they reference
+    matrix_files = [
+        path
+        for matrix in [baseline_path(met_store_path)] + feature_paths
+        for path in store_files(matrix)
+    ]
+
+    add_task(
+        tasks,
+        prefix + "classification",
+        command,
+        os.path.join(task_log_dir, "classification.log"),
+        deps=feature_tasks,
+        inputs=[met_store_path] + matrix_files,
+        outputs=[classification_out_dir],
+        code=[
+            os.path.join(args.script_dir, "run_classification.py"),
+            os.path.join(args.script_dir, "classification.py"),
+            os.path.join(args.script_dir, "learners.py"),
+            os.path.join(args.script_dir, "learner_names.py"),
+            os.path.join(args.script_dir, "report.py"),
+        ],
+        memory=functools.partial(
+            classification_memory,
+            feature_paths,
+            args.classification_jobs,
+            args.evaluation,
+            args.search,
+            args.classification_workers,
+        ),
+        cpus=args.classification_jobs * args.classification_workers,
+    )
 
     # summary
     summary_out_dir = os.path.join(args.out_dir, "summary")
     summary_log_path = os.path.join(summary_out_dir, "summary.log")
-    command = (
-        "python3 -W ignore "
-        + os.path.join(args.script_dir, "summarize_performance.py")
-        + " --in_dir "
-        + classification_out_dir
-        + " --case "
-        + args.case
-        + " --control "
-        + args.control
-        + " --out_dir "
-        + summary_out_dir
-        + " --log_path "
-        + summary_log_path
+    command = [
+        "python3",
+        "-W",
+        "ignore",
+        os.path.join(args.script_dir, "summarize_performance.py"),
+        "--in_dir",
+        classification_out_dir,
+        "--case",
+        args.case,
+        "--control",
+        args.control,
+        "--out_dir",
+        summary_out_dir,
+        "--log_path",
+        summary_log_path,
+    ]
+    if args.learners != ["forest"]:
+        command += ["--learners"] + args.learners
+    if args.no_plots:
+        command.append("--no_plots")
+    add_task(
+        tasks,
+        prefix + "summary",
+        command,
+        os.path.join(task_log_dir, "summary.log"),
+        deps=[prefix + "classification"],
+        inputs=[classification_out_dir],
+        outputs=[summary_out_dir],
+        code=[
+            os.path.join(args.script_dir, "summarize_performance.py"),
+            os.path.join(args.script_dir, "learner_names.py"),
+            os.path.join(args.script_dir, "report.py"),
+        ],
     )
-    if execute_command(command, log_file) != 0:
-        return False
 
-    return True
+
+def build_tasks(args):
+    """
+    Builds the task graph of the pipeline:
+    preprocessing -> features of every reaction set -> classification -> summary.
+    """
+    tasks = {}
+    task_log_dir = os.path.join(args.out_dir, "logs")
+
+    add_preprocess_task(tasks, args)
+
+    # preprocessing human-gem
+    met_out_dir = os.path.join(args.out_dir, "preprocess", "metabolome")
+    valid_met_path = os.path.join(met_out_dir, "gem_overlapped_metabolites.tsv")
+    gem_out_dir = os.path.join(args.out_dir, "preprocess", "gem")
+    gem_log_path = os.path.join(gem_out_dir, "preprocess-gem.log")
+
+    command = [
+        "python3",
+        "-W",
+        "ignore",
+        os.path.join(args.script_dir, "preprocess-gem.py"),
+        "--gem_path",
+        args.gem_path,
+        "--valid_met_path",
+        valid_met_path,
+        "--log_path",
+        gem_log_path,
+        "--out_dir",
+        gem_out_dir,
+    ] + (["--incremental"] if args.incremental else [])
+
+    # the gem-overlapped metabolites are unchanged by appended samples
+    if args.append:
+        feature_deps = ["preprocess-metabolome"]
+    else:
+        add_task(
+            tasks,
+            "preprocess-gem",
+            command,
+            os.path.join(task_log_dir, "preprocess-gem.log"),
+            deps=["preprocess-metabolome"],
+            inputs=[args.gem_path, valid_met_path],
+            outputs=[gem_out_dir],
+            code=[os.path.join(args.script_dir, "preprocess-gem.py")],
+        )
+        feature_deps = ["preprocess-gem"]
+
+    add_feature_tasks(tasks, args, feature_deps)
+    return tasks
+
+
+def run_pipeline(args, log_file):
+    """
+    Executes the full pipeline, returning True on success and False on failure.
+    """
+    tasks = build_tasks(args)
+    cache_dir = None if args.no_cache else os.path.join(args.out_dir, "cache")
+    profile_dir = os.path.join(args.out_dir, "profile")
+    if args.queue_dir is not None:
+        write_queue(
+            tasks,
+            args.queue_dir,
+            cache_dir=cache_dir,
+            profile_dir=profile_dir,
+            capture=args.capture,
+            capture_tasks=args.capture_tasks,
+            plots=not args.no_plots,
+        )
+        log_file.write(f"--- Wrote {len(tasks)} tasks to the work queue {args.queue_dir} ---\n")
+        log_file.flush()
+        returncodes = wait_queue(args.queue_dir, log_file)
+    else:
+        with task_executor(
+            args.workers, pool=args.pool, daemon=args.daemon, plots=not args.no_plots
+        ) as execute:
+            returncodes = run_tasks(
+                tasks,
+                args.workers,
+                log_file,
+                cache_dir=cache_dir,
+                execute=execute,
+                profile_dir=profile_dir,
+                capture=args.capture,
+                capture_tasks=args.capture_tasks,
+                memory_budget=args.memory_budget,
+                cpu_budget=args.cpu_budget,
+            )
+    if args.profile_table:
+        log_file.write(profile_table(read_profile(profile_dir)) + "\n")
+
+    if returncodes["preprocess-metabolome"] == REBUILD_EXIT_CODE and args.append:
+        log_file.write(
+            "--- New samples change the preprocessed metabolites; rerun without --append. ---\n"
+        )
+    failed = [name for name, returncode in returncodes.items() if returncode != 0]
+    log_file.write(f"--- {len(tasks) - len(failed)} of {len(tasks)} tasks complete. ---\n")
+    if failed:
+        log_file.write("--- Failed or skipped tasks: " + ", ".join(failed) + " ---\n")
+    return not failed
+
+
+def run_in_process(args, log_file):
+    """
+    Executes the whole workflow in this process, returning True on success and False on failure.
+    """
+    profile_dir = os.path.join(args.out_dir, "profile")
+    pathlib.Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    phase_path = os.path.join(profile_dir, "workflow.jsonl")
+    if os.path.exists(phase_path):
+        os.remove(phase_path)
+    env = {PROFILE_ENV: phase_path}
+    if args.capture is not None:
+        env[CAPTURE_ENV] = args.capture
+
+    success = True
+    with profiled_task(env) as usage:
+        try:
+            with log_to(log_file):
+                run_workflow(args, persist=args.persist)
+        except Exception:
+            success = False
+
+    record = {"returncode": 0 if success else 1, "cached": False, **usage}
+    record["phases"] = read_phases(phase_path)
+    write_profile({"workers": 1, "wall_s": usage["wall_s"], "tasks": {"workflow": record}}, profile_dir)
+    if args.profile_table:
+        log_file.write(profile_table(read_profile(profile_dir)) + "\n")
+    return success
 
 
 def main(args):
     pathlib.Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    os.environ[LOG_LEVEL_ENV] = args.log_level
+
+    if args.plan:
+        with open(args.log_path, "w") as log_file:
+            with log_to(log_file):
+                plan = plan_pipeline(args, FEATURE_SETS, args.plan_history or [args.out_dir])
+            report = plan_report(plan)
+            log_file.write(report + "\n")
+        print(report)
+        return
 
     with open(args.log_path, "w") as log_file:
-        success = run_pipeline(args, log_file)
+        if args.in_process:
+            success = run_in_process(args, log_file)
+        else:
+            success = run_pipeline(args, log_file)
 
     if not success:
         sys.exit(1)
@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import pandas as pd
+from classification import forest_fits, forests_held
+from evaluation import evaluation_mode
+from features import REPORTED_REACTIONS
+from preprocessing import preprocess_metabolome
+from profiling import read_profile
+from reaction_sets import build_reaction_sets, measure_reactions, parse_reactions
+from resources import BASE_MB, forest_memory, network_memory, network_size
+from workflow import timepoint_inputs
+
+# Dry run of the pipeline (pipeline.py --plan): preprocesses the metabolome
+# and builds the reaction sets in memory, without writing anything, and
+# reports the work the run would do (samples, metabolites, reactions, network
+# sizes, RWR solves, forest fits), the memory estimates of its tasks and, from
+# the profiles of previous runs, its expected runtime.
+
+PLAN_NAME = "plan.json"
+
+
+def plan_workload(args, feature_sets):
+    """
+    The workload of the pipeline run of args, as a dict; feature_sets maps
+    every kind of feature to the reaction sets it is computed for.
+    """
+    timepoint_paths, timepoints = timepoint_inputs(args)
+    result = preprocess_metabolome(
+        timepoint_paths,
+        timepoints,
+        args.contrast,
+        args.missing_pct,
+        args.user_met_id_path,
+        args.user_met_name_col,
+        args.user_met_id_col,
+        args.gem_path,
+        args.gem_met_id_path,
+        args.gem_met_id_col,
+    )
+    valid_mets = set(result["valid_met_df"]["MET_ID"])
+    react_sets = build_reaction_sets(measure_reactions(parse_reactions(args.gem_path), valid_mets))
+
+    registry = result["registry"]
+    n_samples = len(registry)
+    n_study = int(registry["sample_group"].isin([args.case, args.control]).sum())
+    n_contrasts = len(result["contrasts"])
+    n_mets = len(result["gem_overlapped_name_to_id"])
+    metabolite_cols = n_mets * n_contrasts
+
+    # classified matrices: rows and columns, the metabolite baseline first
+    matrices = {"metabolite": (n_samples, metabolite_cols)}
+    sets = []
+    for react_set_no, (react_set_df, basic_df) in react_sets.items():
+        kinds = [kind for kind, set_nos in feature_sets.items() if react_set_no in set_nos]
+        n_nodes, n_edges = network_size(n_samples, n_mets, react_set_df)
+        react_cols = min(REPORTED_REACTIONS, len(react_set_df)) * n_contrasts
+        for kind in kinds:
+            # prob features only cover the case and control samples
+            n_rows = n_study if kind == "prob" else n_samples
+            matrices[f"reaction/reaction-set-{react_set_no}/{kind}"] = (n_rows, react_cols)
+            matrices[f"metabolite+reaction/reaction-set-{react_set_no}/{kind}"] = (
+                n_rows,
+                metabolite_cols + react_cols,
+            )
+        prob = "prob" in kinds
+        sets.append(
+            {
+                "reaction_set": react_set_no,
+                "features": kinds,
+                "reactions": len(react_set_df),
+                "reactions_before_split": None if basic_df is None else len(basic_df),
+                "nodes": n_nodes if prob else None,
+                "edges": n_edges if prob else None,
+                "rwr_solves": n_study * n_contrasts if prob else 0,
+                "prob_memory_mb": round(network_memory(n_samples, n_nodes, n_edges, n_contrasts), 1)
+                if prob
+                else None,
+            }
+        )
+
+    # run_classification.py chooses the evaluation once, by the metabolite matrix
+    evaluation = evaluation_mode(n_samples, args.evaluation, args.search)
+    fits = {name: forest_fits(n_rows, evaluation, args.search) for name, (n_rows, _) in matrices.items()}
+    classification_memory = args.classification_workers * (
+        BASE_MB * args.classification_jobs
+        + max(
+            forest_memory(n_rows, n_cols, forests_held(n_rows, evaluation, args.search))
+            for n_rows, n_cols in matrices.values()
+        )
+    )
+    groups = registry["sample_group"].value_counts().to_dict()
+    return {
+        "samples": n_samples,
+        "samples_per_group": {group: int(count) for group, count in groups.items()},
+        "classified_samples": n_study,
+        "timepoints": result["timepoints"],
+        "contrasts": [list(contrast) for contrast in result["contrasts"]],
+        "metabolites": len(result["preprocessing"]["missing_counts"][timepoints[0]]),
+        "metabolites_after_missingness": len(result["matrices"][timepoints[0]].columns),
+        "metabolites_with_identifier": len(result["name_to_id"]),
+        "gem_overlapped_metabolites": n_mets,
+        "reaction_sets": sets,
+        "rwr_solves": sum(react_set["rwr_solves"] for react_set in sets),
+        "classified_matrices": len(matrices),
+        "matrix_shapes": {name: list(shape) for name, shape in matrices.items()},
+        "evaluation": evaluation,
+        "search": args.search,
+        "forest_fits": sum(fits.values()),
+        "forest_fits_per_matrix": fits,
+        "memory_mb": {
+            "prob": max(react_set["prob_memory_mb"] or 0 for react_set in sets),
+            "classification": round(classification_memory, 1),
+        },
+    }
+
+
+def task_kind(name):
+    """Kind of a task of a profile: change, ratio, prob, classification, ..."""
+    return re.sub(r"-\d+$", "", name.split("/")[-1])
+
+
+def runtime_rates(profiles):
+    """
+    Runtime model fitted on previous profiles: seconds per RWR edge and solve,
+    seconds per forest fit and sample, and the mean wall time of every task kind
+    without those phases. None without profiles.
+    """
+    rwr_s = rwr_work = fit_s = fit_work = 0
+    other_s = {}
+    for profile in profiles:
+        for name, task in profile["tasks"].items():
+            if task.get("cached") or task.get("returncode") != 0 or "wall_s" not in task:
+                continue
+            wall = task["wall_s"]
+            for record in task.get("phases", []):
+                if record["phase"] == "RWR" and "solves" in record:
+                    rwr_s += record["wall_s"]
+                    rwr_work += record["edges"] * record["solves"]
+                    wall -= record["wall_s"]
+                elif record["phase"] in ["forest fitting", "LOO fitting", "halving search"] and "shape" in record:
+                    n_rows = record["shape"][0]
+                    # core-seconds: the folds may have been fitted on several cores
+                    fit_s += record["wall_s"] * record.get("n_jobs", 1)
+                    fit_work += record.get("fits", forest_fits(n_rows)) * n_rows
+                    wall -= record["wall_s"]
+            other_s.setdefault(task_kind(name), []).append(max(wall, 0))
+    if not other_s:
+        return None
+    return {
+        "rwr_s_per_edge_solve": rwr_s / rwr_work if rwr_work else None,
+        "fit_s_per_fit_sample": fit_s / fit_work if fit_work else None,
+        "task_s": {kind: sum(walls) / len(walls) for kind, walls in other_s.items()},
+    }
+
+
+def plan_runtime(plan, rates, workers, classification_jobs=1, classification_workers=1):
+    """
+    Runtime of every stage in seconds, the serial total and the expected wall
+    time with workers, the feature matrices being classified by
+    classification_workers processes fitting on classification_jobs cores each.
+    """
+    task_s = rates["task_s"]
+    stages = {
+        "preprocess-metabolome": task_s.get("preprocess-metabolome", 0),
+        "preprocess-gem": task_s.get("preprocess-gem", 0),
+    }
+    features = []
+    for react_set in plan["reaction_sets"]:
+        for kind in react_set["features"]:
+            seconds = task_s.get(kind, 0)
+            if kind == "prob" and rates["rwr_s_per_edge_solve"] is not None:
+                seconds += rates["rwr_s_per_edge_solve"] * react_set["edges"] * react_set["rwr_solves"]
+            features.append(seconds)
+    stages["features"] = sum(features)
+    classification = task_s.get("classification", 0)
+    if rates["fit_s_per_fit_sample"] is not None:
+        classification += rates["fit_s_per_fit_sample"] / (classification_jobs * classification_workers) * sum(
+            plan["forest_fits_per_matrix"][name] * n_rows
+            for name, (n_rows, _) in plan["matrix_shapes"].items()
+        )
+    stages["classification"] = classification
+    stages["summary"] = task_s.get("summary", 0)
+    serial = sum(stages.values())
+    # the stages run one after the other, only the features run in parallel
+    critical = serial - stages["features"] + max(stages["features"] / workers, max(features, default=0))
+    return {
+        "stages_s": {stage: round(seconds, 1) for stage, seconds in stages.items()},
+        "serial_s": round(serial, 1),
+        "wall_s": round(critical, 1),
+    }
+
+
+def read_history(history_dirs):
+    """Profiles of the previous runs whose output directories are given."""
+    profiles = []
+    for history_dir in history_dirs:
+        profile_dir = os.path.join(history_dir, "profile")
+        if os.path.exists(os.path.join(profile_dir, "profile.json")):
+            profiles.append(read_profile(profile_dir))
+    return profiles
+
+
+def plan_report(plan):
+    """Human-readable report of a plan."""
+    lines = []
+    groups = ", ".join(f"{group} {count}" for group, count in plan["samples_per_group"].items())
+    lines.append(
+        f"Samples: {plan['samples']} ({groups}), {plan['classified_samples']} case and control samples"
+    )
+    lines.append(
+        f"Timepoints: {', '.join(plan['timepoints'])}; contrasts: "
+        + ", ".join(" -> ".join(contrast) for contrast in plan["contrasts"])
+    )
+    lines.append(
+        f"Metabolites: {plan['metabolites']} measured, {plan['metabolites_after_missingness']} after the "
+        + f"missingness filter, {plan['metabolites_with_identifier']} with an identifier, "
+        + f"{plan['gem_overlapped_metabolites']} in the GEM"
+    )
+    sets = pd.DataFrame(plan["reaction_sets"])
+    sets["features"] = sets["features"].map(", ".join)
+    for col in ["reactions_before_split", "nodes", "edges"]:
+        sets[col] = sets[col].map(lambda value: "-" if pd.isna(value) else int(value))
+    lines.append(sets.to_string(index=False, na_rep="-"))
+    lines.append(f"RWR solves: {plan['rwr_solves']}")
+    fit_counts = sorted(set(plan["forest_fits_per_matrix"].values()))
+    lines.append(
+        f"Forest fits: {plan['forest_fits']} ({plan['classified_matrices']} feature matrices, "
+        + f"{' or '.join(map(str, fit_counts))} fits each, {plan['search']} search evaluated by {plan['evaluation']})"
+    )
+    memory = plan["memory_mb"]
+    lines.append(
+        f"Estimated memory: {memory['prob']:.0f} MB per prob task, "
+        + f"{memory['classification']:.0f} MB for the classification"
+    )
+    runtime = plan.get("runtime")
+    if runtime is None:
+        lines.append("Runtime: no profile of a previous run (pass --plan_history <out_dir> ...)")
+    else:
+        stages = ", ".join(f"{stage} {seconds:.0f} s" for stage, seconds in runtime["stages_s"].items())
+        lines.append(
+            f"Runtime from {runtime['profiles']} previous run(s): {stages}; "
+            + f"{runtime['serial_s']:.0f} s serial, about {runtime['wall_s']:.0f} s with {runtime['workers']} workers"
+        )
+    return "\n".join(lines)
+
+
+def plan_pipeline(args, feature_sets, history_dirs):
+    """Plans the pipeline run of args, writing it to out_dir/plan.json."""
+    plan = plan_workload(args, feature_sets)
+    profiles = read_history(history_dirs)
+    rates = runtime_rates(profiles)
+    if rates is not None:
+        plan["runtime"] = {
+            "profiles": len(profiles),
+            "workers": args.workers,
+            **plan_runtime(plan, rates, args.workers, args.classification_jobs, args.classification_workers),
+        }
+    with open(os.path.join(args.out_dir, PLAN_NAME), "w") as f:
+        json.dump(plan, f, indent=4)
+    return plan
@@ -1,7 +1,19 @@
 import argparse
-import sys
+import os
+import pickle
+import shutil
 import pandas as pd
 from pathlib import Path
+from logging_utils import get_logger, log_to
+from profiling import phase
+from reaction_sets import build_reaction_sets, measure_reactions, metabolite_index, parse_reactions, write_reaction_sets
+
+# parsed reactions and the valid metabolites they were measured against, reused by --incremental
+REACTION_INDEX_NAME = 'all-reactions.pickle'
+# reactions whose measured metabolites changed in the last --incremental run
+CHANGED_REACTIONS_NAME = 'changed-reactions.tsv'
+
+logger = get_logger('preprocess-gem')
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Discards and prerpocesses GEM reactions based on reaction reversibility and metabolite overlap filters.')
@@ -9,314 +21,112 @@ def parse_args():
     parser.add_argument("--gem_path", type=str,
                         help="path to a gem model in .xlsx format",
                         required=True, default=None)
-    parser.add_argument("--valid_met_path", type=str,
-                        help="path to list of valid (common between user data and gem) metabolites in tsv format",
+    parser.add_argument("--valid_met_path", type=str, nargs='+',
+                        help="path to list of valid (common between user data and gem) metabolites in tsv format; " + \
+                        "several studies may be given, one per out_dir, sharing a single parse of the gem",
                         required=True, default=None)
+    parser.add_argument("--incremental", action='store_true',
+                        help="reuse the reactions parsed by a previous run in out_dir and only update those " + \
+                        "involving metabolites added to or removed from valid_met_path")
     
     parser.add_argument("--log_path", type=str,
                         help="path to log file",
                         required=True, default=None)
-    parser.add_argument("--out_dir", type=str,
-                        help="path to output dir",
+    parser.add_argument("--out_dir", type=str, nargs='+',
+                        help="path to output dir, one per valid_met_path; " + \
+                        "studies with identical valid metabolites share the outputs of the first one through symlinks",
                         required=True, default=None)
     args = parser.parse_args()
+    if(len(args.valid_met_path) != len(args.out_dir)):
+        parser.error('--valid_met_path and --out_dir must be given the same number of times')
+    if(args.incremental and len(args.out_dir) > 1):
+        parser.error('--incremental supports a single study')
     return args
 
-def extract_metabolites(eqn):
-    print('eqn', eqn)
-    old = eqn.split(' + ')
-    print('old', old)
-    new = set()
-    flag = False
-    for i_old in old:
-        print(i_old)
-        i_old_split = i_old.split(' ')
-        print(i_old)
-        if(len(i_old_split)>1):
-            print('if')
-            if(i_old_split[0].replace(".", "").isnumeric()): # If a metabolite   a coefficient in reaction equation
-                i_new = i_old[len(i_old_split[0])+1:]
-                print(i_new, i_old)
-                
-                new.add(i_new)
-                flag = True
-            else:
-                new.add(i_old)
-        else:
-            
-            new.add(i_old)
-    print('new', new)
-    return new
-            
+def write_reactions(react_gem, valid_mets, out_dir):
+    react_gem.to_csv(out_dir + '/all-reactions.tsv', sep='\t', index=False)
+    with open(out_dir + '/' + REACTION_INDEX_NAME, 'wb') as f:
+        pickle.dump({'valid_mets': valid_mets, 'reactions': react_gem}, f)
 
-def all_reactions(valid_met_path, gem_path, out_dir):
+def read_valid_mets(valid_met_path):
     valid_mets = pd.read_csv(valid_met_path, sep='\t')
-    valid_mets = set(valid_mets['MET_ID'])
-    react_gem = pd.read_excel(gem_path, sheet_name='RXNS', usecols=['ID', 'EQUATION', 'SUBSYSTEM'])
-    react_gem = react_gem.rename(columns={'ID': 'RXN_ID'})
-    
-    print(react_gem.head())
-    pattern = '|'.join(['\[e\]', '\[x\]', '\[m\]', '\[c\]', '\[l\]', '\[r\]', '\[g\]', '\[n\]', '\[i\]'])
-    react_gem['EQUATION'] = react_gem['EQUATION'].str.replace(pattern, '', regex=True)
-    print(react_gem.head())
-    react_gem['Direction'] = react_gem['EQUATION'].apply(lambda x: 2 if '<=>' in x else 1)
-    react_gem['EQUATION'] = react_gem['EQUATION'].str.replace('<=>', '=>')
-    react_gem[['EQUATION_LHS', 'EQUATION_RHS']] = react_gem['EQUATION'].str.split(' => ', expand=True)
-    react_gem['Substrate_Set'] = react_gem['EQUATION_LHS'].apply(lambda x: extract_metabolites(x))
-    react_gem['Product_Set'] = react_gem['EQUATION_RHS'].apply(lambda x: extract_metabolites(x))
-    react_gem['Metabolite_Set'] = react_gem.apply(lambda x: x['Product_Set'].union(x['Substrate_Set']), axis=1)
-    
-    print(react_gem)
-
-    react_gem['Substrate_Count'] = react_gem['Substrate_Set'].apply(lambda x: len(x))
-    react_gem['Product_Count'] = react_gem['Product_Set'].apply(lambda x: len(x))
-    react_gem['Metabolite_Count'] = react_gem['Metabolite_Set'].apply(lambda x: len(x))
-    
-    react_gem['Measured_Substrate'] = react_gem['Substrate_Set'].apply(lambda x: x.intersection(valid_mets))
-    react_gem['Measured_Product'] = react_gem['Product_Set'].apply(lambda x: x.intersection(valid_mets))
-    react_gem['Measured_Metabolite'] = react_gem['Metabolite_Set'].apply(lambda x: x.intersection(valid_mets))
+    return set(valid_mets['MET_ID'])
 
-    react_gem['Measured_Substrate_Count'] = react_gem['Measured_Substrate'].apply(lambda x: len(x))
-    react_gem['Measured_Product_Count'] = react_gem['Measured_Product'].apply(lambda x: len(x))
-    react_gem['Measured_Metabolite_Count'] = react_gem['Measured_Metabolite'].apply(lambda x: len(x))
+def all_reactions(react_gem, valid_mets, out_dir):
+    react_gem = measure_reactions(react_gem.copy(), valid_mets)
     #react_gem.head()
-    react_gem.to_csv(out_dir + '/all-reactions.tsv', sep='\t', index=False)
+    write_reactions(react_gem, valid_mets, out_dir)
+    Path(out_dir + '/' + CHANGED_REACTIONS_NAME).unlink(missing_ok=True)
     return react_gem
 
-def react_set_1(react_gem, out_dir):
-    react_set_1_dir = out_dir + '/reaction-set-1'
-    Path(react_set_1_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_gem = react_gem[react_gem['Direction'] == 1]
-    one_more_mets_in = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
-    print(one_more_mets_in.shape)
-    one_more_mets_in.to_csv(react_set_1_dir + '/reaction-set-1.tsv', sep='\t', index=False)
-    print(one_more_mets_in.shape)
-    
-def react_set_2(react_gem, out_dir):
-    react_set_2_dir = out_dir + '/reaction-set-2'
-    Path(react_set_2_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_gem = react_gem[react_gem['Direction'] == 1]
-    one_more_mets_in = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
-    print(one_more_mets_in.shape)
-    one_more_mets_in.to_csv(react_set_2_dir + '/reaction-set-2.tsv', sep='\t', index=False)
-    print(one_more_mets_in.shape)
-    
-def reverse_equation(eqn):
-    eqn_split = eqn.split(' => ')
-    if(len(eqn_split) != 2):
-        print('Something wrong!')
-    new_eqn = eqn_split[1] + ' => ' + eqn_split[0]
-    #print(eqn, eqn_split, new_eqn)
-    return new_eqn
-
-def react_set_3(react_gem, out_dir):
-    react_set_3_dir = out_dir + '/reaction-set-3'
-    Path(react_set_3_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
-    print(react_df.shape)
-    react_df.to_csv(react_set_3_dir + '/reaction-set-3-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-    react3_df = react2_df.copy()
-    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
-    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
-    print(react2_df.head())
-
-
-
-
-    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
-    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
-    #swapping columns
-    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
-    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
-    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
-    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
-    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
-
-    print(react3_df.head())
-
-    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
-    react_df.to_csv(react_set_3_dir + '/reaction-set-3.tsv', sep='\t', index=False)
-    
-
-def react_set_4(react_gem, out_dir):
-    react_set_4_dir = out_dir + '/reaction-set-4'
-    Path(react_set_4_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
-    print(react_df.shape)
-    react_df.to_csv(react_set_4_dir + '/reaction-set-4-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-    react3_df = react2_df.copy()
-
-    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
-    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
-    print(react2_df.head())
-
-    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
-    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
-    #swapping columns
-    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
-    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
-    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
-    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
-    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
-
-    print(react3_df.head())
-
-    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
-    react_df.to_csv(react_set_4_dir + '/reaction-set-4.tsv', sep='\t', index=False)
-    
-def react_set_5(react_gem, out_dir):
-    react_set_5_dir = out_dir + '/reaction-set-5'
-    Path(react_set_5_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
-    print(react_df.shape)
-    react_df.to_csv(react_set_5_dir + '/reaction-set-5-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-
-    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
-    react2_df['Product_Set'] = react2_df['Metabolite_Set']
+def link_outputs(target_dir, out_dir):
+    """Replaces out_dir by a symlink to the outputs of a study with the same valid metabolites."""
+    if(os.path.islink(out_dir) or os.path.isfile(out_dir)):
+        os.unlink(out_dir)
+    elif(os.path.isdir(out_dir)):
+        shutil.rmtree(out_dir)
+    Path(out_dir).parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(os.path.abspath(target_dir), out_dir)
+
+def update_reactions(valid_met_path, out_dir):
+    """Updates the measured metabolites of the reactions parsed by a previous run.
+
+    Only reactions involving a metabolite added to or removed from the valid
+    metabolites are recomputed; their identifiers are written to
+    CHANGED_REACTIONS_NAME. Returns the reactions and whether any changed.
+    """
+    with open(out_dir + '/' + REACTION_INDEX_NAME, 'rb') as f:
+        previous = pickle.load(f)
+    react_gem = previous['reactions']
+    valid_mets = read_valid_mets(valid_met_path)
+    
+    changed_mets = previous['valid_mets'].symmetric_difference(valid_mets)
+    logger.info('%d changed metabolites', len(changed_mets))
+    logger.debug('changed_mets %s', changed_mets)
+    
+    index = metabolite_index(react_gem)
+    rows = sorted(set(pos for met in changed_mets for pos in index.get(met, [])))
+    logger.info('%d changed reactions', len(rows))
+    
+    changed = measure_reactions(react_gem.iloc[rows].copy(), valid_mets)
+    react_gem.iloc[rows] = changed
+    
+    write_reactions(react_gem, valid_mets, out_dir)
+    changed[['RXN_ID']].to_csv(out_dir + '/' + CHANGED_REACTIONS_NAME, sep='\t', index=False)
+    return react_gem, len(rows) > 0
 
-    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
-    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
-
-    react_df = pd.concat([react1_df, react2_df], axis=0)
-
-    react_df.to_csv(react_set_5_dir + '/reaction-set-5.tsv', sep='\t', index=False)
-    
-def react_set_6(react_gem, out_dir):
-    react_set_6_dir = out_dir + '/reaction-set-6'
-    Path(react_set_6_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
-    print(react_df.shape)
-    react_df.to_csv(react_set_6_dir + '/reaction-set-6-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-
-    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
-    react2_df['Product_Set'] = react2_df['Metabolite_Set']
-
-    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
-    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
-
-    react_df = pd.concat([react1_df, react2_df], axis=0)
-    react_df.to_csv(react_set_6_dir + '/reaction-set-6.tsv', sep='\t', index=False)
-
-def react_set_7(react_gem, out_dir):
-    react_set_7_dir = out_dir + '/reaction-set-7'
-    Path(react_set_7_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_gem = react_gem[react_gem['Direction'] == 1]
-    two_more_mets_in = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
-    print(two_more_mets_in.shape)
-    two_more_mets_in.to_csv(react_set_7_dir + '/reaction-set-7.tsv', sep='\t', index=False)
-    print(two_more_mets_in.shape)
-    
-def react_set_8(react_gem, out_dir):
-    react_set_8_dir = out_dir + '/reaction-set-8'
-    Path(react_set_8_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
-    print(react_df.shape)
-    react_df.to_csv(react_set_8_dir + '/reaction-set-8-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-    react3_df = react2_df.copy()
-    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
-    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
-    print(react2_df.head())
-
-
-
-
-    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
-    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
-    #swapping columns
-    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
-    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
-    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
-    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
-    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
-
-    print(react3_df.head())
-
-    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
-    react_df.to_csv(react_set_8_dir + '/reaction-set-8.tsv', sep='\t', index=False)
-    
-def react_set_9(react_gem, out_dir):
-    react_set_9_dir = out_dir + '/reaction-set-9'
-    Path(react_set_9_dir).mkdir(parents=True, exist_ok=True)
-    
-    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
-    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
-    print(react_df.shape)
-    react_df.to_csv(react_set_9_dir + '/reaction-set-9-basic.tsv', sep='\t', index=False)
-    print(react_df.shape)
-
-    react1_df = react_df[react_df.Direction == 1]
-    react2_df = react_df[react_df.Direction == 2]
-
-    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
-    react2_df['Product_Set'] = react2_df['Metabolite_Set']
-
-    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
-    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
-
-    react_df = pd.concat([react1_df, react2_df], axis=0)
-
-    react_df.to_csv(react_set_9_dir + '/reaction-set-9.tsv', sep='\t', index=False)
-    
 def main(args):
-    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
-    
-    orig_stdout = sys.stdout
-    log_file = open(args.log_path, 'w')
-    sys.stdout = log_file
-    
-    print('gem_path', args.gem_path)
-    print('valid_met_path', args.valid_met_path)
-    print('log_path', args.log_path)
-    print('out_dir', args.out_dir)
-    
-    react_gem = all_reactions(args.valid_met_path, args.gem_path, args.out_dir)
-    
-    react_set_1(react_gem, args.out_dir)
-    react_set_2(react_gem, args.out_dir)
-    react_set_3(react_gem, args.out_dir)
-    react_set_4(react_gem, args.out_dir)
-    react_set_5(react_gem, args.out_dir)
-    react_set_6(react_gem, args.out_dir)
-    react_set_7(react_gem, args.out_dir)
-    react_set_8(react_gem, args.out_dir)
-    react_set_9(react_gem, args.out_dir)
-    
-    sys.stdout = orig_stdout
-    log_file.close()
+    Path(args.log_path).parent.mkdir(parents=True, exist_ok=True)
+    
+    with log_to(args.log_path):
+        for name, value in vars(args).items():
+            logger.info('%s %s', name, value)
+        
+        if(args.incremental and Path(args.out_dir[0] + '/' + REACTION_INDEX_NAME).exists()):
+            with phase('update reactions', out_dir=args.out_dir[0]):
+                react_gem, changed = update_reactions(args.valid_met_path[0], args.out_dir[0])
+            # the reaction sets are filters of all reactions, unchanged if no reaction changed
+            if(changed):
+                write_reaction_sets(build_reaction_sets(react_gem), args.out_dir[0])
+        else:
+            parsed = parse_reactions(args.gem_path)
+        
+            # the gem is parsed once; reaction sets are built once per distinct set of valid metabolites
+            studies = {}
+            for valid_met_path, out_dir in zip(args.valid_met_path, args.out_dir):
+                studies.setdefault(frozenset(read_valid_mets(valid_met_path)), []).append(out_dir)
+            logger.info('%d distinct sets of valid metabolites: %s', len(studies), list(studies.values()))
+        
+            for valid_mets, out_dirs in studies.items():
+                if(os.path.islink(out_dirs[0])):
+                    os.unlink(out_dirs[0])
+                Path(out_dirs[0]).mkdir(parents=True, exist_ok=True)
+                with phase('measure reactions', out_dir=out_dirs[0]):
+                    react_gem = all_reactions(parsed, set(valid_mets), out_dirs[0])
+                with phase('reaction sets', outputs=[out_dirs[0]]):
+                    write_reaction_sets(build_reaction_sets(react_gem), out_dirs[0])
+                for out_dir in out_dirs[1:]:
+                    link_outputs(out_dirs[0], out_dir)
     
 if __name__ == "__main__":
     main(parse_args())
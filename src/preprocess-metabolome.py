@@ -3,45 +3,75 @@ import sys
 import pathlib
 import numpy as np
 import pandas as pd
+from feature_store import BASELINE_NAME, append_matrix, read_features, write_matrix
+from logging_utils import get_logger, log_to
+from metabolome_store import STORE_NAME, append_store, append_tsv, build_registry, change_kind, change_tensor, contrast_frame, read_metadata, read_registry
+from preprocessing import impute_missing_values, preprocess_metabolome, read_profiles, write_preprocessed
+from profiling import phase
+# exit status of --append when the new samples would change the preprocessed metabolites
+REBUILD_EXIT_CODE = 3
+
+logger = get_logger('preprocess-metabolome')
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Preprocessing of user-provided baseline (before diet) and end (after diet) metabolomic profiles (expected file format: .tsv).' + \
+        '\n' + 'Longitudinal studies may instead provide any number of ordered timepoint profiles; changes are then computed for every consecutive pair or against the first timepoint.' + \
         '\n' + 'Two columns sample_id and sample_group are expected to have sample id and sample groups (case/control).' + \
         '\n' + 'Other columns are expected to have metabolite abundances. These columns may have arbitrary names.' + \
         '\n' + 'Rows or columns absent in any profile are discarded from the other profile.' + \
         '\n' + 'Columns are discarded based on missing value proportion too.' + \
-        '\n' + 'In the output directory, 10 .tsv files are generated.')
+        '\n' + 'In the output directory, the timepoint and change matrices are written to a single columnar store (' + STORE_NAME + ').' + \
+        '\n' + 'With --append, the profiles of newly enrolled samples are appended to an existing output directory using the stored filter and imputation parameters.')
     
     parser.add_argument("--base_path", type=str,
                         help="path to baseline metabolomics in tsv format",
-                        required=True, default=None)
+                        required=False, default=None)
     parser.add_argument("--end_path", type=str,
                         help="path to end metabolomics in tsv format",
-                        required=True, default=None)
+                        required=False, default=None)
+    
+    parser.add_argument("--timepoint_paths", type=str, nargs='+',
+                        help="paths to metabolomics of every timepoint in tsv format, in visit order (instead of base_path and end_path)",
+                        required=False, default=None)
+    parser.add_argument("--timepoint_names", type=str, nargs='+',
+                        help="names of the timepoints in timepoint_paths (default: t0, t1, ...)",
+                        required=False, default=None)
+    parser.add_argument("--contrast", type=str,
+                        help="pair every timepoint with the previous one (consecutive) or with the first one (baseline)",
+                        choices=['consecutive', 'baseline'], default='consecutive')
     
     parser.add_argument("--missing_pct", type=float,
                         help="threshold of missing value percentage for dropping columns",
-                        required=True, default=None)
+                        required=False, default=None)
     
     parser.add_argument("--user_met_id_path", type=str,
                         help="path to list of user metabolites (columns in in base_path and end_path) with standard identifiers in tsv format",
-                        required=True, default=None)
+                        required=False, default=None)
     parser.add_argument("--user_met_name_col", type=str,
                         help="which column in user_met_id_path contains the metabolite names",
-                        required=True, default=None)
+                        required=False, default=None)
     parser.add_argument("--user_met_id_col", type=str,
                         help="which column in user_met_id_path contains the metabolite standard identifiers",
-                        required=True, default=None)
+                        required=False, default=None)
     
     parser.add_argument("--gem_path", type=str,
                         help="path to a gem model in .xlsx format",
-                        required=True, default=None)
+                        required=False, default=None)
     parser.add_argument("--gem_met_id_path", type=str,
                         help="path to list of human gem metabolites with standard identifiers list in tsv format",
-                        required=True, default=None)
+                        required=False, default=None)
     parser.add_argument("--gem_met_id_col", type=str,
                         help="which column in gem_met_id_path contains the metabolite standard identifiers",
-                        required=True, default=None)
+                        required=False, default=None)
+    
+    parser.add_argument("--compression", type=str,
+                        help="compression codec of the columnar store",
+                        choices=['lz4', 'zstd', 'uncompressed'], default='lz4')
+    parser.add_argument("--write_tsv", action='store_true',
+                        help="also write the base, end and change matrices as the legacy .tsv files")
+    parser.add_argument("--append", action='store_true',
+                        help="append new samples to the store in out_dir instead of preprocessing from scratch; " + \
+                        "exits with status " + str(REBUILD_EXIT_CODE) + " if a full rebuild is required")
     
     parser.add_argument("--log_path", type=str,
                         help="path to log file",
@@ -51,223 +81,150 @@ def parse_args():
                         required=True, default=None)
     
     args = parser.parse_args()
-    return args
-
-# Imputes missing values to uniform random values between [0, mm * minimum observed] for every feature
-def impute_missing_values(base_df, end_df, coeff):
-
-    # Compute per-feature minimums for dataset
-    base_df_feature_mins = np.min(base_df, axis=0)
-    base_df_nan_dict = {}
-    end_df_feature_mins = np.min(end_df, axis=0)
-    end_df_nan_dict = {}
     
-    print('base_df_feature_mins', base_df_feature_mins)
-    print('end_df_feature_mins', end_df_feature_mins)
-
-    # Create new datasets that contains random values for each subject for each feature,
-    # between 0 and mm * the minimum for that feature
-    for feature, minimum in base_df_feature_mins.items():
-        base_df_nan_dict[feature] = np.random.uniform(
-            low=0, high=coeff*minimum, size=len(base_df)
-        )
-
-    for feature, minimum in end_df_feature_mins.items():
-        end_df_nan_dict[feature] = np.random.uniform(
-            low=0, high=coeff*minimum, size=len(end_df)
-        )
-
-    # Update original dataset with new values for any missing entries
-    # Original values should be preserved
-    base_df_nan = pd.DataFrame(base_df_nan_dict)
-    base_df_nan.index = base_df.index
-
-    end_df_nan = pd.DataFrame(end_df_nan_dict)
-    end_df_nan.index = end_df.index
-
-    base_df.update(base_df_nan, overwrite=False)
-    end_df.update(end_df_nan, overwrite=False)
-
-    return base_df, end_df
-
+    if(not args.append):
+        for arg in ['missing_pct', 'user_met_id_path', 'user_met_name_col', 'user_met_id_col', 'gem_path', 'gem_met_id_path', 'gem_met_id_col']:
+            if(getattr(args, arg) is None):
+                parser.error('--' + arg + ' is required unless --append is given')
+    
+    if(args.timepoint_paths is None):
+        if(args.base_path is None or args.end_path is None):
+            parser.error('either --base_path and --end_path or --timepoint_paths is required')
+        args.timepoint_paths = [args.base_path, args.end_path]
+        args.timepoint_names = ['base', 'end']
+    elif(args.base_path is not None or args.end_path is not None):
+        parser.error('--timepoint_paths cannot be combined with --base_path/--end_path')
+    if(len(args.timepoint_paths) < 2):
+        parser.error('at least two timepoints are required')
+    if(args.timepoint_names is None):
+        args.timepoint_names = ['t' + str(i) for i in range(len(args.timepoint_paths))]
+    if(len(args.timepoint_names) != len(args.timepoint_paths) or len(set(args.timepoint_names)) != len(args.timepoint_names)):
+        parser.error('--timepoint_names must give one distinct name per timepoint path')
+    return args
 
 def main(args):
     pathlib.Path(args.out_dir).mkdir(parents=True, exist_ok=True)
     
-    orig_stdout = sys.stdout
-    log_file = open(args.log_path, 'w')
-    sys.stdout = log_file
-    
-    print('base_path', args.base_path)
-    print('end_path', args.end_path)
-    print('missing_pct', args.missing_pct)
-    print('user_met_id_path', args.user_met_id_path)
-    print('user_met_name_col', args.user_met_name_col)
-    print('user_met_id_col', args.user_met_id_col)
-    print('gem_path', args.gem_path)
-    print('gem_met_id_path', args.gem_met_id_path)
-    print('gem_met_id_col', args.gem_met_id_col)
-    print('log_path', args.log_path)
-    print('out_dir', args.out_dir)
-    
-    base_df = pd.read_csv(args.base_path, sep='\t')
-    print(base_df.shape)
-    end_df = pd.read_csv(args.end_path, sep='\t')
-    print(end_df.shape)
-    
-    base_df.columns = map(str.lower, base_df.columns)
-    end_df.columns = map(str.lower, end_df.columns)
-    
-    base_df['key'] = base_df['sample_id'].astype(str) + ':' + base_df['sample_group'].astype(str)
-    end_df['key'] = end_df['sample_id'].astype(str) + ':' + end_df['sample_group'].astype(str)
-    
-    base_df = base_df.set_index('key')
-    end_df = end_df.set_index('key')
-    
-    common_rows = set(base_df.index).intersection(set(end_df.index))
-    print('common_rows', len(common_rows), common_rows)
-    
-    base_df = base_df[base_df.index.isin(common_rows)]
-    end_df = end_df[end_df.index.isin(common_rows)]
-     
-    common_cols = list(set(base_df.columns).intersection(set(end_df.columns)))
-    print('common_cols', len(common_cols))
-    
-    base_df = base_df[common_cols]
-    end_df = end_df[common_cols]
-    
-    print('base_df', base_df.shape, 'end_df', end_df.shape)
-    
-    base_missing = base_df.isnull().mean()
-    end_missing = end_df.isnull().mean()
-    
-    print('base_missing', base_missing)
-    print('end_missing', end_missing)
-    
-    base_drop_cols = base_missing[base_missing >= args.missing_pct].index
-    end_drop_cols = end_missing[end_missing >= args.missing_pct].index
-    
-    print('base_drop_cols', len(base_drop_cols), base_drop_cols)
-    print('end_drop_cols', len(end_drop_cols), end_drop_cols)
-    
-    drop_cols = list(set(base_drop_cols).union(set(end_drop_cols))) + ['sample_id', 'sample_group']
-    print('drop_cols', len(drop_cols), drop_cols)
-    
-    base_df = base_df.drop(columns=drop_cols)
-    end_df = end_df.drop(columns=drop_cols)
-    
-    print('base_df', base_df.shape, 'end_df', end_df.shape)
-    
-    base_df, end_df = impute_missing_values(base_df, end_df, coeff=0.25)
-    print(base_df.shape, end_df.shape)    
-    
-    common_cols = list(set(base_df.columns).intersection(set(end_df.columns)))
-    print('common_cols', len(common_cols))
-    base_df = base_df[common_cols]
-    end_df = end_df[common_cols]
-    
-    print('base_df',base_df.shape, 'end_df', end_df.shape)
-    
-    base_df.to_csv(args.out_dir + '/preprocessed_base_name.tsv', sep='\t')
-    end_df.to_csv(args.out_dir + '/preprocessed_end_name.tsv', sep='\t')
-    
-    base_df = base_df.sort_index(axis=0).sort_index(axis=1)
-    end_df = end_df.sort_index(axis=0).sort_index(axis=1)
-    
-    print('base_df',base_df.shape, 'end_df', end_df.shape)
-    
-    change_df = end_df.sub(base_df)
-    print('change_df', change_df.shape)
-    change_df.to_csv(args.out_dir + '/preprocessed_change_name.tsv', sep='\t')
-    
-    id_df = pd.read_csv(args.user_met_id_path, sep='\t', usecols=[args.user_met_name_col, args.user_met_id_col])
-    id_df[args.user_met_name_col] = id_df[args.user_met_name_col].apply(lambda x: x.lower())
-    id_df = id_df[id_df[args.user_met_name_col].isin(common_cols)]
-    id_df = id_df.dropna(subset=[args.user_met_id_col])
-    
-    print('id_df', id_df.shape)
+    with log_to(args.log_path):
+        for name, value in vars(args).items():
+            logger.info('%s %s', name, value)
         
-    name_to_id = dict(zip(id_df[args.user_met_name_col], id_df[args.user_met_id_col]))
-    print('name_to_id', name_to_id)
-    
-    id_to_name = dict(zip(id_df[args.user_met_id_col], id_df[args.user_met_name_col]))
-    print('id_to_name', id_to_name)
-    
-    common_cols_id = set([name_to_id[col] for col in common_cols if col in name_to_id.keys()])
-    print(len(common_cols_id))
+        if(args.append):
+            status = append_samples(args)
+        else:
+            status = preprocess(args)
     
-    gem_met = pd.read_csv(args.gem_met_id_path, sep='\t')
-    gem_met = gem_met.dropna(subset=[args.gem_met_id_col])
-    print(gem_met.shape)
-    
-    common_mets = common_cols_id.intersection(set(gem_met[args.gem_met_id_col]))
-    print('common_mets', len(common_mets))
-    
-    common_mets_names = [id_to_name[met] for met in common_mets]
-    print(len(common_mets_names))
-    print(common_mets_names)
-    
-    base_df = base_df[common_mets_names]
-    end_df = end_df[common_mets_names]
-    print(base_df.shape, end_df.shape)
-    
-    base_df.to_csv(args.out_dir + '/gem_overlapped_base_name.tsv', sep='\t')
-    end_df.to_csv(args.out_dir + '/gem_overlapped_end_name.tsv', sep='\t')
-    
-    base_df = base_df.rename(columns=name_to_id)
-    end_df = end_df.rename(columns=name_to_id)
-    
-    base_df.to_csv(args.out_dir + '/gem_overlapped_base_id.tsv', sep='\t')
-    end_df.to_csv(args.out_dir + '/gem_overlapped_end_id.tsv', sep='\t')
-     
-    base_df = base_df.sort_index(axis=0).sort_index(axis=1)
-    end_df = end_df.sort_index(axis=0).sort_index(axis=1)
-    
-    change_df = end_df.sub(base_df)
-    
-    change_df.to_csv(args.out_dir + '/gem_overlapped_change_id.tsv', sep='\t')
-    change_df = change_df.rename(columns=id_to_name)
-    change_df.to_csv(args.out_dir + '/gem_overlapped_change_name.tsv', sep='\t')
-    print('change_df', change_df.shape)
-    
-    gem_overlapeed_met_names = list(change_df.columns)
-    gem_met = gem_met[gem_met[args.gem_met_id_col].isin(id_to_name.keys())]
-    id_to_mam = dict(zip(gem_met[args.gem_met_id_col], gem_met.metsNoComp))
-    print('id_to_mam', id_to_mam)
-    
-    gem_model = pd.read_excel(args.gem_path, sheet_name='METS', usecols=['NAME', 'REPLACEMENT ID'])
-    print('gem_path', args.gem_path)
-    #pattern = '|'.join(['e', 'x', 'm', 'c', 'l', 'r', 'g', 'n', 'i'])
-    #gem_model['MAM_ID'] = gem_model['REPLACEMENT ID'].str.replace(pattern, '')
-    gem_model['MAM_ID'] = gem_model['REPLACEMENT ID'].str[:-1]
+    if(status != 0):
+        sys.exit(status)
 
-    print('gem_model', gem_model.shape)
-    print(list(id_to_mam.values()))
-    print(gem_model['MAM_ID'])
-    gem_model = gem_model[gem_model['MAM_ID'].isin(id_to_mam.values())]
-    print('gem_model', gem_model.shape)
-    mam_to_met = dict(zip(gem_model['MAM_ID'], gem_model['NAME']))
-    print('mam_to_met', mam_to_met)
-    
-    
-    file = open(args.out_dir + '/gem_overlapped_metabolites.tsv', 'w')
-    file.write('Name' + '\t' + 'ID' + '\t' + 'MAM_ID' + '\t' + 'MET_ID' + '\n')
-    for name in gem_overlapeed_met_names:
-        id = name_to_id[name]
-        mam = id_to_mam[id]
-        met = mam_to_met[mam]
-        file.write(name + '\t' + id + '\t' + mam + '\t' + met + '\n')
-    file.flush()
-    file.close()
-    
-    df = pd.read_csv(args.out_dir + '/gem_overlapped_change_id.tsv', sep='\t')
-    df[['sample_id', 'sample_group']] = df['key'].str.rsplit(":", n=1, expand=True)
-    df = df.set_index(['sample_id', 'sample_group'])
-    df = df.drop(columns='key')
-    df.to_csv(args.out_dir + '/metabolite.tsv', sep='\t', index=True)
-    
-    sys.stdout = orig_stdout
-    log_file.close()
+def preprocess(args):
+    with phase('preprocess', inputs=args.timepoint_paths):
+        result = preprocess_metabolome(args.timepoint_paths, args.timepoint_names, args.contrast, args.missing_pct,
+                                       args.user_met_id_path, args.user_met_name_col, args.user_met_id_col,
+                                       args.gem_path, args.gem_met_id_path, args.gem_met_id_col)
+    with phase('write store', outputs=[args.out_dir]):
+        write_preprocessed(result, args.out_dir, compression=args.compression, write_tsv=args.write_tsv)
+    return 0
+
+def append_samples(args):
+    """Appends newly enrolled samples to the store in out_dir with its fitted filter and imputation parameters.
+
+    Returns REBUILD_EXIT_CODE, leaving every output untouched, if the missing
+    value filter over all samples would keep a different set of metabolites.
+    """
+    store_path = args.out_dir + '/' + STORE_NAME
+    metadata = read_metadata(store_path)
+    preprocessing = metadata['preprocessing']
+    timepoints = metadata['timepoints']
+    contrasts = [tuple(contrast) for contrast in metadata['contrasts']]
+    mets = metadata['metabolites']
+    logger.info('store_path %s, timepoints %s, contrasts %s', store_path, timepoints, contrasts)
+    
+    if(preprocessing is None):
+        raise ValueError(store_path + ' has no fitted preprocessing parameters; preprocess from scratch')
+    if(args.timepoint_names != timepoints):
+        raise ValueError(f"Timepoints {args.timepoint_names} do not match the store timepoints {timepoints}")
+    
+    dfs = read_profiles(args.timepoint_paths)
+    
+    registry = read_registry(store_path)
+    known_keys = set(registry['sample_id'].astype(str) + ':' + registry['sample_group'].astype(str))
+    duplicated = known_keys.intersection(dfs[0].index)
+    if(len(duplicated) > 0):
+        raise ValueError(f"Samples already in the store: {sorted(duplicated)}")
+    
+    # re-evaluate the missing value filter over all samples with the stored counts
+    candidate_cols = list(preprocessing['missing_counts'][timepoints[0]].keys())
+    n_samples = preprocessing['n_samples'] + len(dfs[0])
+    keep_cols = set(candidate_cols)
+    for timepoint, df in zip(timepoints, dfs):
+        counts = preprocessing['missing_counts'][timepoint]
+        present = [col for col in candidate_cols if col in df.columns]
+        keep_cols = keep_cols.intersection(present)
+        new_counts = df[present].isnull().sum()
+        for col in present:
+            counts[col] += int(new_counts[col])
+            if(counts[col] / n_samples >= preprocessing['missing_pct']):
+                keep_cols.discard(col)
+    
+    if(keep_cols != set(mets)):
+        logger.info('added %s', sorted(keep_cols - set(mets)))
+        logger.info('removed %s', sorted(set(mets) - keep_cols))
+        message = 'The missing value filter would change the preprocessed metabolites; a full rebuild is required.'
+        logger.warning(message)
+        sys.stderr.write(message + '\n')
+        return REBUILD_EXIT_CODE
+    
+    # new samples continue the registry after the stored ones
+    samples = dfs[0][['sample_id', 'sample_group']].sort_index()
+    new_registry = build_registry(samples)
+    new_registry.index = pd.RangeIndex(registry.index.max() + 1, registry.index.max() + 1 + len(samples), name='sample')
+    key_to_sample = dict(zip(samples.index, new_registry.index))
+    logger.info('new_registry %s %s', new_registry.shape, new_registry['sample_group'].value_counts().to_dict())
+    
+    feature_mins = [pd.Series(preprocessing['imputation_mins'][timepoint]) for timepoint in timepoints]
+    dfs = [df[mets].astype(float) for df in dfs]
+    dfs = impute_missing_values(dfs, coeff=preprocessing['imputation_coeff'], feature_mins=feature_mins)
+    dfs = [df.sort_index(axis=0) for df in dfs]
+    for df in dfs:
+        df.index = df.index.map(key_to_sample).rename('sample')
+    logger.info('matrices %s', [df.shape for df in dfs])
+    
+    levels = np.stack([df.to_numpy() for df in dfs], axis=1)
+    changes = change_tensor(levels, timepoints, contrasts)
+    
+    matrices = dict(zip(timepoints, dfs))
+    for i, contrast in enumerate(contrasts):
+        matrices[change_kind(contrast)] = pd.DataFrame(changes[:, i, :], index=dfs[0].index, columns=mets)
+    
+    preprocessing['n_samples'] = n_samples
+    append_store(store_path, matrices, new_registry, metadata, compression=args.compression)
+    
+    # the legacy .tsv files are only extended when they were written before
+    name_to_id = metadata['name_to_id']
+    common_mets_names = list(name_to_id.keys())
+    for kind, df in matrices.items():
+        legacy_kind = kind
+        if(kind.startswith('change:')):
+            legacy_kind = 'change' if len(contrasts) == 1 else 'change_' + kind[len('change:'):]
+        legacy_path = args.out_dir + '/preprocessed_' + legacy_kind + '_name.tsv'
+        if(pathlib.Path(legacy_path).exists()):
+            append_tsv(df, legacy_path)
+            append_tsv(df[common_mets_names], args.out_dir + '/gem_overlapped_' + legacy_kind + '_name.tsv')
+            append_tsv(df[common_mets_names].rename(columns=name_to_id), args.out_dir + '/gem_overlapped_' + legacy_kind + '_id.tsv')
+    
+    change_dfs = [matrices[change_kind(contrast)][common_mets_names].rename(columns=name_to_id).sort_index(axis=1)
+                  for contrast in contrasts]
+    change_df = contrast_frame(np.stack([df.to_numpy() for df in change_dfs], axis=1),
+                               change_dfs[0].index, list(change_dfs[0].columns), contrasts)
+    append_tsv(change_df, args.out_dir + '/metabolite.tsv')
+    matrix_path = args.out_dir + '/' + BASELINE_NAME
+    if(pathlib.Path(matrix_path).exists()):
+        append_matrix(change_df, matrix_path)
+    else:
+        write_matrix(read_features(args.out_dir + '/metabolite.tsv'), matrix_path)
+    logger.info('appended %d samples', len(new_registry))
+    return 0
         
 if __name__ == "__main__":
     main(parse_args())
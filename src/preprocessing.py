@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+from feature_store import BASELINE_NAME, write_matrix
+from logging_utils import get_logger
+from metabolome_store import STORE_NAME, build_contrasts, build_registry, change_kind, change_tensor, contrast_frame, contrast_label, write_store
+
+# Preprocessing of the metabolomic profiles in memory: samples measured at
+# every timepoint are kept, metabolites with too many missing values dropped,
+# the remaining missing values imputed and the change matrices of every
+# contrast computed. preprocess_metabolome returns the matrices and the
+# gem-overlapped metabolites as a dict; write_preprocessed writes them to the
+# output directory of preprocess-metabolome.py.
+
+IMPUTATION_COEFF = 0.25
+
+logger = get_logger('preprocessing')
+
+# Imputes missing values to uniform random values between [0, mm * minimum observed] for every feature
+# Minimums are computed per dataset unless previously fitted ones are given
+def impute_missing_values(dfs, coeff, feature_mins=None):
+    imputed_dfs = []
+    for i, df in enumerate(dfs):
+        # Compute per-feature minimums for dataset
+        if(feature_mins is None):
+            df_feature_mins = np.min(df, axis=0)
+        else:
+            df_feature_mins = feature_mins[i][df.columns]
+        df_nan_dict = {}
+        logger.debug('df_feature_mins %s', df_feature_mins)
+
+        # Create new dataset that contains random values for each subject for each feature,
+        # between 0 and mm * the minimum for that feature
+        for feature, minimum in df_feature_mins.items():
+            df_nan_dict[feature] = np.random.uniform(
+                low=0, high=coeff*minimum, size=len(df)
+            )
+
+        # Update original dataset with new values for any missing entries
+        # Original values should be preserved
+        df_nan = pd.DataFrame(df_nan_dict)
+        df_nan.index = df.index
+
+        df.update(df_nan, overwrite=False)
+        imputed_dfs.append(df)
+
+    return imputed_dfs
+
+def read_profiles(paths):
+    """Reads the profile of every timepoint keyed by sample_id:sample_group, keeping samples present in all of them."""
+    dfs = []
+    for path in paths:
+        df = pd.read_csv(path, sep='\t')
+        logger.info('%s %s', path, df.shape)
+        df.columns = map(str.lower, df.columns)
+        df['key'] = df['sample_id'].astype(str) + ':' + df['sample_group'].astype(str)
+        dfs.append(df.set_index('key'))
+
+    common_rows = set.intersection(*[set(df.index) for df in dfs])
+    logger.info('%d samples measured at every timepoint', len(common_rows))
+    logger.debug('common_rows %s', common_rows)
+
+    return [df[df.index.isin(common_rows)] for df in dfs]
+
+def preprocess_metabolome(timepoint_paths, timepoints, contrast, missing_pct,
+                          user_met_id_path, user_met_name_col, user_met_id_col,
+                          gem_path, gem_met_id_path, gem_met_id_col):
+    """Preprocesses the profiles of every timepoint.
+
+    Returns a dict with the 'timepoints', the 'contrasts', the sample
+    'registry', the 'matrices' of every timepoint and contrast (indexed by
+    registry sample, labelled by metabolite name), the fitted 'preprocessing'
+    parameters, the user metabolite 'name_to_id' map and its
+    'gem_overlapped_name_to_id' subset, the gem-overlapped metabolites
+    ('valid_met_df', as in gem_overlapped_metabolites.tsv) and their changes
+    ('change_df', as in metabolite.tsv).
+    """
+    contrasts = build_contrasts(timepoints, contrast)
+    logger.info('contrasts %s', contrasts)
+
+    dfs = read_profiles(timepoint_paths)
+    common_cols = list(set.intersection(*[set(df.columns) for df in dfs]))
+    logger.info('%d common columns', len(common_cols))
+
+    dfs = [df[common_cols] for df in dfs]
+
+    # sample registry: integer sample -> (sample_id, sample_group), in sample key order
+    samples = dfs[0][['sample_id', 'sample_group']].sort_index()
+    registry = build_registry(samples)
+    key_to_sample = dict(zip(samples.index, registry.index))
+    logger.info('%d samples %s', len(registry), registry['sample_group'].value_counts().to_dict())
+
+    # fitted parameters kept in the store so that new samples can be appended
+    candidate_cols = sorted(set(common_cols) - {'sample_id', 'sample_group'})
+    preprocessing = {
+        'missing_pct': missing_pct,
+        'n_samples': len(registry),
+        'missing_counts': {timepoint: df[candidate_cols].isnull().sum().astype(int).to_dict()
+                           for timepoint, df in zip(timepoints, dfs)},
+        'imputation_coeff': IMPUTATION_COEFF,
+    }
+
+    drop_cols = set()
+    for timepoint, df in zip(timepoints, dfs):
+        missing = df.isnull().mean()
+        logger.debug('%s_missing %s', timepoint, missing)
+        tp_drop_cols = missing[missing >= missing_pct].index
+        logger.debug('%s_drop_cols %d %s', timepoint, len(tp_drop_cols), list(tp_drop_cols))
+        drop_cols = drop_cols.union(set(tp_drop_cols))
+
+    drop_cols = list(drop_cols) + ['sample_id', 'sample_group']
+    logger.info('%d metabolites with %s or more missing values dropped', len(drop_cols) - 2, missing_pct)
+    logger.debug('drop_cols %s', drop_cols)
+
+    dfs = [df.drop(columns=drop_cols) for df in dfs]
+
+    feature_mins = [np.min(df, axis=0) for df in dfs]
+    dfs = impute_missing_values(dfs, coeff=IMPUTATION_COEFF, feature_mins=feature_mins)
+
+    common_cols = list(set.intersection(*[set(df.columns) for df in dfs]))
+    preprocessing['imputation_mins'] = {timepoint: mins[sorted(common_cols)].to_dict()
+                                        for timepoint, mins in zip(timepoints, feature_mins)}
+
+    dfs = [df[common_cols].sort_index(axis=0).sort_index(axis=1) for df in dfs]
+    for df in dfs:
+        df.index = df.index.map(key_to_sample).rename('sample')
+
+    logger.info('matrices %s', [df.shape for df in dfs])
+
+    # (sample x timepoint x metabolite) levels, all contrasts subtracted at once
+    levels = np.stack([df.to_numpy() for df in dfs], axis=1)
+    changes = change_tensor(levels, timepoints, contrasts)
+    logger.debug('levels %s, changes %s', levels.shape, changes.shape)
+
+    matrices = dict(zip(timepoints, dfs))
+    for i, contrast in enumerate(contrasts):
+        matrices[change_kind(contrast)] = pd.DataFrame(changes[:, i, :], index=dfs[0].index, columns=dfs[0].columns)
+
+    id_df = pd.read_csv(user_met_id_path, sep='\t', usecols=[user_met_name_col, user_met_id_col])
+    id_df[user_met_name_col] = id_df[user_met_name_col].apply(lambda x: x.lower())
+    id_df = id_df[id_df[user_met_name_col].isin(common_cols)]
+    id_df = id_df.dropna(subset=[user_met_id_col])
+
+    name_to_id = dict(zip(id_df[user_met_name_col], id_df[user_met_id_col]))
+    logger.debug('name_to_id %s', name_to_id)
+
+    id_to_name = dict(zip(id_df[user_met_id_col], id_df[user_met_name_col]))
+    logger.debug('id_to_name %s', id_to_name)
+
+    common_cols_id = set([name_to_id[col] for col in common_cols if col in name_to_id.keys()])
+    logger.info('%d metabolites with an identifier', len(common_cols_id))
+
+    gem_met = pd.read_csv(gem_met_id_path, sep='\t')
+    gem_met = gem_met.dropna(subset=[gem_met_id_col])
+
+    common_mets = common_cols_id.intersection(set(gem_met[gem_met_id_col]))
+    logger.info('%d metabolites in the GEM', len(common_mets))
+
+    common_mets_names = [id_to_name[met] for met in common_mets]
+    logger.debug('common_mets_names %s', common_mets_names)
+
+    gem_overlapped_name_to_id = {name: name_to_id[name] for name in common_mets_names}
+
+    # gem-overlapped change with standard identifiers, sorted by identifier, one block per contrast
+    change_dfs = [matrices[change_kind(contrast)][common_mets_names].rename(columns=name_to_id).sort_index(axis=1)
+                  for contrast in contrasts]
+    met_ids = list(change_dfs[0].columns)
+    change_df = contrast_frame(np.stack([df.to_numpy() for df in change_dfs], axis=1),
+                               change_dfs[0].index, met_ids, contrasts)
+    logger.info('change_df %s', change_df.shape)
+
+    gem_overlapeed_met_names = [id_to_name[met] for met in met_ids]
+    gem_met = gem_met[gem_met[gem_met_id_col].isin(id_to_name.keys())]
+    id_to_mam = dict(zip(gem_met[gem_met_id_col], gem_met.metsNoComp))
+    logger.debug('id_to_mam %s', id_to_mam)
+
+    gem_model = pd.read_excel(gem_path, sheet_name='METS', usecols=['NAME', 'REPLACEMENT ID'])
+    #pattern = '|'.join(['e', 'x', 'm', 'c', 'l', 'r', 'g', 'n', 'i'])
+    #gem_model['MAM_ID'] = gem_model['REPLACEMENT ID'].str.replace(pattern, '')
+    gem_model['MAM_ID'] = gem_model['REPLACEMENT ID'].str[:-1]
+
+    gem_model = gem_model[gem_model['MAM_ID'].isin(id_to_mam.values())]
+    logger.debug('gem_model %s', gem_model.shape)
+    mam_to_met = dict(zip(gem_model['MAM_ID'], gem_model['NAME']))
+    logger.debug('mam_to_met %s', mam_to_met)
+
+    valid_mets = []
+    for name in gem_overlapeed_met_names:
+        id = name_to_id[name]
+        mam = id_to_mam[id]
+        met = mam_to_met[mam]
+        valid_mets.append((name, id, mam, met))
+    valid_met_df = pd.DataFrame(valid_mets, columns=['Name', 'ID', 'MAM_ID', 'MET_ID'])
+
+    return {
+        'timepoints': timepoints,
+        'contrasts': contrasts,
+        'registry': registry,
+        'matrices': matrices,
+        'preprocessing': preprocessing,
+        'name_to_id': name_to_id,
+        'gem_overlapped_name_to_id': gem_overlapped_name_to_id,
+        'valid_met_df': valid_met_df,
+        'change_df': change_df,
+    }
+
+def write_legacy_tsv(matrices, common_mets_names, name_to_id, out_dir):
+    for kind, df in matrices.items():
+        df.to_csv(out_dir + '/preprocessed_' + kind + '_name.tsv', sep='\t')
+        df = df[common_mets_names]
+        df.to_csv(out_dir + '/gem_overlapped_' + kind + '_name.tsv', sep='\t')
+        df.rename(columns=name_to_id).sort_index(axis=1).to_csv(out_dir + '/gem_overlapped_' + kind + '_id.tsv', sep='\t')
+
+def write_preprocessed(result, out_dir, compression='lz4', write_tsv=False):
+    """Writes the store, gem_overlapped_metabolites.tsv and metabolite.tsv of a preprocess_metabolome result."""
+    timepoints = result['timepoints']
+    contrasts = result['contrasts']
+    matrices = result['matrices']
+
+    store_path = out_dir + '/' + STORE_NAME
+    write_store(store_path, matrices, result['gem_overlapped_name_to_id'], result['registry'],
+                timepoints, contrasts, preprocessing=result['preprocessing'], compression=compression)
+    logger.info('store_path %s', store_path)
+
+    if(write_tsv):
+        legacy_matrices = {timepoint: matrices[timepoint] for timepoint in timepoints}
+        for contrast in contrasts:
+            legacy_kind = 'change' if len(contrasts) == 1 else 'change_' + contrast_label(contrast)
+            legacy_matrices[legacy_kind] = matrices[change_kind(contrast)]
+        write_legacy_tsv(legacy_matrices, list(result['gem_overlapped_name_to_id'].keys()), result['name_to_id'], out_dir)
+
+    file = open(out_dir + '/gem_overlapped_metabolites.tsv', 'w')
+    file.write('Name' + '\t' + 'ID' + '\t' + 'MAM_ID' + '\t' + 'MET_ID' + '\n')
+    for name, id, mam, met in result['valid_met_df'].itertuples(index=False):
+        file.write(name + '\t' + id + '\t' + mam + '\t' + met + '\n')
+    file.flush()
+    file.close()
+
+    result['change_df'].to_csv(out_dir + '/metabolite.tsv', sep='\t', index=True)
+    # the metabolite block read by the classification, referenced by every metabolite+reaction matrix
+    write_matrix(result['change_df'], out_dir + '/' + BASELINE_NAME)
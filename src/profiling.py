@@ -0,0 +1,242 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+import pandas as pd
+import psutil
+
+# Resource profiling of the pipeline.
+# The task graph records the wall time, CPU time, peak RSS and input and
+# output sizes of every task. Inside a task, phase() measures the inner phases
+# (xlsx parse, graph build, RWR, forest fitting, plotting) and appends them as
+# json lines to the file named by PROFILE_ENV, which the task graph sets for
+# every task; without it phases cost nothing. CAPTURE_ENV additionally turns
+# on cProfile or tracemalloc for the whole task, written next to that file.
+
+PROFILE_ENV = "PIPELINE_PROFILE_PATH"
+CAPTURE_ENV = "PIPELINE_PROFILE_CAPTURE"
+CAPTURE_KINDS = ["cprofile", "tracemalloc"]
+PROFILE_NAME = "profile.json"
+
+# seconds between two RSS samples
+SAMPLE_INTERVAL = 0.05
+# frames recorded per allocation and allocation sites kept by a tracemalloc capture
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 50
+
+MB = 1 << 20
+
+
+def path_size(paths):
+    """Total size in bytes of the given files and of every file under the given directories."""
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+class ResourceMonitor:
+    """
+    Measures the wall time, CPU time and peak RSS of a process (this one by
+    default) and its children between start() and stop(), sampling RSS in a thread.
+    """
+
+    def __init__(self, process=None, interval=SAMPLE_INTERVAL):
+        self.process = process or psutil.Process()
+        self.interval = interval
+
+    def rss(self):
+        rss = 0
+        with contextlib.suppress(psutil.Error):
+            rss += self.process.memory_info().rss
+            for child in self.process.children(recursive=True):
+                with contextlib.suppress(psutil.Error):
+                    rss += child.memory_info().rss
+        return rss
+
+    def cpu(self):
+        times = self.process.cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def start(self):
+        self.stopped = threading.Event()
+        self.start_rss = self.peak_rss = self.rss()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = self.cpu()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop_sampling(self):
+        """Stops sampling, returning the peak RSS in bytes."""
+        self.stopped.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self.rss())
+        return self.peak_rss
+
+    def stop(self):
+        self.stop_sampling()
+        return {
+            "wall_s": round(time.perf_counter() - self.start_wall, 3),
+            "cpu_s": round(self.cpu() - self.start_cpu, 3),
+            "peak_rss_mb": round(self.peak_rss / MB, 1),
+        }
+
+
+@contextlib.contextmanager
+def phase(name, inputs=(), outputs=(), **details):
+    """
+    Measures a phase of the current task when PROFILE_ENV is set, recording
+    the sizes of its input and output paths and any details given.
+    """
+    profile_path = os.environ.get(PROFILE_ENV)
+    if profile_path is None:
+        yield
+        return
+    monitor = ResourceMonitor().start()
+    try:
+        yield
+    finally:
+        record = {"phase": name, **details, **monitor.stop()}
+        if inputs:
+            record["input_bytes"] = path_size(inputs)
+        if outputs:
+            record["output_bytes"] = path_size(outputs)
+        with open(profile_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_phases(profile_path):
+    if not os.path.exists(profile_path):
+        return []
+    with open(profile_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# (kind, output path, profiler) of the running capture
+_capture = None
+
+
+def start_capture():
+    """Starts the cProfile or tracemalloc capture requested by CAPTURE_ENV for this task."""
+    global _capture
+    kind = os.environ.get(CAPTURE_ENV)
+    profile_path = os.environ.get(PROFILE_ENV)
+    if kind is None or profile_path is None or _capture is not None:
+        return
+    # nested processes of a task write their own capture
+    capture_path = f"{os.path.splitext(profile_path)[0]}.{os.getpid()}"
+    profiler = None
+    if kind == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif kind == "tracemalloc":
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    else:
+        raise ValueError(f"Unknown capture {kind}, expected one of {CAPTURE_KINDS}")
+    _capture = (kind, capture_path, profiler)
+
+
+def stop_capture():
+    """Stops the running capture and writes <task>.<pid>.prof or <task>.<pid>.tracemalloc.txt."""
+    global _capture
+    if _capture is None:
+        return
+    kind, capture_path, profiler = _capture
+    _capture = None
+    if kind == "cprofile":
+        profiler.disable()
+        profiler.dump_stats(capture_path + ".prof")
+    else:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with open(capture_path + ".tracemalloc.txt", "w") as f:
+            f.write(f"peak traced memory: {peak / MB:.1f} MB\n")
+            for stat in snapshot.statistics("traceback")[:TRACEMALLOC_TOP]:
+                f.write(f"{stat}\n")
+                f.write("\n".join(stat.traceback.format()) + "\n\n")
+
+
+# a task started in a new process is captured from its first import of this module
+start_capture()
+atexit.register(stop_capture)
+
+
+@contextlib.contextmanager
+def profiled_task(env=None):
+    """
+    Runs a task in this process with the variables of env (PROFILE_ENV,
+    CAPTURE_ENV) set, yielding a dict filled with its resource usage on exit.
+    The peak RSS is that of the whole process, so its RSS at the start of the
+    task (the interpreter and whatever earlier tasks left) is recorded too, as
+    baseline_rss_mb.
+    """
+    orig_environ = dict(os.environ)
+    os.environ.update(env or {})
+    usage = {}
+    start_capture()
+    monitor = ResourceMonitor().start()
+    try:
+        yield usage
+    finally:
+        usage.update(monitor.stop(), baseline_rss_mb=round(monitor.start_rss / MB, 1))
+        stop_capture()
+        os.environ.clear()
+        os.environ.update(orig_environ)
+
+
+def write_profile(profile, profile_dir):
+    with open(os.path.join(profile_dir, PROFILE_NAME), "w") as f:
+        json.dump(profile, f, indent=4)
+
+
+def read_profile(profile_dir):
+    with open(os.path.join(profile_dir, PROFILE_NAME)) as f:
+        return json.load(f)
+
+
+def profile_table(profile):
+    """
+    Human-readable table of the tasks of a profile, slowest first, each followed
+    by its phases summed by name (peak RSS is the maximum).
+    """
+    rows = []
+    columns = ["wall_s", "cpu_s", "peak_rss_mb", "input_bytes", "output_bytes"]
+    tasks = sorted(profile["tasks"].items(), key=lambda item: -item[1].get("wall_s", 0))
+    for name, task in tasks:
+        status = "cached" if task.get("cached") else task.get("returncode")
+        rows.append({"task": name, "status": status, **{col: task.get(col) for col in columns}})
+        if not task.get("phases"):
+            continue
+        phases = pd.DataFrame(task["phases"]).reindex(columns=["phase"] + columns)
+        phases = phases.groupby("phase", sort=False).agg(
+            count=("phase", "size"),
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+            input_bytes=("input_bytes", lambda col: col.sum(min_count=1)),
+            output_bytes=("output_bytes", lambda col: col.sum(min_count=1)),
+        )
+        for phase_name, record in phases.iterrows():
+            label = f"  {phase_name}" + (f" (x{int(record['count'])})" if record["count"] > 1 else "")
+            rows.append({"task": label, "status": "", **record[columns].to_dict()})
+    df = pd.DataFrame(rows, columns=["task", "status"] + columns)
+    for col in ["input_bytes", "output_bytes"]:
+        df[col] = (df[col].astype(float) / MB).round(1)
+    df = df.rename(columns={"input_bytes": "input_mb", "output_bytes": "output_mb"})
+    df[["wall_s", "cpu_s"]] = df[["wall_s", "cpu_s"]].astype(float).round(3)
+    width = df["task"].str.len().max()
+    return df.to_string(index=False, na_rep="", formatters={"task": lambda task: task.ljust(width)})
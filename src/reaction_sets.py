@@ -0,0 +1,369 @@
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from pathlib import Path
+from logging_utils import get_logger
+from metabolome_store import contrast_columns
+from profiling import phase
+
+# Reaction sets: building the 9 reaction sets from the Human-GEM reactions
+# (used by preprocess-gem.py), reading the ones it wrote and their metabolite x
+# reaction incidence matrices, shared by the feature scripts.
+
+logger = get_logger('reaction_sets')
+
+def str_to_set(cell):
+    cell = ''.join(c for c in cell if c not in "'{}")
+    if(len(cell) == 0):
+        return set()
+    cell = set(cell.split(', '))
+    if('set()' in cell):
+        cell.remove('set()')
+    return cell
+
+def read_reaction_set(path):
+    react_set_df = pd.read_csv(path, sep='\t')
+    react_set_df['Measured_Substrate'] = react_set_df['Measured_Substrate'].apply(str_to_set)
+    react_set_df['Measured_Product'] = react_set_df['Measured_Product'].apply(str_to_set)
+    return react_set_df
+
+def read_met_to_id(valid_met_path):
+    id_df = pd.read_csv(valid_met_path, sep='\t')
+    return dict(zip(id_df.MET_ID, id_df.ID))
+
+def incidence_matrix(react_set_df, column, met_to_id, mets):
+    """Returns a sparse (metabolite x reaction) 0/1 matrix of the measured metabolites in column.
+
+    Rows follow mets (standard identifiers), columns follow the rows of react_set_df.
+    """
+    met_pos = {met: i for i, met in enumerate(mets)}
+    rows = []
+    cols = []
+    for j, met_set in enumerate(react_set_df[column]):
+        for met in met_set:
+            if(not met in met_to_id):
+                logger.warning('%s %s of %s has no identifier', column, met, react_set_df['RXN_ID'].iloc[j])
+            rows.append(met_pos[met_to_id[met]])
+            cols.append(j)
+    data = np.ones(len(rows))
+    return sp.csr_array((data, (rows, cols)), shape=(len(mets), len(react_set_df)))
+
+def pair_indices(react_set_df, met_to_id, mets):
+    """Returns (product, substrate, reaction) position arrays of every measured product-substrate pair."""
+    met_pos = {met: i for i, met in enumerate(mets)}
+    product_idx = []
+    substrate_idx = []
+    react_idx = []
+    for j, rxn in enumerate(react_set_df.itertuples(index=False)):
+        for p in rxn.Measured_Product:
+            for s in rxn.Measured_Substrate:
+                product_idx.append(met_pos[met_to_id[p]])
+                substrate_idx.append(met_pos[met_to_id[s]])
+                react_idx.append(j)
+    return np.array(product_idx, dtype=int), np.array(substrate_idx, dtype=int), np.array(react_idx, dtype=int)
+
+def read_changed_reactions(path):
+    """Reactions listed by preprocess-gem.py --incremental, with the IDs of their forward/backward splits."""
+    rxn_ids = set(pd.read_csv(path, sep='\t')['RXN_ID'])
+    return rxn_ids | {rxn_id + 'F' for rxn_id in rxn_ids} | {rxn_id + 'B' for rxn_id in rxn_ids}
+
+def hash_path(out_path):
+    """Path of the input hashes written next to a reaction feature .tsv."""
+    return str(Path(out_path).with_suffix('')) + '.hash.tsv'
+
+def input_hashes(changes, mets, react_set_df, met_to_id, react_ids):
+    """Hash of the inputs of every reaction in react_ids.
+
+    Covers the measured substrates and products of the reaction and their
+    columns of the (sample x contrast x metabolite) change tensor, so a
+    reaction hashes differently whenever its features would.
+    """
+    met_pos = {met: i for i, met in enumerate(mets)}
+    hashes = {}
+    for rxn in react_set_df[react_set_df['RXN_ID'].isin(react_ids)].itertuples(index=False):
+        digest = hashlib.sha256()
+        for met_set in (rxn.Measured_Substrate, rxn.Measured_Product):
+            ids = sorted(met_to_id[met] for met in met_set)
+            digest.update(repr(ids).encode())
+            digest.update(np.ascontiguousarray(changes[:, :, [met_pos[i] for i in ids]]).tobytes())
+        hashes[rxn.RXN_ID] = digest.hexdigest()
+    return hashes
+
+def write_input_hashes(hashes, out_path):
+    pd.DataFrame(list(hashes.items()), columns=['RXN_ID', 'Hash']).to_csv(hash_path(out_path), sep='\t', index=False)
+
+def read_input_hashes(out_path):
+    path = hash_path(out_path)
+    if(not Path(path).exists()):
+        return {}
+    hash_df = pd.read_csv(path, sep='\t')
+    return dict(zip(hash_df.RXN_ID, hash_df.Hash))
+
+def reusable_columns(out_path, react_ids, changed, samples, contrasts, hashes):
+    """Columns of a previous reaction feature .tsv that can be reused as is.
+
+    A reaction is reusable if it is not in changed, its input hash in hashes
+    matches the one written with the previous output and all its contrast
+    columns exist there. The previous output must cover the same samples.
+    Returns the reusable reaction IDs and their columns as a DataFrame.
+    """
+    if(not Path(out_path).exists()):
+        return [], pd.DataFrame(index=samples)
+    previous = pd.read_csv(out_path, sep='\t', index_col=0)
+    if(not previous.index.equals(samples)):
+        return [], pd.DataFrame(index=samples)
+    # every rerun of preprocess-metabolome.py re-imputes the missing values,
+    # so an unchanged reaction can still have new inputs
+    previous_hashes = read_input_hashes(out_path)
+    reused_ids = []
+    columns = []
+    for rxn_id in react_ids:
+        rxn_columns = contrast_columns([rxn_id], contrasts)
+        if(rxn_id not in changed and rxn_id in previous_hashes and previous_hashes[rxn_id] == hashes[rxn_id]
+           and all(col in previous.columns for col in rxn_columns)):
+            reused_ids.append(rxn_id)
+            columns += rxn_columns
+    return reused_ids, previous[columns]
+
+def extract_metabolites(eqn):
+    old = eqn.split(' + ')
+    new = set()
+    for i_old in old:
+        i_old_split = i_old.split(' ')
+        if(len(i_old_split)>1):
+            if(i_old_split[0].replace(".", "").isnumeric()): # If a metabolite   a coefficient in reaction equation
+                i_new = i_old[len(i_old_split[0])+1:]
+                new.add(i_new)
+            else:
+                new.add(i_old)
+        else:
+            new.add(i_old)
+    logger.debug('%s -> %s', eqn, new)
+    return new
+            
+
+def measure_reactions(react_gem, valid_mets):
+    react_gem['Measured_Substrate'] = react_gem['Substrate_Set'].apply(lambda x: x.intersection(valid_mets))
+    react_gem['Measured_Product'] = react_gem['Product_Set'].apply(lambda x: x.intersection(valid_mets))
+    react_gem['Measured_Metabolite'] = react_gem['Metabolite_Set'].apply(lambda x: x.intersection(valid_mets))
+
+    react_gem['Measured_Substrate_Count'] = react_gem['Measured_Substrate'].apply(lambda x: len(x))
+    react_gem['Measured_Product_Count'] = react_gem['Measured_Product'].apply(lambda x: len(x))
+    react_gem['Measured_Metabolite_Count'] = react_gem['Measured_Metabolite'].apply(lambda x: len(x))
+    return react_gem
+
+def parse_reactions(gem_path):
+    with phase('xlsx parse', inputs=[gem_path]):
+        react_gem = pd.read_excel(gem_path, sheet_name='RXNS', usecols=['ID', 'EQUATION', 'SUBSYSTEM'])
+    react_gem = react_gem.rename(columns={'ID': 'RXN_ID'})
+    
+    pattern = '|'.join(['\[e\]', '\[x\]', '\[m\]', '\[c\]', '\[l\]', '\[r\]', '\[g\]', '\[n\]', '\[i\]'])
+    react_gem['EQUATION'] = react_gem['EQUATION'].str.replace(pattern, '', regex=True)
+    react_gem['Direction'] = react_gem['EQUATION'].apply(lambda x: 2 if '<=>' in x else 1)
+    react_gem['EQUATION'] = react_gem['EQUATION'].str.replace('<=>', '=>')
+    react_gem[['EQUATION_LHS', 'EQUATION_RHS']] = react_gem['EQUATION'].str.split(' => ', expand=True)
+    react_gem['Substrate_Set'] = react_gem['EQUATION_LHS'].apply(lambda x: extract_metabolites(x))
+    react_gem['Product_Set'] = react_gem['EQUATION_RHS'].apply(lambda x: extract_metabolites(x))
+    react_gem['Metabolite_Set'] = react_gem.apply(lambda x: x['Product_Set'].union(x['Substrate_Set']), axis=1)
+    logger.info('%d reactions (%d reversible) over %d metabolites parsed from %s', len(react_gem),
+                (react_gem['Direction'] == 2).sum(), len(set().union(*react_gem['Metabolite_Set'])), gem_path)
+
+    react_gem['Substrate_Count'] = react_gem['Substrate_Set'].apply(lambda x: len(x))
+    react_gem['Product_Count'] = react_gem['Product_Set'].apply(lambda x: len(x))
+    react_gem['Metabolite_Count'] = react_gem['Metabolite_Set'].apply(lambda x: len(x))
+    return react_gem
+
+def metabolite_index(react_gem):
+    """Inverted index of every gem metabolite to the positions of the reactions it takes part in."""
+    index = {}
+    for pos, mets in enumerate(react_gem['Metabolite_Set']):
+        for met in mets:
+            index.setdefault(met, []).append(pos)
+    return index
+
+def react_set_1(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_gem = react_gem[react_gem['Direction'] == 1]
+    one_more_mets_in = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
+    return one_more_mets_in, None
+    
+def react_set_2(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_gem = react_gem[react_gem['Direction'] == 1]
+    one_more_mets_in = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
+    return one_more_mets_in, None
+    
+def reverse_equation(eqn):
+    eqn_split = eqn.split(' => ')
+    if(len(eqn_split) != 2):
+        logger.warning('Cannot reverse equation %s', eqn)
+    new_eqn = eqn_split[1] + ' => ' + eqn_split[0]
+    #print(eqn, eqn_split, new_eqn)
+    return new_eqn
+
+def react_set_3(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
+    basic_df = react_df
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+    react3_df = react2_df.copy()
+    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
+    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
+
+
+
+
+    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
+    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
+    #swapping columns
+    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
+    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
+    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
+    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
+    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
+
+
+    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
+    return react_df, basic_df
+    
+
+def react_set_4(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
+    basic_df = react_df
+
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+    react3_df = react2_df.copy()
+
+    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
+    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
+
+    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
+    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
+    #swapping columns
+    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
+    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
+    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
+    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
+    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
+
+
+    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
+    return react_df, basic_df
+    
+def react_set_5(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 0]
+    basic_df = react_df
+
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+
+    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
+    react2_df['Product_Set'] = react2_df['Metabolite_Set']
+
+    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
+    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
+
+    react_df = pd.concat([react1_df, react2_df], axis=0)
+
+    return react_df, basic_df
+    
+def react_set_6(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[(react_gem['Measured_Substrate_Count'] > 0) & (react_gem['Measured_Product_Count'] > 0)]
+    basic_df = react_df
+
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+
+    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
+    react2_df['Product_Set'] = react2_df['Metabolite_Set']
+
+    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
+    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
+
+    react_df = pd.concat([react1_df, react2_df], axis=0)
+    return react_df, basic_df
+
+def react_set_7(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_gem = react_gem[react_gem['Direction'] == 1]
+    two_more_mets_in = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
+    return two_more_mets_in, None
+    
+def react_set_8(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
+    basic_df = react_df
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+    react3_df = react2_df.copy()
+    react2_df['RXN_ID'] = react2_df['RXN_ID'] + 'F'
+    react2_df['EQUATION'] = react2_df['EQUATION'].str.replace('<=>','=>')
+
+
+
+
+    react3_df['EQUATION'] = react3_df['EQUATION'].apply(lambda x: reverse_equation(x))
+    react3_df['RXN_ID'] = react3_df['RXN_ID'] + 'B'
+    #swapping columns
+    react3_df[['EQUATION_LHS', 'EQUATION_RHS']] = react3_df[['EQUATION_RHS', 'EQUATION_LHS']]
+    react3_df[['Substrate_Set', 'Product_Set']] = react3_df[['Product_Set', 'Substrate_Set']]
+    react3_df[['Substrate_Count', 'Product_Count']] = react3_df[['Product_Count', 'Substrate_Count']]
+    react3_df[['Measured_Substrate', 'Measured_Product']] = react3_df[['Measured_Product', 'Measured_Substrate']]
+    react3_df[['Measured_Substrate_Count', 'Measured_Product_Count']] = react3_df[['Measured_Product_Count', 'Measured_Substrate_Count']]
+
+
+    react_df = pd.concat([react1_df, react2_df, react3_df], axis=0)
+    return react_df, basic_df
+    
+def react_set_9(react_gem):
+    react_gem = react_gem[~react_gem['SUBSYSTEM'].isin(['Transport reactions', 'Exchange/demand reactions'])]
+    react_df = react_gem[react_gem['Measured_Metabolite_Count'] > 1]
+    basic_df = react_df
+
+    react1_df = react_df[react_df.Direction == 1]
+    react2_df = react_df[react_df.Direction == 2]
+
+    react2_df['Substrate_Set'] = react2_df['Metabolite_Set']
+    react2_df['Product_Set'] = react2_df['Metabolite_Set']
+
+    react2_df['Measured_Substrate'] = react2_df['Measured_Metabolite']
+    react2_df['Measured_Product'] = react2_df['Measured_Metabolite']
+
+    react_df = pd.concat([react1_df, react2_df], axis=0)
+
+    return react_df, basic_df
+
+def build_reaction_sets(react_gem):
+    """Filters the measured reactions into the 9 reaction sets.
+
+    Returns a dict of set number -> (reaction set, basic set before the
+    reversible reactions are split or None).
+    """
+    builders = [react_set_1, react_set_2, react_set_3, react_set_4, react_set_5,
+                react_set_6, react_set_7, react_set_8, react_set_9]
+    react_sets = {react_set_no: builder(react_gem) for react_set_no, builder in enumerate(builders, start=1)}
+    for react_set_no, (react_set_df, basic_df) in react_sets.items():
+        if(basic_df is None):
+            logger.info('reaction set %d: %d reactions', react_set_no, len(react_set_df))
+        else:
+            logger.info('reaction set %d: %d reactions from %d before splitting reversible ones',
+                        react_set_no, len(react_set_df), len(basic_df))
+    return react_sets
+
+def write_reaction_sets(react_sets, out_dir):
+    for react_set_no, (react_set_df, basic_df) in react_sets.items():
+        react_set_dir = out_dir + '/reaction-set-' + str(react_set_no)
+        Path(react_set_dir).mkdir(parents=True, exist_ok=True)
+        if(basic_df is not None):
+            basic_df.to_csv(react_set_dir + '/reaction-set-' + str(react_set_no) + '-basic.tsv', sep='\t', index=False)
+        react_set_df.to_csv(react_set_dir + '/reaction-set-' + str(react_set_no) + '.tsv', sep='\t', index=False)
+
+def reaction_set_frame(react_set_df):
+    """In-memory counterpart of read_reaction_set for a reaction set of build_reaction_sets."""
+    return react_set_df.reset_index(drop=True)
@@ -0,0 +1,242 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import pathlib
+import sys
+import numpy as np
+import pandas as pd
+from logging_utils import get_logger, log_to
+
+# Figures of a run, rendered from its numeric artifacts.
+# The classification writes <case>.<control>.feature-importance.csv and
+# .top-features.tsv (the samples of its 10 most important features with their
+# group), the summaries write <prefix>.json; the figures are drawn from those
+# files, by the stages themselves or, when they ran with --no_plots, later by
+# "python report.py --in_dir <out_dir>" on a pool of processes. matplotlib and
+# seaborn are only imported to draw, so the numeric stages never pay for them.
+
+PERFORMANCE_SUFFIX = ".classifier_performance.json"
+IMPORTANCE_SUFFIX = ".feature-importance.csv"
+TOP_FEATURES_SUFFIX = ".top-features.tsv"
+# features of a classification drawn as boxplots
+TOP_FEATURES = 10
+
+SUMMARY_TITLES = {
+    "reaction": "Benchmark: Reaction features only",
+    "metabolite+reaction": "Benchmark: Reaction and metabolite features together",
+}
+STUDY_TITLES = {
+    "reaction": "AUROC across studies: Reaction features only",
+    "metabolite+reaction": "AUROC across studies: Reaction and metabolite features together",
+}
+LEARNER_TITLES = {
+    "reaction": "AUROC by learner: Reaction features only",
+    "metabolite+reaction": "AUROC by learner: Reaction and metabolite features together",
+}
+# side-by-side summary of the learners of a study (summarize_performance.py --learners)
+LEARNERS_SUFFIX = ".learners"
+# bootstrap intervals and permutation p-values of the metrics of a summary,
+# a "<Metric> low", "<Metric> high" and "<Metric> p-value" row per metric
+INTERVALS_SUFFIX = ".intervals"
+
+logger = get_logger("report")
+
+
+def pyplot():
+    """matplotlib.pyplot and seaborn, imported on the first figure."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    return plt, sns
+
+
+def plot_classification(prefix, case):
+    """Draws the feature importances and the boxplots of the top features of a classification."""
+    plt, sns = pyplot()
+    importances = pd.read_csv(prefix + IMPORTANCE_SUFFIX)
+    plt.figure(figsize=(5, 5))
+    plt.title(case + "Feature Importances")
+    plt.xlabel("Feature #")
+    plt.ylabel("Feature Importance")
+    plt.plot(importances["Importance"].to_numpy())
+    plt.savefig(prefix + ".feature-importance.png")
+    plt.close()
+
+    top_features = pd.read_csv(prefix + TOP_FEATURES_SUFFIX, sep="\t", index_col=0)
+    for feature in top_features.columns.drop("group"):
+        fig, ax = plt.subplots(figsize=(5, 5))
+        sns.boxplot(data=top_features, x="group", y=feature, linewidth=2.5, width=0.4, ax=ax)
+        ax.set_xlabel("Treatment group")
+        ax.set_ylabel("Relative concentration")
+        fig.suptitle(feature, size=22)
+        fig.savefig(prefix + "." + feature + ".boxplot.png", bbox_inches="tight")
+        plt.close(fig)
+
+
+def plot_heatmap(plot_df, path, title, ylabel, height, annot=None):
+    plt, sns = pyplot()
+    # the cells labelled with an interval need the room of its text
+    cell_width = 0.6 if annot is None else 0.9
+    plt.figure(figsize=(max(8, len(plot_df.columns) * cell_width), height))
+    ax = sns.heatmap(
+        plot_df,
+        annot=True if annot is None else annot,
+        fmt=".2f" if annot is None else "",
+        annot_kws={} if annot is None else {"size": 6},
+        cmap="coolwarm",
+        cbar=True,
+        linewidths=0.5,
+        linecolor="white",
+    )
+    ax.set_title(title)
+    ax.set_xlabel("Feature configuration")
+    ax.set_ylabel(ylabel)
+    plt.xticks(rotation=45, ha="right")
+    plt.tight_layout()
+    plt.savefig(path, dpi=300)
+    plt.close()
+
+
+def interval_annotations(summary_df, intervals_df):
+    """Cell labels of a summary heatmap: every metric with its interval and permutation p-value."""
+    annot = []
+    for metric, values in summary_df.iterrows():
+        low, high, p_value = [intervals_df.loc[f"{metric} {row}"].to_numpy() for row in ["low", "high", "p-value"]]
+        annot.append([f"{v:.2f}\n[{lo:.2f}, {hi:.2f}]\np={p:.3g}" for v, lo, hi, p in zip(values, low, high, p_value)])
+    return np.array(annot)
+
+
+def plot_summary(summary_df, out_dir, prefix):
+    """
+    Heatmap of the metrics of a study summary (summarize_performance.py),
+    with their intervals and p-values when <prefix>.intervals.json exists.
+    """
+    plot_df = summary_df.copy()
+    plot_df.columns = [
+        f"{col[0]} | {col[1]}" if isinstance(col, tuple) else str(col) for col in plot_df.columns
+    ]
+    intervals_path = os.path.join(out_dir, f"{prefix}{INTERVALS_SUFFIX}.json")
+    if os.path.exists(intervals_path):
+        annot = interval_annotations(summary_df, read_summary(intervals_path))
+        plot_heatmap(plot_df, os.path.join(out_dir, f"{prefix}.png"), SUMMARY_TITLES[prefix], "Metric", 6.5, annot)
+    else:
+        plot_heatmap(plot_df, os.path.join(out_dir, f"{prefix}.png"), SUMMARY_TITLES[prefix], "Metric", 4.5)
+
+
+def plot_auroc_rows(summary_df, path, title):
+    """Heatmap of the AUROC of a summary with a row per (study or learner, metric)."""
+    plot_df = summary_df.xs("AUROC", level="Metric")
+    plot_df.columns = [f"{col[0]} | {col[1]}" for col in plot_df.columns]
+    height = max(3, len(plot_df) * 0.6 + 1.5)
+    plot_heatmap(plot_df, path, title, summary_df.index.names[0], height)
+
+
+def plot_study_summary(summary_df, out_dir, prefix):
+    """Heatmap of the AUROC of every study of a cross-study summary (summarize_studies.py)."""
+    plot_auroc_rows(summary_df, os.path.join(out_dir, f"{prefix}.png"), STUDY_TITLES[prefix])
+
+
+def plot_learner_summary(summary_df, out_dir, prefix):
+    """Heatmap of the AUROC of every learner of a study (summarize_performance.py --learners)."""
+    plot_auroc_rows(summary_df, os.path.join(out_dir, f"{prefix}{LEARNERS_SUFFIX}.png"), LEARNER_TITLES[prefix])
+
+
+def read_summary(json_path):
+    """A summary table written as json by summarize_performance.py or summarize_studies.py."""
+    with open(json_path) as json_file:
+        payload = json.load(json_file)
+    columns = pd.MultiIndex.from_tuples(
+        [tuple(str(c) for c in col) for col in payload["columns"]], names=["Reaction set", "Feature"]
+    )
+    index = payload["index"]
+    # the cross-study and learner summaries have a row per (study or learner, metric)
+    if index and isinstance(index[0], list):
+        level = "Learner" if json_path.endswith(LEARNERS_SUFFIX + ".json") else "Study"
+        index = pd.MultiIndex.from_tuples([tuple(row) for row in index], names=[level, "Metric"])
+    return pd.DataFrame(payload["data"], index=index, columns=columns)
+
+
+def render(kind, path):
+    """Draws the figures of one classification prefix or one summary json; the task of a report worker."""
+    if kind == "classification":
+        with open(path + PERFORMANCE_SUFFIX) as f:
+            case = json.load(f)["case"]
+        plot_classification(path, case)
+    else:
+        out_dir, name = os.path.split(path)
+        prefix = name[: -len(".json")]
+        summary_df = read_summary(path)
+        if prefix.endswith(LEARNERS_SUFFIX):
+            plot_learner_summary(summary_df, out_dir, prefix[: -len(LEARNERS_SUFFIX)])
+        elif isinstance(summary_df.index, pd.MultiIndex):
+            plot_study_summary(summary_df, out_dir, prefix)
+        else:
+            plot_summary(summary_df, out_dir, prefix)
+
+
+def figure_tasks(in_dir):
+    """(kind, path) of every classification and summary under in_dir."""
+    tasks = []
+    for path in sorted(pathlib.Path(in_dir).rglob("*" + PERFORMANCE_SUFFIX)):
+        prefix = str(path)[: -len(PERFORMANCE_SUFFIX)]
+        if os.path.exists(prefix + TOP_FEATURES_SUFFIX):
+            tasks.append(("classification", prefix))
+    for prefix in SUMMARY_TITLES:
+        for name in [prefix, prefix + LEARNERS_SUFFIX]:
+            for path in sorted(pathlib.Path(in_dir).rglob(name + ".json")):
+                if path.parent.name == "summary":
+                    tasks.append(("summary", str(path)))
+    return tasks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Renders the figures of a run from its numeric outputs, e.g. after pipeline.py --no_plots."
+    )
+    parser.add_argument(
+        "--in_dir",
+        type=str,
+        help="output directory of a pipeline, batch or classification run",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes drawing the figures (default: number of cpus)",
+        required=False,
+        default=os.cpu_count(),
+    )
+    parser.add_argument("--log_path", type=str, help="path to log file", required=True, default=None)
+    return parser.parse_args()
+
+
+def main(args):
+    with log_to(args.log_path):
+        tasks = figure_tasks(args.in_dir)
+        logger.info("%d classifications and summaries to draw on %d workers", len(tasks), args.workers)
+        failed = 0
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        with executor:
+            futures = {executor.submit(render, kind, path): path for kind, path in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    logger.debug("Drew %s", futures[future])
+                except Exception:
+                    failed += 1
+                    logger.exception("Failed to draw %s", futures[future])
+        logger.info("%d of %d drawn", len(tasks) - failed, len(tasks))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import pathlib
+import sys
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+from logging_utils import get_logger, log_to
+
+# Uncertainty of the reported metrics, from the held-out class probabilities.
+# The held-out (LOO, k-fold or out-of-bag) probabilities of a classification
+# are resampled instead of refitting anything: N_BOOTSTRAP resamples of the
+# samples with replacement give percentile confidence intervals of the
+# accuracy, AUROC and AUPRC, and N_PERMUTATIONS permutations of the labels
+# give the p-value of each against no association, (1 + #{permuted >=
+# observed}) / (1 + N_PERMUTATIONS). All resamples are scored at once as
+# (resamples x samples) arrays: the AUROC from the rank sums of the positives
+# (Mann-Whitney U, ties averaged), the AUPRC as the step-wise average
+# precision over the distinct scores, both equal to the sklearn metrics. The
+# resamples are seeded, so the results are reproducible.
+# The classifications record them under "resampling" in their performance
+# json; "python resampling.py --in_dir <classification dir>" recomputes them
+# for the outputs of an earlier run, from the predictions and the labels of
+# <prefix>.top-features.tsv.
+
+N_BOOTSTRAP = 2000
+N_PERMUTATIONS = 2000
+CONFIDENCE = 0.95
+RESAMPLING_SEED = 1
+# resampled values scored at once, bounding the memory of large studies
+CHUNK_VALUES = 10_000_000
+METRICS = ["accuracy", "auroc", "auprc"]
+
+logger = get_logger("resampling")
+
+
+def auroc(labels, scores):
+    """AUROC of every row of labels (resamples x samples, bool) against the scores of the same shape."""
+    ranks = rankdata(scores, axis=1)
+    n_pos = labels.sum(axis=1)
+    n_neg = labels.shape[1] - n_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ((ranks * labels).sum(axis=1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def auprc(labels, scores):
+    """Average precision of every row of labels against the scores, with a step per distinct score."""
+    order = np.argsort(-scores, axis=1, kind="stable")
+    labels = np.take_along_axis(labels, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    true_pos = np.cumsum(labels, axis=1)
+    precision = true_pos / np.arange(1, labels.shape[1] + 1)
+    # a threshold ends at the last sample of every run of tied scores
+    ends = np.ones(labels.shape, dtype=bool)
+    ends[:, :-1] = scores[:, :-1] != scores[:, 1:]
+    end_pos = np.where(ends, true_pos, 0)
+    previous = np.zeros(labels.shape)
+    previous[:, 1:] = np.maximum.accumulate(end_pos, axis=1)[:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (ends * (true_pos - previous) * precision).sum(axis=1) / labels.sum(axis=1)
+
+
+def score(labels, scores, predicted):
+    """Accuracy, AUROC and AUPRC of every row of labels."""
+    return {
+        "accuracy": (labels == predicted).mean(axis=1),
+        "auroc": auroc(labels, scores),
+        "auprc": auprc(labels, scores),
+    }
+
+
+def resampled(n_samples, draw, n_resamples):
+    """The metrics of n_resamples (labels, scores, predictions) of n_samples, drawn in chunks by draw(rng, rows)."""
+    rng = np.random.default_rng(RESAMPLING_SEED)
+    rows = max(1, CHUNK_VALUES // n_samples)
+    chunks = []
+    for start in range(0, n_resamples, rows):
+        chunks.append(score(*draw(rng, min(rows, n_resamples - start))))
+    return {metric: np.concatenate([chunk[metric] for chunk in chunks]) for metric in METRICS}
+
+
+def resample_metrics(y_true, y_proba, n_bootstrap=N_BOOTSTRAP, n_permutations=N_PERMUTATIONS):
+    """
+    Bootstrap confidence intervals and permutation p-values of the accuracy,
+    AUROC and AUPRC of the held-out probabilities y_proba ([control, case])
+    of the samples labelled y_true (1 for the case).
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    scores = np.asarray(y_proba)[:, 1]
+    predicted = np.asarray(y_proba).argmax(axis=1).astype(bool)
+    observed = {metric: values[0] for metric, values in score(y_true[None], scores[None], predicted[None]).items()}
+
+    def bootstrap(rng, rows):
+        idx = rng.integers(0, len(y_true), size=(rows, len(y_true)))
+        return y_true[idx], scores[idx], predicted[idx]
+
+    def permutation(rng, rows):
+        labels = rng.permuted(np.broadcast_to(y_true, (rows, len(y_true))), axis=1)
+        return labels, np.broadcast_to(scores, labels.shape), predicted[None]
+
+    bootstrapped = resampled(len(y_true), bootstrap, n_bootstrap)
+    permuted = resampled(len(y_true), permutation, n_permutations)
+    tail = (1 - CONFIDENCE) / 2 * 100
+    record = {"bootstrap": n_bootstrap, "permutations": n_permutations, "confidence": CONFIDENCE}
+    for metric in METRICS:
+        # a resample of a single class has no AUROC or AUPRC
+        values = bootstrapped[metric][np.isfinite(bootstrapped[metric])]
+        low, high = np.percentile(values, [tail, 100 - tail])
+        p_value = (1 + np.sum(permuted[metric] >= observed[metric] - 1e-12)) / (1 + n_permutations)
+        record[metric] = {"ci": [round(float(low), 3), round(float(high), 3)], "p_value": round(float(p_value), 4)}
+    return record
+
+
+def resample_outputs(prefix, case=None):
+    """
+    Recomputes the resampling record of the classification outputs <prefix>.*
+    from its predictions. The case group is the one recorded in the
+    performance json, or case for outputs written before it was.
+    """
+    performance_path = prefix + ".classifier_performance.json"
+    with open(performance_path) as f:
+        performance = json.load(f)
+    case = performance.get("case", case)
+    if case is None:
+        raise ValueError(f"{performance_path} records no case group, pass it with --case")
+    labels = pd.read_csv(prefix + ".top-features.tsv", sep="\t", index_col=0)["group"]
+    y_true = (labels == case).to_numpy()
+    y_proba = np.loadtxt(prefix + ".classifier_prediction.tsv", delimiter="\t", ndmin=2)
+    performance["resampling"] = resample_metrics(y_true, y_proba)
+    with open(performance_path, "w") as f:
+        json.dump(performance, f)
+    return performance["resampling"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Recomputes the bootstrap intervals and permutation p-values of the classifications of a run "
+        + "from their saved held-out probabilities."
+    )
+    parser.add_argument("--in_dir", type=str, help="classification output directory", required=True, default=None)
+    parser.add_argument("--log_path", type=str, help="path to log file", required=True, default=None)
+    parser.add_argument("--case", type=str,
+                        help="name of the case group, for performance jsons that do not record it",
+                        required=False, default=None)
+    return parser.parse_args()
+
+
+def main(args):
+    with log_to(args.log_path):
+        failed = 0
+        paths = sorted(pathlib.Path(args.in_dir).rglob("*.classifier_performance.json"))
+        for path in paths:
+            prefix = str(path)[: -len(".classifier_performance.json")]
+            try:
+                record = resample_outputs(prefix, args.case)
+                logger.info("%s: AUROC %s, p = %s", os.path.relpath(prefix, args.in_dir),
+                            record["auroc"]["ci"], record["auroc"]["p_value"])
+            except Exception:
+                failed += 1
+                logger.exception("Failed to resample %s", prefix)
+        logger.info("%d of %d classifications resampled", len(paths) - failed, len(paths))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,126 @@
+import contextlib
+import os
+import psutil
+from classification import forests_held
+from evaluation import evaluation_mode
+from feature_store import matrix_shape
+from metabolome_store import read_metadata, read_registry
+from profiling import MB, path_size, read_profile
+from reaction_sets import read_reaction_set
+
+# Memory estimates of the pipeline tasks, used by the task graph to admit
+# tasks under a memory budget. An estimate is computed when its task becomes
+# ready, from the inputs written by the tasks it depends on; the peak RSS the
+# same task reached in the previous run's profile takes precedence. A task run
+# by a warm worker only counts the RSS it added to the worker.
+
+# resident size of a python process with the scientific stack imported
+BASE_MB = 160
+# networkx DiGraph storage per node and per weighted edge
+GRAPH_NODE_BYTES = 600
+GRAPH_EDGE_BYTES = 250
+# sklearn tree storage per node
+TREE_NODE_BYTES = 100
+# working copies of a feature matrix (a combined matrix, fold copies); the
+# float32 matrices of feature_store are mapped, not parsed
+MATRIX_COPIES = 2
+VALUE_BYTES = 4
+# resident bytes per input byte of the tasks without a specific estimate
+INPUT_FACTOR = 3
+# trees per forest of classification.py
+N_ESTIMATORS = 200
+
+# default memory budget, as a fraction of the total memory
+MEMORY_FRACTION = 0.9
+
+
+def default_memory_budget():
+    return psutil.virtual_memory().total * MEMORY_FRACTION / MB
+
+
+def children_rss_mb():
+    """Live RSS of the processes started by this process, directly or not."""
+    rss = 0
+    for child in psutil.Process().children(recursive=True):
+        with contextlib.suppress(psutil.Error):
+            rss += child.memory_info().rss
+    return rss / MB
+
+
+def input_memory(paths):
+    return BASE_MB + INPUT_FACTOR * path_size(paths) / MB
+
+
+def network_size(n_samples, n_mets, react_set_df):
+    """
+    (nodes, edges) of the prob network of one contrast: a node per sample, two
+    per metabolite and one per reaction, an edge per sample and metabolite in
+    both directions and two per measured substrate or product of every reaction.
+    """
+    n_nodes = n_samples + 2 * n_mets + len(react_set_df)
+    n_measured = sum(map(len, react_set_df["Measured_Substrate"])) + sum(
+        map(len, react_set_df["Measured_Product"])
+    )
+    n_edges = 2 * n_samples * n_mets + 2 * n_measured
+    return n_nodes, n_edges
+
+
+def network_memory(n_samples, n_nodes, n_edges, n_contrasts):
+    """Memory of a prob task: the network of every contrast and its (sample x node) probabilities."""
+    graph_bytes = n_nodes * GRAPH_NODE_BYTES + n_edges * GRAPH_EDGE_BYTES + n_samples * n_nodes * 8
+    return BASE_MB + n_contrasts * graph_bytes / MB
+
+
+def graph_memory(react_set_path, met_store_path):
+    """network_memory of the prob task of a reaction set, from the store and the reaction set file."""
+    metadata = read_metadata(met_store_path)
+    n_samples = len(read_registry(met_store_path))
+    react_set_df = read_reaction_set(react_set_path)
+    n_nodes, n_edges = network_size(n_samples, len(metadata["name_to_id"]), react_set_df)
+    return network_memory(n_samples, n_nodes, n_edges, len(metadata["contrasts"]))
+
+
+def forest_memory(n_rows, n_cols, n_forests=None):
+    """
+    Memory of classifying an (n_rows x n_cols) feature matrix: the matrix copies
+    and the n_forests forests held at once (by default one per LOO fold and the
+    best one), with up to 2 * n_rows nodes per tree.
+    """
+    if n_forests is None:
+        n_forests = n_rows + 1
+    matrix_bytes = MATRIX_COPIES * n_rows * n_cols * VALUE_BYTES
+    forest_bytes = n_forests * N_ESTIMATORS * 2 * n_rows * TREE_NODE_BYTES
+    return BASE_MB + (matrix_bytes + forest_bytes) / MB
+
+
+def classification_memory(feature_paths, jobs=1, evaluation="auto", search="grid", workers=1):
+    """
+    Memory of run_classification.py, whose workers classify the feature
+    matrices one after the other: per worker, an interpreter and the largest
+    of them, plus an interpreter per additional process fitting folds.
+    """
+    shapes = [matrix_shape(path) for path in feature_paths if os.path.exists(path)]
+    # the evaluation is chosen once for every matrix, by the largest of them
+    mode = evaluation_mode(max([n_rows for n_rows, _ in shapes], default=0), evaluation, search)
+    memory = [forest_memory(n_rows, n_cols, forests_held(n_rows, mode, search)) for n_rows, n_cols in shapes]
+    return workers * (BASE_MB * jobs + max(memory, default=BASE_MB))
+
+
+def profile_history(profile_dir):
+    """
+    Peak RSS in MB of every task executed by the run profiled in profile_dir.
+    The peak of a task run in a long-lived interpreter includes the imports
+    and leftovers of earlier tasks: only the RSS it reached above its
+    baseline counts, on top of a fresh interpreter.
+    """
+    if not os.path.exists(os.path.join(profile_dir, "profile.json")):
+        return {}
+    tasks = read_profile(profile_dir)["tasks"]
+    history = {}
+    for name, task in tasks.items():
+        if task.get("cached") or "peak_rss_mb" not in task:
+            continue
+        history[name] = task["peak_rss_mb"]
+        if "baseline_rss_mb" in task:
+            history[name] = BASE_MB + max(task["peak_rss_mb"] - task["baseline_rss_mb"], 0)
+    return history
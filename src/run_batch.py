@@ -0,0 +1,460 @@
+import argparse
+import os
+import pathlib
+import sys
+import pandas as pd
+from classification import CV_BACKENDS, SEARCHES
+from evaluation import EVALUATIONS
+from learner_names import LEARNERS
+from logging_utils import LOG_LEVEL_ENV, LOG_LEVELS
+from pipeline import add_feature_tasks, add_preprocess_task
+from profiling import CAPTURE_KINDS, profile_table, read_profile
+from task_graph import add_task, run_tasks
+from work_queue import wait_queue, write_queue
+from worker_pool import task_executor
+
+# Batch mode: runs the pipeline for several studies in one task graph.
+# Human-GEM is parsed once and reaction sets are built once per distinct set
+# of gem-overlapped metabolites, then the features and classifications of all
+# studies share a single worker pool. The per-study summaries are combined
+# into one cross-study summary.
+
+STUDY_COLUMNS = ["study", "base_path", "end_path", "case", "control"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Runs the pipeline for every study of a manifest, sharing the Human-GEM preprocessing, and summarizes all studies together."
+    )
+
+    parser.add_argument(
+        "--studies_path",
+        type=str,
+        help="manifest of studies in tsv format, with columns " + ", ".join(STUDY_COLUMNS),
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--missing_pct",
+        type=float,
+        help="threshold of missing value percentage for dropping columns",
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--user_met_id_path",
+        type=str,
+        help="path to list of user metabolites (columns in the study metabolomics) with standard identifiers in tsv format",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--user_met_name_col",
+        type=str,
+        help="which column in user_met_id_path contains the metabolite names",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--user_met_id_col",
+        type=str,
+        help="which column in user_met_id_path contains the metabolite standard identifiers",
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--gem_path",
+        type=str,
+        help="path to a gem model in .xlsx format",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--gem_met_id_path",
+        type=str,
+        help="path to list of human gem metabolites with standard identifiers list in tsv format",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--gem_met_id_col",
+        type=str,
+        help="which column in gem_met_id_path contains the metabolite standard identifiers",
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        help="Parameter alpha for RWR algorithm",
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of tasks run in parallel across all studies (default: number of cpus)",
+        required=False,
+        default=os.cpu_count(),
+    )
+
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        help="memory in MB the parallel tasks may use together, the largest tasks starting first "
+        + "(default: 90%% of the memory)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--cpu_budget",
+        type=int,
+        help="cpus the parallel tasks may use together (default: workers)",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--classification_jobs",
+        type=int,
+        help="number of cores the LOO folds of every classification are fitted on; the classification task "
+        + "counts as that many cpus against --cpu_budget (default: 1)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--classification_workers",
+        type=int,
+        help="number of processes classifying the feature matrices, each fitting on --classification_jobs "
+        + "cores; the classification task counts as workers x jobs cpus (default: 1)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--classification_backend",
+        type=str,
+        help="joblib backend of the LOO folds with --classification_jobs > 1 (default: loky)",
+        choices=CV_BACKENDS,
+        required=False,
+        default="loky",
+    )
+    parser.add_argument(
+        "--evaluation",
+        type=str,
+        help="estimator of the classification performance: LeaveOneOut, repeated stratified k-fold or "
+        + "out-of-bag (default: auto, chosen by the number of samples and recorded in the performance json)",
+        choices=EVALUATIONS,
+        required=False,
+        default="auto",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        help="parameter search of the classifications: every point of the small grid evaluated in full, or "
+        + "successive halving over max_features, max_depth, min_samples_leaf and class_weight by OOB score, "
+        + "growing the surviving forests, with only the finalists evaluated in full (default: grid)",
+        choices=SEARCHES,
+        required=False,
+        default="grid",
+    )
+    parser.add_argument(
+        "--learners",
+        type=str,
+        nargs="+",
+        help="learners every feature matrix is classified with: the random forest, L2-regularized logistic "
+        + "regression, ridge classification (closed-form LOO) and histogram gradient boosting; the summary "
+        + "shows the first one, and with several all of them side by side (default: forest)",
+        choices=LEARNERS,
+        required=False,
+        default=["forest"],
+    )
+    parser.add_argument(
+        "--screen",
+        action="store_true",
+        help="drop the non-finite, constant and perfectly correlated (duplicate) columns of every feature "
+        + "matrix before the classification; the columns removed by each step are recorded in the performance json",
+    )
+    parser.add_argument(
+        "--univariate_k",
+        type=int,
+        help="keep the k columns of every feature matrix with the best ANOVA F score, selected inside every "
+        + "evaluation fold (default: every column)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--no_plots",
+        action="store_true",
+        help="only write the numeric outputs of the classifications and summaries, without the figures; "
+        + "report.py --in_dir <out_dir> draws them later",
+    )
+
+    parser.add_argument(
+        "--pool",
+        action="store_true",
+        help="run the tasks in warm worker processes that import the scientific libraries once, "
+        + "instead of a new interpreter per task",
+    )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        help="path of the socket of a running worker daemon (worker_pool.py serve) to run the tasks on",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        help="write the tasks to a work queue in this directory on a shared filesystem and wait for "
+        + "workers on any node (work_queue.py work --queue_dir <dir>) to execute them",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--log_level",
+        type=str,
+        help="level of the logs of the stages (default: INFO); DEBUG also logs the per-item diagnostics "
+        + "of the hot loops (metabolite mappings, reaction rows, unmapped nodes)",
+        choices=LOG_LEVELS,
+        required=False,
+        default="INFO",
+    )
+    parser.add_argument(
+        "--profile_table",
+        action="store_true",
+        help="write a table of the wall time, CPU time, peak RSS and input and output sizes of every task "
+        + "and phase at the end of the log (always written to profile/profile.json under out_dir)",
+    )
+    parser.add_argument(
+        "--capture",
+        type=str,
+        help="also capture a cProfile or tracemalloc profile of every task, written to profile/ under out_dir",
+        choices=CAPTURE_KINDS,
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--capture_tasks",
+        type=str,
+        nargs="+",
+        help="names of the tasks captured with --capture (default: all tasks)",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="rerun every task instead of reusing the outputs of tasks whose inputs, parameters and code are unchanged",
+    )
+
+    parser.add_argument(
+        "--script_dir",
+        type=str,
+        help="path to folder with all scripts",
+        required=True,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--log_path", type=str, help="path to log file", required=True, default=None
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        help="path to output dir, with one subfolder per study and the cross-study summary",
+        required=True,
+        default=None,
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def read_studies(studies_path):
+    studies = pd.read_csv(studies_path, sep="\t", dtype=str)
+    missing = [col for col in STUDY_COLUMNS if col not in studies.columns]
+    if missing:
+        raise ValueError(f"Missing columns {missing} in {studies_path}")
+    if studies["study"].duplicated().any():
+        raise ValueError(f"Duplicate studies in {studies_path}")
+    return studies
+
+
+def study_args(args, study):
+    """The pipeline arguments of one study of the manifest."""
+    return argparse.Namespace(
+        **vars(args),
+        base_path=study.base_path,
+        end_path=study.end_path,
+        timepoint_paths=None,
+        timepoint_names=None,
+        contrast="consecutive",
+        case=study.case,
+        control=study.control,
+        append=False,
+        incremental=False,
+    )
+
+
+def build_tasks(args, studies):
+    """
+    Builds the task graph of all studies:
+    preprocessing of every study -> one shared gem preprocessing ->
+    features, classification and summary of every study -> cross-study summary.
+    """
+    tasks = {}
+    task_log_dir = os.path.join(args.out_dir, "logs")
+
+    studies_args = {}
+    for study in studies.itertuples(index=False):
+        studies_args[study.study] = study_args(args, study)
+        studies_args[study.study].out_dir = os.path.join(args.out_dir, study.study)
+        add_preprocess_task(tasks, studies_args[study.study], prefix=study.study + "/")
+
+    # preprocessing human-gem, once for all studies
+    valid_met_paths = []
+    gem_out_dirs = []
+    for name, study in studies_args.items():
+        valid_met_paths.append(
+            os.path.join(
+                study.out_dir,
+                "preprocess",
+                "metabolome",
+                "gem_overlapped_metabolites.tsv",
+            )
+        )
+        gem_out_dirs.append(os.path.join(study.out_dir, "preprocess", "gem"))
+    gem_log_path = os.path.join(args.out_dir, "preprocess-gem", "preprocess-gem.log")
+
+    command = (
+        [
+            "python3",
+            "-W",
+            "ignore",
+            os.path.join(args.script_dir, "preprocess-gem.py"),
+            "--gem_path",
+            args.gem_path,
+            "--valid_met_path",
+        ]
+        + valid_met_paths
+        + ["--log_path", gem_log_path, "--out_dir"]
+        + gem_out_dirs
+    )
+    add_task(
+        tasks,
+        "preprocess-gem",
+        command,
+        os.path.join(task_log_dir, "preprocess-gem.log"),
+        deps=[name + "/preprocess-metabolome" for name in studies_args],
+        inputs=[args.gem_path] + valid_met_paths,
+        outputs=gem_out_dirs,
+        code=[os.path.join(args.script_dir, "preprocess-gem.py")],
+    )
+
+    for name, study in studies_args.items():
+        add_feature_tasks(tasks, study, ["preprocess-gem"], prefix=name + "/")
+
+    # cross-study summary
+    summary_out_dir = os.path.join(args.out_dir, "summary")
+    summary_log_path = os.path.join(summary_out_dir, "summary.log")
+    study_summary_dirs = [
+        os.path.join(study.out_dir, "summary") for study in studies_args.values()
+    ]
+    command = (
+        [
+            "python3",
+            "-W",
+            "ignore",
+            os.path.join(args.script_dir, "summarize_studies.py"),
+            "--study_dirs",
+        ]
+        + study_summary_dirs
+        + ["--studies"]
+        + list(studies_args)
+        + ["--out_dir", summary_out_dir, "--log_path", summary_log_path]
+        + (["--no_plots"] if args.no_plots else [])
+    )
+    add_task(
+        tasks,
+        "summary",
+        command,
+        os.path.join(task_log_dir, "summary.log"),
+        deps=[name + "/summary" for name in studies_args],
+        inputs=study_summary_dirs,
+        outputs=[summary_out_dir],
+        code=[
+            os.path.join(args.script_dir, "summarize_studies.py"),
+            os.path.join(args.script_dir, "report.py"),
+        ],
+    )
+    return tasks
+
+
+def run_batch(args, log_file):
+    """
+    Executes the pipeline of every study, returning True on success and False on failure.
+    """
+    studies = read_studies(args.studies_path)
+    tasks = build_tasks(args, studies)
+    cache_dir = None if args.no_cache else os.path.join(args.out_dir, "cache")
+    profile_dir = os.path.join(args.out_dir, "profile")
+    if args.queue_dir is not None:
+        write_queue(
+            tasks,
+            args.queue_dir,
+            cache_dir=cache_dir,
+            profile_dir=profile_dir,
+            capture=args.capture,
+            capture_tasks=args.capture_tasks,
+            plots=not args.no_plots,
+        )
+        log_file.write(f"--- Wrote {len(tasks)} tasks to the work queue {args.queue_dir} ---\n")
+        log_file.flush()
+        returncodes = wait_queue(args.queue_dir, log_file)
+    else:
+        with task_executor(
+            args.workers, pool=args.pool, daemon=args.daemon, plots=not args.no_plots
+        ) as execute:
+            returncodes = run_tasks(
+                tasks,
+                args.workers,
+                log_file,
+                cache_dir=cache_dir,
+                execute=execute,
+                profile_dir=profile_dir,
+                capture=args.capture,
+                capture_tasks=args.capture_tasks,
+                memory_budget=args.memory_budget,
+                cpu_budget=args.cpu_budget,
+            )
+    if args.profile_table:
+        log_file.write(profile_table(read_profile(profile_dir)) + "\n")
+
+    failed = [name for name, returncode in returncodes.items() if returncode != 0]
+    log_file.write(f"--- {len(tasks) - len(failed)} of {len(tasks)} tasks complete. ---\n")
+    if failed:
+        log_file.write("--- Failed or skipped tasks: " + ", ".join(failed) + " ---\n")
+    return not failed
+
+
+def main(args):
+    pathlib.Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    os.environ[LOG_LEVEL_ENV] = args.log_level
+
+    with open(args.log_path, "w") as log_file:
+        success = run_batch(args, log_file)
+
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parse_args())
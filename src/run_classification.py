@@ -1,11 +1,39 @@
 import argparse
-import sys
+import multiprocessing
 import os
+import queue
+import sys
+import traceback
 from pathlib import Path
+from artifact_cache import build_manifest, is_cached, write_manifest
+from classification import CV_BACKENDS, SEARCHES, classification_cost, classify
+from evaluation import EVALUATIONS, evaluation_mode
+from feature_store import (COMBINATION_SUFFIX, MATRIX_SUFFIX, combination_parts, copy_matrix, matrix_shape,
+                           read_features, read_matrix, store_files)
+from learner_names import LEARNERS
+from logging_utils import get_logger, log_to
+from metabolome_store import read_registry
+
+logger = get_logger('run_classification')
+
+# Classification of every feature matrix of a run.
+# The matrices are the memory-mapped arrays of feature_store. The
+# classifications are grouped into jobs, one per feature directory, whose
+# reaction matrix is opened once for its reaction and metabolite+reaction
+# classifications; a metabolite+reaction matrix references the metabolite
+# baseline, which every worker opens once (load_shared). The jobs run in a
+# pool of --workers processes, the most expensive first, and every failed
+# classification is reported with its exit status.
+
+# sample registry and matrices opened by this process, see load_shared
+_shared = {}
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--met_path", type=str,
+                        help="path to the memory-mapped metabolite baseline (metabolite.npy)",
+                        required=True, default=None)
+    parser.add_argument("--met_store_path", type=str,
                         required=True, default=None)
     parser.add_argument("--feature_dir", type=str,
                         required=True, default=None)
@@ -21,81 +49,211 @@ def parse_args():
                         required=True, default=None)
     parser.add_argument("--log_path", type=str,
                         required=True, default=None)
+    parser.add_argument("--n_jobs", type=int,
+                        help="number of cores the LOO folds of every classification are fitted on (default: 1)",
+                        required=False, default=1)
+    parser.add_argument("--backend", type=str, choices=CV_BACKENDS,
+                        help="joblib backend of the LOO folds with --n_jobs > 1 (default: loky)",
+                        required=False, default="loky")
+    parser.add_argument("--evaluation", type=str, choices=EVALUATIONS,
+                        help="estimator of the performance of every classification (default: auto, "
+                        + "chosen once by the number of samples of the metabolite matrix)",
+                        required=False, default="auto")
+    parser.add_argument("--search", type=str, choices=SEARCHES,
+                        help="parameter search of every classification (default: grid)",
+                        required=False, default="grid")
+    parser.add_argument("--workers", type=int,
+                        help="number of processes classifying the feature matrices; 1 classifies them "
+                        + "in this process (default: 1)",
+                        required=False, default=1)
+    parser.add_argument("--learners", type=str, nargs='+', choices=LEARNERS,
+                        help="learners every matrix is classified with (default: forest)",
+                        required=False, default=['forest'])
+    parser.add_argument("--screen", action="store_true",
+                        help="drop the non-finite, constant and duplicate columns of every matrix before fitting")
+    parser.add_argument("--univariate_k", type=int,
+                        help="keep the k columns with the best ANOVA F score, selected inside every evaluation fold",
+                        required=False, default=None)
+    parser.add_argument("--no_plots", action="store_true",
+                        help="only write the numeric outputs of the classifications; report.py draws the "
+                        + "figures from them later")
     args = parser.parse_args()
     return args
 
+def open_matrix(path):
+    """Memory-mapped matrix of path, opened once per classification process."""
+    key = os.path.abspath(path)
+    if key not in _shared['matrices']:
+        _shared['matrices'][key] = read_matrix(path)
+    return _shared['matrices'][key]
+
+def load_shared(met_path, met_store_path):
+    """Loads the registry and opens the metabolite baseline, once per classification process."""
+    _shared['registry'] = read_registry(met_store_path)
+    _shared['matrices'] = {}
+    open_matrix(met_path)
+
+def screening_args(args):
+    """The screening options of args, as classification.py arguments."""
+    return (["--screen"] if args.screen else []) \
+        + (["--univariate_k", str(args.univariate_k)] if args.univariate_k else [])
+
+def classification(kind, in_path, out_dir, manifest_path, args):
+    """A classification of kind metabolite, reaction or metabolite+reaction, with its cache manifest."""
+    # the results do not depend on the parallelism, which is left out of the manifest
+    command = ["random_forest_classifier", "--in_path", in_path,
+               "--case", args.case, "--control", args.control,
+               "--evaluation", args.evaluation, "--search", args.search] + screening_args(args) \
+        + (["--learners"] + args.learners if args.learners != ['forest'] else []) \
+        + (["--no_plots"] if args.no_plots else [])
+    parts = combination_parts(in_path) if in_path.endswith(COMBINATION_SUFFIX) else []
+    inputs = [path for matrix in [in_path] + parts for path in store_files(matrix)]
+    manifest = build_manifest(command, inputs + [args.met_store_path], [args.script_dir + "/run_classification.py"])
+    return {"kind": kind, "in_path": in_path, "out_dir": out_dir,
+            "manifest_path": manifest_path, "manifest": manifest}
+
+def plan_jobs(args, cache_dir):
+    """
+    The classification jobs of the run, most expensive first, leaving out the
+    classifications a previous run did with the same inputs and code.
+    """
+    jobs = [{"name": "metabolite",
+             "classifications": [classification("metabolite", args.met_path, args.out_dir + "/metabolite",
+                                                cache_dir + "/metabolite.json", args)]}]
+    for entry in sorted(os.scandir(args.feature_dir), key=lambda entry: entry.name):
+        if not entry.is_dir():
+            continue
+        for sub_entry in sorted(os.scandir(entry.path), key=lambda entry: entry.name):
+            if not sub_entry.is_dir():
+                continue
+            name = entry.name + "/" + sub_entry.name
+            reaction_path = sub_entry.path + '/reaction.' + sub_entry.name + MATRIX_SUFFIX
+            met_react_path = sub_entry.path + '/metabolite.reaction.' + sub_entry.name + COMBINATION_SUFFIX
+            jobs.append({"name": name, "classifications": [
+                classification("reaction", reaction_path, args.out_dir + "/reaction/" + name,
+                               cache_dir + "/reaction." + entry.name + "." + sub_entry.name + ".json", args),
+                classification("metabolite+reaction", met_react_path, args.out_dir + "/metabolite+reaction/" + name,
+                               cache_dir + "/metabolite+reaction." + entry.name + "." + sub_entry.name + ".json",
+                               args)]})
+
+    for job in jobs:
+        cached = [item for item in job["classifications"] if is_cached(item["manifest_path"], item["manifest"])]
+        for item in cached:
+            logger.info("Skipping %s; inputs unchanged since %s", item["out_dir"], item["manifest_path"])
+        job["classifications"] = [item for item in job["classifications"] if item not in cached]
+    jobs = [job for job in jobs if job["classifications"]]
+
+    for job in jobs:
+        job["cost"] = sum(classification_cost(*matrix_shape(item["in_path"]), args.evaluation, args.search)
+                          for item in job["classifications"])
+    return sorted(jobs, key=lambda job: -job["cost"])
+
+def classify_job(job, args):
+    """
+    Runs the classifications of a job, whose matrices are opened once per
+    process, returning (exit status, traceback) by output directory.
+    """
+    results = {}
+    for item in job["classifications"]:
+        out_dir = item["out_dir"]
+        try:
+            # a combination references the baseline and the reaction matrix opened before
+            X = read_features(item["in_path"], read=open_matrix)
+            classify(X, _shared['registry'], args.case, args.control, out_dir, out_dir + '/classification.log',
+                     learners=args.learners, n_jobs=args.n_jobs, backend=args.backend, evaluation=args.evaluation,
+                     search=args.search, plots=not args.no_plots, screen=args.screen,
+                     univariate_k=args.univariate_k)
+            # copy of the input for provenance
+            copy_matrix(item["in_path"], out_dir)
+            results[out_dir] = (0, None)
+        except Exception:
+            results[out_dir] = (1, traceback.format_exc())
+    return results
+
+def work(jobs, todo, done, args):
+    """Classification worker: loads the shared matrices once, then runs the jobs of todo until it is empty."""
+    load_shared(args.met_path, args.met_store_path)
+    while (index := todo.get()) is not None:
+        done.put((os.getpid(), index, None))
+        done.put((os.getpid(), index, classify_job(jobs[index], args)))
+
+def run_jobs(jobs, args):
+    """Runs the jobs on args.workers processes, yielding (job, results of classify_job) as they finish."""
+    if not jobs:
+        return
+    if args.workers == 1:
+        load_shared(args.met_path, args.met_store_path)
+        for job in jobs:
+            yield job, classify_job(job, args)
+        return
+    context = multiprocessing.get_context("spawn")
+    todo, done = context.Queue(), context.Queue()
+    # the workers take the jobs in order, most expensive first
+    for index in range(len(jobs)):
+        todo.put(index)
+    workers = {}
+    for _ in range(min(args.workers, len(jobs))):
+        todo.put(None)
+        worker = context.Process(target=work, args=(jobs, todo, done, args))
+        worker.start()
+        workers[worker.pid] = worker
+    running = {}
+    pending = set(range(len(jobs)))
+    while pending:
+        try:
+            pid, index, results = done.get(timeout=1)
+        except queue.Empty:
+            for pid, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+                del workers[pid]
+                # a worker killed while classifying (out of memory, signal) fails its job with its exit status
+                if pid in running and worker.exitcode != 0:
+                    index = running.pop(pid)
+                    pending.discard(index)
+                    yield jobs[index], {item["out_dir"]: (worker.exitcode, "worker process exited")
+                                        for item in jobs[index]["classifications"]}
+            if not workers:
+                for index in sorted(pending):
+                    yield jobs[index], {item["out_dir"]: (None, "no worker process left")
+                                        for item in jobs[index]["classifications"]}
+                break
+            continue
+        if results is None:
+            running[pid] = index
+        else:
+            del running[pid]
+            pending.discard(index)
+            yield jobs[index], results
+    for worker in workers.values():
+        worker.join()
+
 def main(args):
     Path(args.out_dir).mkdir(exist_ok=True, parents=True)
     
-    orig_stdout = sys.stdout
-    orig_stderr = sys.stderr
-    
-    log_file = open(args.log_path, 'w')
-    sys.stdout = log_file
-    sys.stderr = log_file
-    
-    #metabolite
-    print("Classification with metabolite")
-    met_out_dir = args.out_dir + "/metabolite"
-    met_log_path = met_out_dir + '/classification.log'
-    Path(met_out_dir).mkdir(exist_ok=True, parents=True)
-    perf_json = met_out_dir + f'/{args.case}.{args.control}.classifier_performance.json'
-    if not (os.path.exists(perf_json) and os.path.getsize(perf_json) > 0):
-        command = "python -W ignore " + args.script_dir + "/classification.py" + \
-            " --in_path " + args.met_path + \
-            " --case " + args.case + \
-            " --control " + args.control + \
-            " --out_dir " + met_out_dir + \
-            " --log_path " + met_log_path
-        os.system(command)
-    else:
-        print(f"Skipping metabolite classification; found {perf_json}")
-    
-    #reaction
-    print("Classification with reaction")
-    react_out_dir = args.out_dir + "/reaction"
-    for entry in os.scandir(args.feature_dir):
-        if (entry.is_dir()):
-            for sub_entry in os.scandir(entry.path):
-                if (sub_entry.is_dir()):
-                    out_dir = react_out_dir + "/" + entry.name + "/" + sub_entry.name
-                    perf_json = out_dir + f'/{args.case}.{args.control}.classifier_performance.json'
-                    if not (os.path.exists(perf_json) and os.path.getsize(perf_json) > 0):
-                        command = "python -W ignore " + args.script_dir + "/classification.py" + \
-                            " --in_path " + sub_entry.path + '/reaction.' + sub_entry.name + '.tsv' + \
-                            " --case " + args.case + \
-                            " --control " + args.control + \
-                            " --out_dir " + out_dir + \
-                            " --log_path " + out_dir + "/classification.log"
-                        os.system(command)
-                    else:
-                        print(f"Skipping reaction: {entry.name}/{sub_entry.name}; found {perf_json}")
-                    
-    #metabolite+reaction
-    print("Classification with metabolite and reaction")
-    met_react_out_dir = args.out_dir + "/metabolite+reaction"
-    print("Classification with reaction")
-    react_out_dir = args.out_dir + "/reaction"
-    for entry in os.scandir(args.feature_dir):
-        if (entry.is_dir()):
-            for sub_entry in os.scandir(entry.path):
-                if (sub_entry.is_dir()):
-                    out_dir = met_react_out_dir + "/" + entry.name + "/" + sub_entry.name
-                    perf_json = out_dir + f'/{args.case}.{args.control}.classifier_performance.json'
-                    if not (os.path.exists(perf_json) and os.path.getsize(perf_json) > 0):
-                        command = "python -W ignore " + args.script_dir + "/classification.py" + \
-                            " --in_path " + sub_entry.path + '/metabolite.reaction.' + sub_entry.name + '.tsv' + \
-                            " --case " + args.case + \
-                            " --control " + args.control + \
-                            " --out_dir " + out_dir + \
-                            " --log_path " + out_dir + "/classification.log"
-                        os.system(command) 
-                    else:
-                        print(f"Skipping metabolite+reaction: {entry.name}/{sub_entry.name}; found {perf_json}")
-    sys.stdout = orig_stdout
-    sys.stderr = orig_stderr 
-    log_file.close()
-                
+    with log_to(args.log_path):
+        # manifests of the previous classifications, reused while their inputs are unchanged
+        cache_dir = args.out_dir + "/cache"
+        # every feature matrix is evaluated alike, so that their metrics are comparable
+        args.evaluation = evaluation_mode(matrix_shape(args.met_path)[0], args.evaluation, args.search)
+        logger.info("Performance estimated by %s", args.evaluation)
+
+        jobs = plan_jobs(args, cache_dir)
+        n_classifications = sum(len(job["classifications"]) for job in jobs)
+        logger.info("%d classifications in %d jobs on %d workers", n_classifications, len(jobs), args.workers)
+        failed = []
+        for job, results in run_jobs(jobs, args):
+            for item in job["classifications"]:
+                status, error = results[item["out_dir"]]
+                if status == 0:
+                    write_manifest(item["manifest_path"], item["manifest"], [item["out_dir"]])
+                    logger.info("Classification %s complete", item["out_dir"])
+                else:
+                    failed.append(item["out_dir"])
+                    logger.error("Classification %s failed with exit status %s:\n%s", item["out_dir"], status, error)
+        logger.info("%d of %d classifications complete", n_classifications - len(failed), n_classifications)
+    if failed:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main(parse_args())
-    
@@ -0,0 +1,73 @@
+import numpy as np
+from sklearn.feature_selection import SelectKBest, f_classif
+from sklearn.pipeline import Pipeline
+
+# Screening of the feature matrices ahead of the classification.
+# The wide reaction sets (3, 4 and 8 after the F/B split) hold thousands of
+# columns that cannot help a forest: columns with a NaN or inf (Ratio features
+# of a zero concentration), constant columns, and columns perfectly correlated
+# with another one, e.g. the forward and backward copy of a reaction. Those are
+# dropped once, before any fit, as they carry no label information; the
+# duplicates are found by hashing every column standardized, sign-normalized
+# and rounded to DUPLICATE_DECIMALS, so scaled and negated copies collide, and
+# the first column of every group is kept. The optional univariate filter
+# (the k columns with the best ANOVA F score) does look at the labels, so it is
+# fitted inside every evaluation fold, on the training samples only.
+
+DUPLICATE_DECIMALS = 4
+SCREENING_STEPS = ["non_finite", "zero_variance", "duplicate"]
+
+
+def column_keys(values):
+    """Hashable key of every column of values: equal for perfectly correlated columns."""
+    values = values.astype(np.float64)
+    z = (values - values.mean(axis=0)) / values.std(axis=0)
+    # the sign of the first non-zero value of every column is made positive
+    first = z[np.argmax(np.abs(z) > 0.5 / 10**DUPLICATE_DECIMALS, axis=0), np.arange(z.shape[1])]
+    z *= np.where(first < 0, -1.0, 1.0)
+    # + 0.0 turns the -0.0 of rounding into 0.0, which would hash differently
+    z = np.round(z, DUPLICATE_DECIMALS) + 0.0
+    return [column.tobytes() for column in z.T]
+
+
+def screen_features(X):
+    """
+    Drops the non-finite, constant and duplicate columns of the feature matrix
+    X, returning the screened matrix and the number of columns each step removed.
+    """
+    values = X.to_numpy()
+    keep = np.isfinite(values).all(axis=0)
+    removed = {"non_finite": int((~keep).sum())}
+
+    constant = np.zeros(len(keep), dtype=bool)
+    constant[keep] = np.ptp(values[:, keep], axis=0) == 0
+    keep &= ~constant
+    removed["zero_variance"] = int(constant.sum())
+
+    first = {}
+    duplicate = np.zeros(len(keep), dtype=bool)
+    kept_idx = np.flatnonzero(keep)
+    for idx, key in zip(kept_idx, column_keys(values[:, kept_idx])):
+        duplicate[idx] = first.setdefault(key, idx) != idx
+    keep &= ~duplicate
+    removed["duplicate"] = int(duplicate.sum())
+    return X.iloc[:, np.flatnonzero(keep)], removed
+
+
+def univariate_model(estimator, k, n_features):
+    """estimator behind a filter keeping the k best columns by ANOVA F score, refitted in every fold."""
+    if not k or k >= n_features:
+        return estimator
+    return Pipeline([("filter", SelectKBest(f_classif, k=k)), ("model", estimator)])
+
+
+def final_estimator(model):
+    """The estimator of a model built by univariate_model."""
+    return model[-1] if isinstance(model, Pipeline) else model
+
+
+def selected_columns(model, n_features):
+    """Boolean mask of the columns a fitted model built by univariate_model uses."""
+    if isinstance(model, Pipeline):
+        return model[0].get_support()
+    return np.ones(n_features, dtype=bool)
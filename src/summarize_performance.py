@@ -1,11 +1,12 @@
 import argparse
-import sys
 import os
 import json
 import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
+from learner_names import LEARNERS, performance_prefix
+from logging_utils import get_logger, log_to
+from profiling import phase
+from report import INTERVALS_SUFFIX, LEARNERS_SUFFIX, plot_learner_summary, plot_summary
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,11 +20,49 @@ def parse_args():
                         required=True, default=None)
     parser.add_argument("--log_path", type=str,
                         required=True, default=None)
+    parser.add_argument("--learners", type=str, nargs='+', choices=LEARNERS,
+                        help="learners whose classifications are summarized: the summary of the first one, "
+                        + "and with several a side-by-side table of all (default: forest)",
+                        required=False, default=['forest'])
+    parser.add_argument("--no_plots", action="store_true",
+                        help="only write the summary tables; report.py draws the heatmaps from them later")
     args = parser.parse_args()
     return args
 
 
-def build_summary_dataframe(parent_dir, feature_root, react_feat_map, metrics, json_filename, baseline_metrics):
+# features computed for every reaction set
+REACT_FEAT_MAP = {
+    1: ['Change', 'Prob'],
+    2: ['Change', 'Ratio', 'Prob'],
+    3: ['Change', 'Prob'],
+    4: ['Change', 'Ratio', 'Prob'],
+    5: ['Prob'],
+    6: ['Prob'],
+    7: ['Change', 'Ratio', 'Prob'],
+    8: ['Change', 'Ratio', 'Prob'],
+    9: ['Prob']
+}
+
+logger = get_logger("summarize_performance")
+
+
+def performance_key(feature_root, react_set_no, feature_name):
+    """Output dir of a classification relative to the classification dir, e.g. reaction/reaction-set-1/change."""
+    return os.path.join(feature_root, f"reaction-set-{react_set_no}", feature_name.lower())
+
+
+def read_performance(in_dir, json_filename, react_feat_map):
+    """Reads the performance of every classification summarized, keyed by its relative output dir."""
+    performance = {"metabolite": json.load(open(os.path.join(in_dir, "metabolite", json_filename)))}
+    for feature_root in ["reaction", "metabolite+reaction"]:
+        for react_set_no in range(1, 10):
+            for feature_name in react_feat_map[react_set_no]:
+                key = performance_key(feature_root, react_set_no, feature_name)
+                performance[key] = json.load(open(os.path.join(in_dir, key, json_filename)))
+    return performance
+
+
+def build_summary_dataframe(performance, feature_root, react_feat_map, metrics, baseline_metrics):
     summary_dict = {
         "index": ["Accuracy", "AUROC", "AUPRC"],
         "columns": [],
@@ -40,11 +79,8 @@ def build_summary_dataframe(parent_dir, feature_root, react_feat_map, metrics, j
     for metric in metrics:
         metric_values = []
         for react_set_no in range(1, 10):
-            react_set_dir = os.path.join(parent_dir, feature_root, f"reaction-set-{react_set_no}")
             for feature_name in react_feat_map[react_set_no]:
-                feature_dir = os.path.join(react_set_dir, feature_name.lower())
-                json_path = os.path.join(feature_dir, json_filename)
-                metric_dict = json.load(open(json_path))
+                metric_dict = performance[performance_key(feature_root, react_set_no, feature_name)]
                 metric_values.append(round(metric_dict[metric], 2))
         metric_values.append(baseline_metrics[metric])
         summary_dict["data"].append(metric_values)
@@ -54,104 +90,138 @@ def build_summary_dataframe(parent_dir, feature_root, react_feat_map, metrics, j
     return summary_df
 
 
-def save_summary_outputs(summary_df, out_dir, prefix, title):
+def build_interval_dataframe(performance, feature_root, react_feat_map):
+    """
+    Bootstrap intervals and permutation p-values of the metrics summarized by
+    build_summary_dataframe, in its columns; None if a classification has no
+    resampling record (performance json of an earlier version).
+    """
+    keys = [performance_key(feature_root, react_set_no, feature_name)
+            for react_set_no in range(1, 10) for feature_name in react_feat_map[react_set_no]] + ["metabolite"]
+    if any("resampling" not in performance[key] for key in keys):
+        return None
+    columns = [(react_set_no, feature_name) for react_set_no in range(1, 10)
+               for feature_name in react_feat_map[react_set_no]] + [("Baseline", "Metabolite")]
+    index, data = [], []
+    for metric, label in [('accuracy', "Accuracy"), ('auroc', "AUROC"), ('auprc', "AUPRC")]:
+        records = [performance[key]["resampling"][metric] for key in keys]
+        index += [f"{label} low", f"{label} high", f"{label} p-value"]
+        data += [[record["ci"][0] for record in records],
+                 [record["ci"][1] for record in records],
+                 [record["p_value"] for record in records]]
+    return pd.DataFrame(data, index=index,
+                        columns=pd.MultiIndex.from_tuples(columns, names=["Reaction set", "Feature"]))
+
+
+def save_summary_outputs(summary_df, out_dir, prefix, plots=True, interval_df=None):
     summary_payload = json.loads(summary_df.to_json(orient="split"))
     with open(os.path.join(out_dir, f"{prefix}.json"), "w") as json_file:
         json.dump(summary_payload, json_file, indent=4)
 
-    plot_df = summary_df.copy()
-    plot_df.columns = [
-        f"{col[0]} | {col[1]}" if isinstance(col, tuple) else str(col)
-        for col in plot_df.columns
-    ]
-
-    plt.figure(figsize=(max(8, len(plot_df.columns) * 0.6), 4.5))
-    ax = sns.heatmap(
-        plot_df,
-        annot=True,
-        fmt=".2f",
-        cmap="coolwarm",
-        cbar=True,
-        linewidths=0.5,
-        linecolor="white",
-    )
-    ax.set_title(title)
-    ax.set_xlabel("Feature configuration")
-    ax.set_ylabel("Metric")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout()
-    plt.savefig(os.path.join(out_dir, f"{prefix}.png"), dpi=300)
-    plt.close()
+    intervals_path = os.path.join(out_dir, f"{prefix}{INTERVALS_SUFFIX}.json")
+    if interval_df is not None:
+        interval_df.to_csv(os.path.join(out_dir, f"{prefix}{INTERVALS_SUFFIX}.tsv"), sep='\t')
+        with open(intervals_path, "w") as json_file:
+            json.dump(json.loads(interval_df.to_json(orient="split")), json_file, indent=4)
+    elif os.path.exists(intervals_path):
+        # the intervals of a previous run would be drawn on these metrics
+        os.remove(intervals_path)
 
+    if plots:
+        with phase("plotting", prefix=prefix):
+            plot_summary(summary_df, out_dir, prefix)
 
-def main(args):
-    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
-    
-    orig_stdout = sys.stdout
-    orig_stderr = sys.stderr
-    
-    log_file = open(args.log_path, 'w')
-    sys.stdout = log_file
-    sys.stderr = log_file
-    
-    json_filename = args.case + "." + args.control + ".classifier_performance.json"
-    
-    baseline_dict = json.load(open(args.in_dir + '/metabolite/' + json_filename))
+
+def baseline_values(performance, metrics):
+    """Metrics of the metabolite baseline, rounded like the summaries."""
+    return {metric: round(performance["metabolite"][metric], 2) for metric in metrics}
+
+
+def summarize_learners(performances, out_dir, plots=True):
+    """
+    Writes the summaries of several learners side by side, a row per
+    (learner, metric), from their performance read by read_performance.
+    """
+    metrics = ['accuracy', 'auroc', 'auprc']
+    summary_dfs = {}
+    for prefix in ["reaction", "metabolite+reaction"]:
+        summary_df = pd.concat(
+            {
+                learner: build_summary_dataframe(
+                    performance, prefix, REACT_FEAT_MAP, metrics, baseline_values(performance, metrics)
+                )
+                for learner, performance in performances.items()
+            },
+            names=["Learner", "Metric"],
+        )
+        summary_df.to_csv(os.path.join(out_dir, f"{prefix}{LEARNERS_SUFFIX}.tsv"), sep='\t')
+        summary_payload = json.loads(summary_df.to_json(orient="split"))
+        with open(os.path.join(out_dir, f"{prefix}{LEARNERS_SUFFIX}.json"), "w") as json_file:
+            json.dump(summary_payload, json_file, indent=4)
+        if plots:
+            with phase("plotting", prefix=prefix + LEARNERS_SUFFIX):
+                plot_learner_summary(summary_df, out_dir, prefix)
+        logger.info("AUROC by learner, %s features:\n%s", prefix, summary_df.xs("AUROC", level="Metric"))
+        summary_dfs[prefix] = summary_df
+    return summary_dfs
+
+
+def summarize_performance(performance, out_dir, plots=True):
+    """
+    Writes the reaction and metabolite+reaction summaries of the performance
+    read by read_performance, with their heatmaps unless plots is False.
+    """
+    baseline_dict = performance["metabolite"]
     baseline = [round(baseline_dict['accuracy'], 2),
                 round(baseline_dict['auroc'], 2),
                 round(baseline_dict['auprc'], 2)]
     
-    print("baseline", baseline)
-    
-    react_feat_map = {
-        1: ['Change', 'Prob'],
-        2: ['Change', 'Ratio', 'Prob'],
-        3: ['Change', 'Prob'],
-        4: ['Change', 'Ratio', 'Prob'],
-        5: ['Prob'],
-        6: ['Prob'],
-        7: ['Change', 'Ratio', 'Prob'],
-        8: ['Change', 'Ratio', 'Prob'],
-        9: ['Prob']
-    }
+    logger.info("baseline %s", baseline)
+
+    # metrics of different estimators (LOO, k-fold, out-of-bag) are not comparable
+    estimators = {key: perf.get("evaluation", {"estimator": "loo"})["estimator"] for key, perf in performance.items()}
+    if len(set(estimators.values())) > 1:
+        logger.warning("Performance estimated by different estimators: %s", estimators)
+    else:
+        logger.info("Performance estimated by %s", baseline_dict.get("evaluation", {"estimator": "loo"})["estimator"])
     
     metrics = ['accuracy', 'auroc', 'auprc']
 
     baseline_metrics = dict(zip(metrics, baseline))
 
     reaction_summary_df = build_summary_dataframe(
-        args.in_dir,
+        performance,
         "reaction",
-        react_feat_map,
+        REACT_FEAT_MAP,
         metrics,
-        json_filename,
         baseline_metrics,
     )
-    save_summary_outputs(
-        reaction_summary_df,
-        args.out_dir,
-        "reaction",
-        "Benchmark: Reaction features only",
-    )
+    save_summary_outputs(reaction_summary_df, out_dir, "reaction", plots,
+                         build_interval_dataframe(performance, "reaction", REACT_FEAT_MAP))
 
     combo_summary_df = build_summary_dataframe(
-        args.in_dir,
+        performance,
         "metabolite+reaction",
-        react_feat_map,
+        REACT_FEAT_MAP,
         metrics,
-        json_filename,
         baseline_metrics,
     )
-    save_summary_outputs(
-        combo_summary_df,
-        args.out_dir,
-        "metabolite+reaction",
-        "Benchmark: Reaction and metabolite features together",
-    )
+    save_summary_outputs(combo_summary_df, out_dir, "metabolite+reaction", plots,
+                         build_interval_dataframe(performance, "metabolite+reaction", REACT_FEAT_MAP))
+    return reaction_summary_df, combo_summary_df
+
 
-    sys.stdout = orig_stdout
-    sys.stderr = orig_stderr 
-    log_file.close()
+def main(args):
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    
+    with log_to(args.log_path):
+        performances = {}
+        for learner in args.learners:
+            json_filename = performance_prefix(args.case, args.control, learner) + ".classifier_performance.json"
+            performances[learner] = read_performance(args.in_dir, json_filename, REACT_FEAT_MAP)
+        summarize_performance(performances[args.learners[0]], args.out_dir, plots=not args.no_plots)
+        if len(args.learners) > 1:
+            summarize_learners(performances, args.out_dir, plots=not args.no_plots)
                 
 if __name__ == "__main__":
     main(parse_args())
@@ -0,0 +1,70 @@
+import argparse
+import os
+import json
+import pandas as pd
+from pathlib import Path
+from logging_utils import get_logger, log_to
+from profiling import phase
+from report import plot_study_summary, read_summary
+
+# Cross-study summary of a batch run: the per-study summaries written by
+# summarize_performance.py are stacked into one table with a row per
+# (study, metric) and a column per (reaction set, feature).
+
+logger = get_logger('summarize_studies')
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study_dirs", type=str, nargs='+',
+                        help="summary dir of every study, as written by summarize_performance.py",
+                        required=True, default=None)
+    parser.add_argument("--studies", type=str, nargs='+',
+                        help="name of every study, in the order of study_dirs",
+                        required=True, default=None)
+    parser.add_argument("--out_dir", type=str,
+                        required=True, default=None)
+    parser.add_argument("--log_path", type=str,
+                        required=True, default=None)
+    parser.add_argument("--no_plots", action="store_true",
+                        help="only write the summary tables; report.py draws the heatmaps from them later")
+    args = parser.parse_args()
+    if(len(args.study_dirs) != len(args.studies)):
+        parser.error('--study_dirs and --studies must be given the same number of times')
+    return args
+
+
+def build_study_dataframe(study_dirs, studies, prefix):
+    summary_dfs = {}
+    for study, study_dir in zip(studies, study_dirs):
+        summary_dfs[study] = read_summary(os.path.join(study_dir, f"{prefix}.json"))
+        logger.info('%s %s %s', study, prefix, summary_dfs[study].shape)
+    summary_df = pd.concat(summary_dfs, names=["Study", "Metric"])
+    return summary_df
+
+
+def save_study_outputs(summary_df, out_dir, prefix, plots=True):
+    summary_df.to_csv(os.path.join(out_dir, f"{prefix}.tsv"), sep='\t')
+    summary_payload = json.loads(summary_df.to_json(orient="split"))
+    with open(os.path.join(out_dir, f"{prefix}.json"), "w") as json_file:
+        json.dump(summary_payload, json_file, indent=4)
+
+    if plots:
+        # one heatmap row per study, on the AUROC
+        with phase("plotting", prefix=prefix):
+            plot_study_summary(summary_df, out_dir, prefix)
+
+
+def main(args):
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+
+    with log_to(args.log_path):
+        logger.info('studies %s', args.studies)
+
+        reaction_summary_df = build_study_dataframe(args.study_dirs, args.studies, "reaction")
+        save_study_outputs(reaction_summary_df, args.out_dir, "reaction", not args.no_plots)
+
+        combo_summary_df = build_study_dataframe(args.study_dirs, args.studies, "metabolite+reaction")
+        save_study_outputs(combo_summary_df, args.out_dir, "metabolite+reaction", not args.no_plots)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,274 @@
+import concurrent.futures
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+import time
+import traceback
+import psutil
+from artifact_cache import build_manifest, is_cached, write_manifest
+from logging_utils import LOG_LEVEL_ENV, log_level
+from resources import children_rss_mb, default_memory_budget, input_memory, profile_history
+from profiling import (
+    CAPTURE_ENV,
+    MB,
+    PROFILE_ENV,
+    ResourceMonitor,
+    path_size,
+    read_phases,
+    write_profile,
+)
+
+# Task graph of commands executed on a pool of worker threads.
+# A task is a dict holding its command (an argument list, run without a shell
+# so paths may contain spaces), the names of the tasks it
+# depends on and the path of the log file capturing its output. Tasks are
+# added in dependency order; every task starts as soon as all of its
+# dependencies succeeded and a worker is free.
+# Tasks may also list their input files, output paths and code; with a cache
+# directory, a task whose manifest matches the previous run is not rerun.
+# Commands may also be handed to the warm workers of worker_pool.py.
+# The resource usage of every task and of its phases can be written to a
+# profile (see profiling.py).
+# Tasks are admitted under a memory and a cpu budget: every task has a memory
+# estimate (see resources.py), ready tasks start largest first, and a task only
+# starts while the running tasks' estimates, or their live RSS if larger, leave
+# room for it. A task larger than the budget runs alone.
+
+
+def add_task(
+    tasks, name, command, log_path, deps=(), inputs=(), outputs=(), code=(), memory=None, cpus=1
+):
+    """
+    Adds a task to an ordered dict of tasks, after the tasks it depends on.
+    memory is its estimated peak RSS in MB, or a function computing it once the
+    dependencies are done; by default it is estimated from the size of its inputs.
+    """
+    for dep in deps:
+        if dep not in tasks:
+            raise ValueError(f"Unknown dependency {dep} of task {name}")
+    if name in tasks:
+        raise ValueError(f"Duplicate task {name}")
+    tasks[name] = {
+        "command": command,
+        "log_path": log_path,
+        "deps": list(deps),
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "code": list(code),
+        "memory": memory,
+        "cpus": cpus,
+    }
+
+
+def estimate_memory(task):
+    """The memory estimate of a task whose dependencies are done, in MB."""
+    memory = task["memory"]
+    if callable(memory):
+        try:
+            memory = memory()
+        except (OSError, ValueError, KeyError):
+            memory = None
+    if memory is None:
+        memory = input_memory(task["inputs"])
+    return memory
+
+
+def execute_command(command, log_path, env=None):
+    """
+    Executes a command with its output written to log_path and the variables of
+    env added to its environment, returning (exit status, resource usage).
+    """
+    pathlib.Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with open(log_path, "w") as task_log:
+        process = subprocess.Popen(
+            command, stdout=task_log, stderr=task_log, env=dict(os.environ, **(env or {}))
+        )
+        # ru_maxrss would start from the RSS of this process at the fork, so RSS is sampled
+        monitor = ResourceMonitor(psutil.Process(process.pid)).start()
+        # the rusage of wait4 covers the process and the children it waited for
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "wall_s": round(time.perf_counter() - start, 3),
+        "cpu_s": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "peak_rss_mb": round(monitor.stop_sampling() / MB, 1),
+    }
+    return process.returncode, usage
+
+
+def run_task(name, task, cache_dir, execute=execute_command, profile_path=None, capture=None):
+    """
+    Executes a task unless its cached outputs can be reused, returning its record:
+    exit status, whether it was cached and its resource usage. With profile_path,
+    the task appends its phases to that file and the record also holds the
+    phases and the sizes of its inputs and outputs. A command the executor could
+    not run (e.g. an unreachable daemon or a crashed worker) fails with status 1,
+    its traceback appended to the task log.
+    """
+    # tasks log at the level of the pipeline, also in warm workers started before it
+    env = {LOG_LEVEL_ENV: log_level()}
+    if profile_path is not None:
+        pathlib.Path(profile_path).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(profile_path):
+            os.remove(profile_path)
+        env[PROFILE_ENV] = profile_path
+        if capture is not None:
+            env[CAPTURE_ENV] = capture
+
+    record = {"cached": False}
+    manifest = None
+    if cache_dir is not None and task["outputs"]:
+        manifest_path = os.path.join(cache_dir, name + ".json")
+        manifest = build_manifest(task["command"], task["inputs"], task["code"])
+        record["cached"] = is_cached(manifest_path, manifest)
+
+    if record["cached"]:
+        record["returncode"] = 0
+    else:
+        try:
+            record["returncode"], usage = execute(task["command"], task["log_path"], env)
+            record.update(usage)
+        except Exception:
+            pathlib.Path(task["log_path"]).parent.mkdir(parents=True, exist_ok=True)
+            with open(task["log_path"], "a") as task_log:
+                task_log.write(f"--- The task could not be executed: ---\n{traceback.format_exc()}")
+            record["returncode"] = 1
+        if record["returncode"] == 0 and manifest is not None:
+            write_manifest(manifest_path, manifest, task["outputs"])
+
+    if profile_path is not None:
+        record["input_bytes"] = path_size(task["inputs"])
+        record["output_bytes"] = path_size(task["outputs"])
+        record["phases"] = read_phases(profile_path)
+    return record
+
+
+def run_tasks(
+    tasks,
+    workers,
+    log_file,
+    cache_dir=None,
+    execute=execute_command,
+    profile_dir=None,
+    capture=None,
+    capture_tasks=None,
+    memory_budget=None,
+    cpu_budget=None,
+):
+    """
+    Runs every task once its dependencies succeeded, at most workers at a time,
+    within memory_budget MB (default: 90% of the memory) and cpu_budget cpus
+    (default: workers). Ready tasks are started largest memory estimate first;
+    the peak RSS of a task in the previous profile replaces its estimate.
+
+    A failed task skips every task depending on it, directly or not, while
+    independent tasks keep running. With cache_dir, tasks with outputs are
+    reused when their inputs, command and code are unchanged. Commands are run by
+    execute(command, log_path, env), a new process per command by default.
+    With profile_dir, the record of every task and its phases is written to
+    profile_dir/profile.json, and capture ("cprofile" or "tracemalloc") is
+    turned on for the tasks in capture_tasks (all tasks if None).
+    Returns a dict of task name -> exit status, None for skipped tasks.
+    """
+    if memory_budget is None:
+        memory_budget = default_memory_budget()
+    if cpu_budget is None:
+        cpu_budget = workers
+    history = profile_history(profile_dir) if profile_dir is not None else {}
+    returncodes = {}
+    records = {}
+    start = time.perf_counter()
+    pending = dict(tasks)
+    # memory estimates of the ready tasks, and of the running tasks by future
+    ready = {}
+    running = {}
+    running_memory = {}
+    waiting = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or ready or running:
+            for name, task in list(pending.items()):
+                if any(returncodes.get(dep, 0) != 0 for dep in task["deps"] if dep in returncodes):
+                    returncodes[name] = None
+                    records[name] = {"returncode": None}
+                    del pending[name]
+                    log_file.write(f"--- Skipped task {name}: a dependency failed ---\n")
+                elif all(returncodes.get(dep) == 0 for dep in task["deps"]):
+                    del pending[name]
+                    ready[name] = history.get(name) or estimate_memory(task)
+
+            # largest first; a task that does not fit holds back the smaller ones
+            used_memory = max(sum(running_memory.values()), children_rss_mb()) if running else 0
+            used_cpus = sum(tasks[running[future]]["cpus"] for future in running)
+            for name in sorted(ready, key=lambda name: -ready[name]):
+                task = tasks[name]
+                if running and (
+                    len(running) >= workers
+                    or used_memory + ready[name] > memory_budget
+                    or used_cpus + task["cpus"] > cpu_budget
+                ):
+                    if name not in waiting and len(running) < workers:
+                        log_file.write(
+                            f"--- Task {name} waits for resources: {ready[name]:.0f} MB estimated, "
+                            + f"{used_memory:.0f} of {memory_budget:.0f} MB "
+                            + f"and {used_cpus} of {cpu_budget} cpus in use ---\n"
+                        )
+                        waiting.add(name)
+                    break
+                memory = ready.pop(name)
+                used_memory += memory
+                used_cpus += task["cpus"]
+                log_file.write(f"--- Queued task {name}: {shlex.join(task['command'])} ---\n")
+                profile_path = None
+                task_capture = None
+                if profile_dir is not None:
+                    profile_path = os.path.join(profile_dir, name + ".jsonl")
+                    if capture_tasks is None or name in capture_tasks:
+                        task_capture = capture
+                future = pool.submit(
+                    run_task, name, task, cache_dir, execute, profile_path, task_capture
+                )
+                running[future] = name
+                running_memory[future] = memory
+            log_file.flush()
+
+            if not running:
+                continue
+            # while tasks wait, the live RSS is sampled again every second
+            done, _ = concurrent.futures.wait(
+                running,
+                timeout=1 if ready else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                name = running.pop(future)
+                records[name] = future.result()
+                records[name]["memory_estimate_mb"] = round(running_memory.pop(future), 1)
+                returncodes[name] = records[name]["returncode"]
+                if records[name]["cached"]:
+                    log_file.write(f"--- Task {name} unchanged, reusing its outputs. ---\n")
+                elif returncodes[name] == 0:
+                    log_file.write(f"--- Task {name} complete. ---\n")
+                else:
+                    log_file.write(
+                        f"--- Task {name} failed with return code {returncodes[name]}, "
+                        + f"see {tasks[name]['log_path']} ---\n"
+                    )
+                    # On failure, also write to the main script's stderr
+                    sys.stderr.write(f"--- Command failed: {shlex.join(tasks[name]['command'])} ---\n")
+                    sys.stderr.write(f"--- Return Code: {returncodes[name]} ---\n")
+                    sys.stderr.write(f"--- See log file for details: {tasks[name]['log_path']} ---\n")
+                    sys.stderr.flush()
+            log_file.flush()
+
+    if profile_dir is not None:
+        profile = {
+            "workers": workers,
+            "wall_s": round(time.perf_counter() - start, 3),
+            "tasks": records,
+        }
+        write_profile(profile, profile_dir)
+    return returncodes
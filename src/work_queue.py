@@ -0,0 +1,346 @@
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import quote
+from logging_utils import LOG_LEVEL_ENV, log_level
+from profiling import write_profile
+from task_graph import run_task
+from worker_pool import task_executor
+
+# Work queue of a task graph on a shared filesystem.
+# pipeline.py --queue_dir writes every task as a json file under tasks/ and
+# waits for them; workers on any node sharing the filesystem run
+# "work_queue.py work --queue_dir <dir>" to claim, execute and commit them,
+# without any other service:
+# - a task is claimed by creating leases/<task>.lease with O_EXCL, which
+#   exactly one worker can do; the worker renews the lease (its mtime) while
+#   the task runs, and a lease older than the lease timeout is taken over by
+#   renaming it away and checking that the renamed file is still the expired
+#   lease, putting it back otherwise;
+# - a task is committed by hard-linking its record to done/<task>.json, which
+#   fails if another worker committed it first, so a task is done exactly once.
+# The queue holds the working directory of the pipeline run, which every node
+# must see at the same path.
+
+META_NAME = "queue.json"
+# seconds between two scans of the queue, and between two renewals of a lease
+POLL_INTERVAL = 1
+RENEW_INTERVAL = 10
+# seconds after which the lease of a task whose worker stopped renewing it expires
+LEASE_TIMEOUT = 60
+
+
+def task_file(name):
+    """File name of a task, whose name may contain '/' in batch mode."""
+    return quote(name, safe="")
+
+
+def write_json(path, data):
+    """Writes a json file atomically."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_queue(tasks, queue_dir, cache_dir=None, profile_dir=None, capture=None, capture_tasks=None, plots=True):
+    """Writes a task graph to a new work queue in queue_dir, replacing its previous tasks."""
+    for sub_dir in ["tasks", "leases", "done"]:
+        path = pathlib.Path(queue_dir, sub_dir)
+        path.mkdir(parents=True, exist_ok=True)
+        for old in path.iterdir():
+            old.unlink()
+    for order, (name, task) in enumerate(tasks.items()):
+        record = {key: value for key, value in task.items() if key != "memory"}
+        write_json(
+            os.path.join(queue_dir, "tasks", task_file(name) + ".json"),
+            {"name": name, "order": order, **record},
+        )
+    meta = {
+        "cwd": os.getcwd(),
+        "tasks": list(tasks),
+        "cache_dir": None if cache_dir is None else os.path.abspath(cache_dir),
+        "profile_dir": None if profile_dir is None else os.path.abspath(profile_dir),
+        "capture": capture,
+        "capture_tasks": capture_tasks,
+        "log_level": log_level(),
+        "plots": plots,
+    }
+    # written last: workers only start on a complete queue
+    write_json(os.path.join(queue_dir, META_NAME), meta)
+
+
+def read_done(queue_dir):
+    """Records of the committed tasks by name."""
+    done = {}
+    for path in pathlib.Path(queue_dir, "done").glob("*.json"):
+        record = read_json(path)
+        done[record["name"]] = record
+    return done
+
+
+def done_path(queue_dir, name):
+    return os.path.join(queue_dir, "done", task_file(name) + ".json")
+
+
+def commit(queue_dir, name, record):
+    """Commits the record of a task, returning False if it was committed already."""
+    path = done_path(queue_dir, name)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"name": name, **record}, f, indent=4)
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+def lease_path(queue_dir, name):
+    return os.path.join(queue_dir, "leases", task_file(name) + ".lease")
+
+
+def read_owner(path):
+    """Worker holding a lease, the first line of the lease file."""
+    with open(path) as f:
+        return f.readline().strip()
+
+
+def claim(queue_dir, name, worker_id, lease_timeout):
+    """Claims a task by creating its lease, or taking over an expired one."""
+    path = lease_path(queue_dir, name)
+    with contextlib.suppress(FileNotFoundError):
+        with open(path) as f:
+            lease = f.read()
+        mtime = os.path.getmtime(path)
+        if time.time() - mtime > lease_timeout:
+            expired_path = f"{path}.{uuid.uuid4().hex}.expired"
+            os.rename(path, expired_path)
+            # another worker may have taken the lease over, or its owner renewed
+            # it, between the check and the rename: then the renamed file is not
+            # the expired lease and is put back
+            with open(expired_path) as f:
+                expired = f.read() == lease and os.path.getmtime(expired_path) == mtime
+            if not expired:
+                with contextlib.suppress(FileExistsError):
+                    os.link(expired_path, path)
+                os.remove(expired_path)
+                return False
+            os.remove(expired_path)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    # the nonce tells apart two leases of the same worker
+    with os.fdopen(fd, "w") as f:
+        f.write(worker_id + "\n" + uuid.uuid4().hex + "\n")
+    return True
+
+
+def release(path, worker_id):
+    """Removes a lease unless another worker took it over."""
+    with contextlib.suppress(FileNotFoundError):
+        if read_owner(path) == worker_id:
+            os.remove(path)
+
+
+def renew(path, worker_id, stopped):
+    """Renews a lease until stopped, or until another worker took it over."""
+    while not stopped.wait(RENEW_INTERVAL):
+        # the lease may be missing for a moment while a worker checks its expiry
+        with contextlib.suppress(FileNotFoundError):
+            if read_owner(path) != worker_id:
+                return
+            os.utime(path)
+
+
+def next_task(queue_dir, meta, done, worker_id, lease_timeout):
+    """
+    Claims the first task of the queue whose dependencies are committed,
+    returning it or None. Tasks depending on a failed task are committed as skipped.
+    """
+    for name in meta["tasks"]:
+        if name in done:
+            continue
+        task = read_json(os.path.join(queue_dir, "tasks", task_file(name) + ".json"))
+        if any(done[dep]["returncode"] != 0 for dep in task["deps"] if dep in done):
+            if commit(queue_dir, name, {"returncode": None, "worker": worker_id}):
+                print(f"--- Skipped task {name}: a dependency failed ---", flush=True)
+            done[name] = {"returncode": None}
+        elif all(dep in done for dep in task["deps"]):
+            if not claim(queue_dir, name, worker_id, lease_timeout):
+                continue
+            # committed by its previous worker between the scan and the claim
+            if os.path.exists(done_path(queue_dir, name)):
+                release(lease_path(queue_dir, name), worker_id)
+                continue
+            return task
+    return None
+
+
+def work_once(queue_dir, meta, worker_id, execute, lease_timeout):
+    """Claims, executes and commits one task, returning False once every task is done."""
+    done = read_done(queue_dir)
+    if len(done) == len(meta["tasks"]):
+        return False
+    task = next_task(queue_dir, meta, done, worker_id, lease_timeout)
+    if task is None:
+        time.sleep(POLL_INTERVAL)
+        return True
+
+    name = task["name"]
+    print(f"--- Claimed task {name} ---", flush=True)
+    path = lease_path(queue_dir, name)
+    stopped = threading.Event()
+    renewer = threading.Thread(target=renew, args=(path, worker_id, stopped), daemon=True)
+    renewer.start()
+    profile_path = None
+    capture = None
+    if meta["profile_dir"] is not None:
+        profile_path = os.path.join(meta["profile_dir"], name + ".jsonl")
+        if meta["capture_tasks"] is None or name in meta["capture_tasks"]:
+            capture = meta["capture"]
+    try:
+        record = run_task(name, task, meta["cache_dir"], execute, profile_path, capture)
+    finally:
+        stopped.set()
+        renewer.join()
+    record["worker"] = worker_id
+    if commit(queue_dir, name, record):
+        print(f"--- Committed task {name}: return code {record['returncode']} ---", flush=True)
+    else:
+        print(f"--- Task {name} was committed by another worker ---", flush=True)
+    release(path, worker_id)
+    return True
+
+
+def work(queue_dir, workers=1, lease_timeout=LEASE_TIMEOUT, pool=False, daemon=None):
+    """Runs workers threads executing the tasks of the queue until every task is done."""
+    queue_dir = os.path.abspath(queue_dir)
+    meta_path = os.path.join(queue_dir, META_NAME)
+    while not os.path.exists(meta_path):
+        time.sleep(POLL_INTERVAL)
+    meta = read_json(meta_path)
+    os.chdir(meta["cwd"])
+    os.environ[LOG_LEVEL_ENV] = meta["log_level"]
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def loop(thread_id):
+        while work_once(queue_dir, meta, f"{worker_id}:{thread_id}", execute, lease_timeout):
+            pass
+
+    with task_executor(workers, pool=pool, daemon=daemon, plots=meta.get("plots", True)) as execute:
+        threads = [threading.Thread(target=loop, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def wait_queue(queue_dir, log_file, poll_interval=POLL_INTERVAL):
+    """
+    Waits until every task of the queue is committed, logging them as they are,
+    and writes the profile of the run. Returns a dict of task name -> exit status.
+    """
+    meta = read_json(os.path.join(queue_dir, META_NAME))
+    start = time.perf_counter()
+    logged = set()
+    while True:
+        done = read_done(queue_dir)
+        for name in meta["tasks"]:
+            if name not in done or name in logged:
+                continue
+            logged.add(name)
+            record = done[name]
+            if record["returncode"] is None:
+                log_file.write(f"--- Skipped task {name}: a dependency failed ---\n")
+            elif record.get("cached"):
+                log_file.write(f"--- Task {name} unchanged, reusing its outputs. ---\n")
+            elif record["returncode"] == 0:
+                log_file.write(f"--- Task {name} complete on {record['worker']}. ---\n")
+            else:
+                log_file.write(
+                    f"--- Task {name} failed on {record['worker']} "
+                    + f"with return code {record['returncode']} ---\n"
+                )
+        log_file.flush()
+        if len(done) == len(meta["tasks"]):
+            break
+        time.sleep(poll_interval)
+
+    records = {name: done[name] for name in meta["tasks"]}
+    if meta["profile_dir"] is not None:
+        pathlib.Path(meta["profile_dir"]).mkdir(parents=True, exist_ok=True)
+        profile = {
+            "queue_dir": os.path.abspath(queue_dir),
+            "wall_s": round(time.perf_counter() - start, 3),
+            "tasks": records,
+        }
+        write_profile(profile, meta["profile_dir"])
+    return {name: record["returncode"] for name, record in records.items()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Claims, executes and commits the tasks of a work queue written by pipeline.py --queue_dir "
+        + "until all of them are done; run it on any number of nodes sharing the queue directory."
+    )
+    parser.add_argument("action", choices=["work"])
+    parser.add_argument(
+        "--queue_dir",
+        type=str,
+        help="path of the work queue on the shared filesystem",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of tasks run in parallel by this worker (default: number of cpus)",
+        required=False,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--lease_timeout",
+        type=float,
+        help=f"seconds after which a task whose worker stopped renewing its lease is claimed again (default: {LEASE_TIMEOUT})",
+        required=False,
+        default=LEASE_TIMEOUT,
+    )
+    parser.add_argument(
+        "--pool",
+        action="store_true",
+        help="run the tasks in warm worker processes that import the scientific libraries once",
+    )
+    parser.add_argument(
+        "--daemon",
+        type=str,
+        help="path of the socket of a running worker daemon (worker_pool.py serve) to run the tasks on",
+        required=False,
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.lease_timeout <= RENEW_INTERVAL:
+        parser.error(f"--lease_timeout must be longer than the renewal interval of {RENEW_INTERVAL} seconds")
+    return args
+
+
+def main(args):
+    work(args.queue_dir, args.workers, args.lease_timeout, pool=args.pool, daemon=args.daemon)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,312 @@
+import argparse
+import concurrent.futures
+import contextlib
+import gc
+import importlib
+import multiprocessing
+import os
+import pathlib
+import runpy
+import secrets
+import sys
+import threading
+import traceback
+import warnings
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from profiling import profiled_task
+from task_graph import execute_command
+
+# Pool of warm worker processes for the pipeline scripts.
+# Every worker imports the scientific stack once when it starts and then runs
+# the "python <script> <args>" commands of the task graph inside its own
+# interpreter (runpy with the command's argv), so the interpreter start-up and
+# the pandas/sklearn/networkx/matplotlib imports are paid once per worker
+# instead of once per task; the plotting modules only when the run draws
+# figures, and a module that is not installed is left to the scripts needing
+# it. The modules of the script directory are reloaded
+# for every command, so code changes are picked up. The pool can also be kept
+# alive by a local daemon (serve) that pipeline runs submit their tasks to;
+# clients authenticate with the key the daemon writes next to its socket,
+# readable by its user only.
+
+WARM_MODULES = [
+    "numpy",
+    "pandas",
+    "pyarrow.feather",
+    "scipy.sparse",
+    "networkx",
+    "openpyxl",
+    "sklearn.ensemble",
+    "sklearn.model_selection",
+    "sklearn.metrics",
+]
+# imported by the figures only, which report.py can draw later (--no_plots)
+PLOT_MODULES = [
+    "matplotlib.pyplot",
+    "seaborn",
+]
+
+
+def warm_up(plots=True):
+    """Initializer of the worker processes: imports the modules shared by the scripts."""
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    for module in WARM_MODULES + (PLOT_MODULES if plots else []):
+        with contextlib.suppress(ImportError):
+            importlib.import_module(module)
+
+
+def split_command(command):
+    """Splits a python command into (script, script arguments, ignore warnings), or None for other commands."""
+    if not command or not os.path.basename(command[0]).startswith("python"):
+        return None
+    for i, arg in enumerate(command[1:], start=1):
+        if arg.endswith(".py"):
+            return arg, command[i + 1 :], "ignore" in command[1:i]
+    return None
+
+
+def run_script(script, script_args, ignore_warnings):
+    """Runs a script as __main__ with the given arguments, returning its exit status."""
+    script_dir = os.path.dirname(os.path.abspath(script))
+    loaded = set(sys.modules)
+    sys.argv = [script] + list(script_args)
+    sys.path.insert(0, script_dir)
+    try:
+        with warnings.catch_warnings():
+            if ignore_warnings:
+                warnings.simplefilter("ignore")
+            runpy.run_path(script, run_name="__main__")
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.path.remove(script_dir)
+        # forget the modules of the script directory so the next command reloads them
+        for name in set(sys.modules) - loaded:
+            module_file = getattr(sys.modules[name], "__file__", None) or ""
+            if os.path.dirname(os.path.abspath(module_file)) == script_dir:
+                del sys.modules[name]
+
+
+def run_command(command, log_path, env=None, cwd=None):
+    """
+    Executes a task command in this process when it is a python script, with its
+    output written to log_path and the variables of env set, returning
+    (exit status, resource usage). Other commands are executed in a subprocess.
+    Relative paths are resolved against cwd if given.
+    """
+    orig_cwd = os.getcwd()
+    if cwd is not None:
+        os.chdir(cwd)
+    split = split_command(command)
+    if split is None:
+        try:
+            return execute_command(command, log_path, env)
+        finally:
+            os.chdir(orig_cwd)
+
+    pathlib.Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+    orig_stdout, orig_stderr, orig_argv = sys.stdout, sys.stderr, sys.argv
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(log_path, "w") as task_log, profiled_task(env) as usage:
+        # output of the interpreter and of native libraries goes to the task log too
+        os.dup2(task_log.fileno(), 1)
+        os.dup2(task_log.fileno(), 2)
+        sys.stdout = sys.stderr = task_log
+        try:
+            returncode = run_script(*split)
+        finally:
+            for stream in [sys.stdout, sys.stderr]:
+                with contextlib.suppress(Exception):
+                    stream.flush()
+            sys.stdout, sys.stderr, sys.argv = orig_stdout, orig_stderr, orig_argv
+            os.chdir(orig_cwd)
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+            # close the log files the script left open
+            gc.collect()
+    return returncode, usage
+
+
+class WorkerPool:
+    """Warm worker processes executing task commands, see run_command."""
+
+    def __init__(self, workers, plots=True):
+        self.workers = workers
+        self.plots = plots
+        self.lock = threading.Lock()
+        self.executor = self.start()
+
+    def start(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_up,
+            initargs=(self.plots,),
+        )
+
+    def execute(self, command, log_path, env=None, cwd=None):
+        executor = self.executor
+        try:
+            return executor.submit(run_command, command, log_path, env, cwd).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. killed out of memory): the commands it held fail
+            # and the next ones run on a new pool
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = self.start()
+                    executor.shutdown(wait=False)
+            raise
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def key_path(address):
+    """Path of the authentication key of the daemon listening at address."""
+    return address + ".key"
+
+
+def write_authkey(address):
+    """Writes a new authentication key for the daemon at address, readable by its user only."""
+    path = key_path(address)
+    if os.path.exists(path):
+        os.remove(path)
+    authkey = secrets.token_bytes(32)
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as key_file:
+        key_file.write(authkey)
+    return authkey
+
+
+def read_authkey(address):
+    with open(key_path(address), "rb") as key_file:
+        return key_file.read()
+
+
+def daemon_execute(address, command, log_path, env=None):
+    """Executes a task command on the worker daemon listening at address."""
+    with Client(address, family="AF_UNIX", authkey=read_authkey(address)) as connection:
+        connection.send(("run", command, log_path, env, os.getcwd()))
+        result = connection.recv()
+    # the daemon sends back the exception its pool raised
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+@contextlib.contextmanager
+def task_executor(workers, pool=False, daemon=None, plots=True):
+    """
+    The function executing the commands of run_tasks: a running daemon,
+    a warm worker pool started for this run (importing the plotting modules
+    with plots), or a new process per command.
+    """
+    if daemon is not None:
+        yield lambda command, log_path, env=None: daemon_execute(daemon, command, log_path, env)
+    elif pool:
+        worker_pool = WorkerPool(workers, plots)
+        try:
+            yield worker_pool.execute
+        finally:
+            worker_pool.shutdown()
+    else:
+        yield execute_command
+
+
+def handle_run(connection, worker_pool, command, log_path, env, cwd):
+    with connection:
+        try:
+            result = worker_pool.execute(command, log_path, env, cwd)
+        except Exception as e:
+            result = e
+        connection.send(result)
+
+
+def serve(address, workers, plots=True):
+    """Serves task commands on a unix socket with a warm worker pool until stopped."""
+    if os.path.exists(address):
+        os.remove(address)
+    worker_pool = WorkerPool(workers, plots)
+    # the socket and the key are created accessible to this user only; requests
+    # are unpickled, so only clients holding the key are accepted
+    umask = os.umask(0o077)
+    try:
+        authkey = write_authkey(address)
+        listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(umask)
+    with listener:
+        print(f"Serving {workers} workers at {address}", flush=True)
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                continue
+            request = connection.recv()
+            if request[0] == "stop":
+                connection.send(0)
+                connection.close()
+                break
+            # each command waits for its worker in its own thread
+            threading.Thread(
+                target=handle_run, args=(connection, worker_pool) + request[1:], daemon=True
+            ).start()
+    os.remove(key_path(address))
+    worker_pool.shutdown()
+
+
+def stop_daemon(address):
+    with Client(address, family="AF_UNIX", authkey=read_authkey(address)) as connection:
+        connection.send(("stop",))
+        connection.recv()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Runs a daemon keeping warm worker processes for the pipeline tasks, or stops it."
+    )
+    parser.add_argument("action", choices=["serve", "stop"])
+    parser.add_argument(
+        "--address",
+        type=str,
+        help="path of the unix socket of the daemon",
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes (default: number of cpus)",
+        required=False,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--no_plots",
+        action="store_true",
+        help="do not import the plotting modules in the workers, for runs with --no_plots",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    if args.action == "serve":
+        serve(args.address, args.workers, plots=not args.no_plots)
+    else:
+        stop_daemon(args.address)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,206 @@
+import os
+import pickle
+from pathlib import Path
+from classification import classify
+from evaluation import evaluation_mode
+from feature_store import BASELINE_NAME, MATRIX_SUFFIX, write_combination, write_matrix
+from features import change_features, prob_features, ratio_features
+from logging_utils import get_logger
+from metabolome_store import change_kind, frame_tensor
+from preprocessing import preprocess_metabolome, write_preprocessed
+from reaction_sets import (
+    build_reaction_sets,
+    measure_reactions,
+    parse_reactions,
+    reaction_set_frame,
+    write_reaction_sets,
+)
+from summarize_performance import REACT_FEAT_MAP, performance_key, summarize_learners, summarize_performance
+
+# End-to-end run of one study in a single process: the stages exchange
+# DataFrames and arrays in memory instead of reading the files written by the
+# previous stage. Only the classification and summary outputs are written,
+# unless persist=True also writes the intermediate results with the layout of
+# pipeline.py.
+
+logger = get_logger("workflow")
+
+
+def timepoint_inputs(args):
+    """Profile paths and timepoint names of the pipeline arguments, as in preprocess-metabolome.py."""
+    if args.timepoint_paths is None:
+        return [args.base_path, args.end_path], ["base", "end"]
+    names = args.timepoint_names
+    if names is None:
+        names = ["t" + str(i) for i in range(len(args.timepoint_paths))]
+    return args.timepoint_paths, names
+
+
+def compute_features(result, react_sets, args):
+    """Computes every feature of REACT_FEAT_MAP, keyed by (reaction set, feature name)."""
+    timepoints = result["timepoints"]
+    contrasts = result["contrasts"]
+    name_to_id = result["gem_overlapped_name_to_id"]
+    valid_met_df = result["valid_met_df"]
+    met_to_id = dict(zip(valid_met_df["MET_ID"], valid_met_df["ID"]))
+
+    levels, samples, mets = frame_tensor(result["matrices"], timepoints, name_to_id)
+    changes, _, _ = frame_tensor(
+        result["matrices"], [change_kind(contrast) for contrast in contrasts], name_to_id
+    )
+
+    features = {}
+    networks = {}
+    for react_set_no, feature_names in REACT_FEAT_MAP.items():
+        react_set_df = reaction_set_frame(react_sets[react_set_no][0])
+        for feature_name in feature_names:
+            logger.info("Reaction set %s: %s features", react_set_no, feature_name)
+            if feature_name == "Change":
+                features[(react_set_no, feature_name)] = change_features(
+                    changes, samples, mets, react_set_df, met_to_id, contrasts
+                )
+            elif feature_name == "Ratio":
+                features[(react_set_no, feature_name)] = ratio_features(
+                    changes, samples, mets, react_set_df, met_to_id, contrasts
+                )
+            else:
+                eq_prob_df, prob_df, df3, graphs = prob_features(
+                    levels,
+                    changes,
+                    samples,
+                    mets,
+                    timepoints,
+                    contrasts,
+                    result["registry"],
+                    react_set_df,
+                    met_to_id,
+                    args.case,
+                    args.control,
+                    args.alpha,
+                )
+                features[(react_set_no, feature_name)] = (prob_df, df3)
+                networks[react_set_no] = (eq_prob_df, graphs)
+    return features, networks
+
+
+def write_features(features, networks, contrasts, feature_out_dir, met_out_dir):
+    """
+    Writes the features with the layout of the compute-*-feature.py scripts,
+    the metabolite+reaction matrices referencing the metabolite block of met_out_dir.
+    """
+    for (react_set_no, feature_name), (react_df, _) in features.items():
+        kind = feature_name.lower()
+        out_dir = os.path.join(feature_out_dir, f"reaction-set-{react_set_no}", kind)
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        react_df.to_csv(os.path.join(out_dir, f"reaction.{kind}.tsv"), sep="\t", index=True)
+        matrix_path = os.path.join(out_dir, f"reaction.{kind}{MATRIX_SUFFIX}")
+        write_matrix(react_df, matrix_path)
+        write_combination(
+            os.path.join(out_dir, f"metabolite.reaction.{kind}.json"),
+            [os.path.join(met_out_dir, BASELINE_NAME), matrix_path],
+        )
+    for react_set_no, (eq_prob_df, graphs) in networks.items():
+        out_dir = os.path.join(feature_out_dir, f"reaction-set-{react_set_no}", "prob")
+        eq_prob_df.to_csv(
+            os.path.join(out_dir, "equilibrium_probability.tsv"), sep="\t", index=True
+        )
+        for label, G in graphs.items():
+            network_name = (
+                "network.pickle" if len(contrasts) == 1 else "network." + label + ".pickle"
+            )
+            with open(os.path.join(out_dir, network_name), "wb") as f:
+                pickle.dump(G, f)
+
+
+def classify_features(result, features, args, classification_out_dir):
+    """
+    Classifies the metabolite baseline and every feature with every learner,
+    returning the performance by learner, keyed as read_performance.
+    """
+    registry = result["registry"]
+    inputs = {"metabolite": result["change_df"]}
+    for (react_set_no, feature_name), (react_df, met_react_df) in features.items():
+        inputs[performance_key("reaction", react_set_no, feature_name)] = react_df
+        inputs[performance_key("metabolite+reaction", react_set_no, feature_name)] = met_react_df
+
+    # every feature matrix is evaluated alike, so that their metrics are comparable
+    evaluation = evaluation_mode(len(result["change_df"]), args.evaluation, args.search)
+    performances = {learner: {} for learner in args.learners}
+    for key, X in inputs.items():
+        out_dir = os.path.join(classification_out_dir, key)
+        logger.info("Classification with %s", key)
+        performance = classify(
+            X,
+            registry,
+            args.case,
+            args.control,
+            out_dir,
+            os.path.join(out_dir, "classification.log"),
+            learners=args.learners,
+            n_jobs=args.classification_jobs,
+            backend=args.classification_backend,
+            evaluation=evaluation,
+            search=args.search,
+            plots=not args.no_plots,
+            screen=args.screen,
+            univariate_k=args.univariate_k,
+        )
+        for learner, metric in performance.items():
+            performances[learner][key] = metric
+    return performances
+
+
+def run_workflow(args, persist=False):
+    """
+    Runs preprocessing -> reaction sets -> features -> classification -> summary
+    of the study in the pipeline arguments, returning the two summary tables.
+    """
+    met_out_dir = os.path.join(args.out_dir, "preprocess", "metabolome")
+    gem_out_dir = os.path.join(args.out_dir, "preprocess", "gem")
+
+    timepoint_paths, timepoints = timepoint_inputs(args)
+    result = preprocess_metabolome(
+        timepoint_paths,
+        timepoints,
+        args.contrast,
+        args.missing_pct,
+        args.user_met_id_path,
+        args.user_met_name_col,
+        args.user_met_id_col,
+        args.gem_path,
+        args.gem_met_id_path,
+        args.gem_met_id_col,
+    )
+    if persist:
+        Path(met_out_dir).mkdir(parents=True, exist_ok=True)
+        write_preprocessed(result, met_out_dir)
+
+    valid_mets = set(result["valid_met_df"]["MET_ID"])
+    react_gem = measure_reactions(parse_reactions(args.gem_path), valid_mets)
+    react_sets = build_reaction_sets(react_gem)
+    if persist:
+        Path(gem_out_dir).mkdir(parents=True, exist_ok=True)
+        react_gem.to_csv(os.path.join(gem_out_dir, "all-reactions.tsv"), sep="\t", index=False)
+        write_reaction_sets(react_sets, gem_out_dir)
+
+    features, networks = compute_features(result, react_sets, args)
+    if persist:
+        write_features(
+            features,
+            networks,
+            result["contrasts"],
+            os.path.join(args.out_dir, "feature"),
+            met_out_dir,
+        )
+
+    performances = classify_features(
+        result, features, args, os.path.join(args.out_dir, "classification")
+    )
+
+    summary_out_dir = os.path.join(args.out_dir, "summary")
+    Path(summary_out_dir).mkdir(parents=True, exist_ok=True)
+    if len(args.learners) > 1:
+        summarize_learners(performances, summary_out_dir, plots=not args.no_plots)
+    return summarize_performance(
+        performances[args.learners[0]], summary_out_dir, plots=not args.no_plots
+    )
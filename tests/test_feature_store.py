@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from feature_store import (
+    DTYPE, copy_matrix, matrix_shape, read_features, read_matrix, write_combination, write_matrix)
+
+# A matrix written to the store reads back as the same float32 DataFrame over a
+# read-only map, and a combination reads as its parts side by side on the
+# samples of the last part.
+
+def matrix(columns, samples, seed):
+    rng = np.random.default_rng(seed)
+    index = pd.Index(samples, name='sample')
+    return pd.DataFrame(rng.normal(size=(len(samples), len(columns))), index=index, columns=columns)
+
+def test_write_open_combine_round_trip(tmp_path):
+    met = matrix(['M1', 'M2'], ['s1', 's2', 's3'], 0)
+    react = matrix(['R1', 'R2', 'R3'], ['s3', 's1', 's2'], 1)
+    met_path, react_path = str(tmp_path / 'metabolite.npy'), str(tmp_path / 'reaction.npy')
+    write_matrix(met, met_path)
+    write_matrix(react, react_path)
+
+    opened = read_matrix(met_path)
+    pd.testing.assert_frame_equal(opened, met.astype(DTYPE))
+    assert not opened.values.flags.writeable
+
+    combination_path = str(tmp_path / 'metabolite+reaction.json')
+    write_combination(combination_path, [met_path, react_path])
+    expected = pd.concat([met.loc[react.index], react], axis=1).astype(DTYPE)
+    pd.testing.assert_frame_equal(read_features(combination_path), expected)
+    assert matrix_shape(combination_path) == (3, 5)
+
+    # a copied combination still references the same parts
+    out_dir = tmp_path / 'copy'
+    out_dir.mkdir()
+    copy_matrix(combination_path, str(out_dir))
+    pd.testing.assert_frame_equal(read_features(str(out_dir / 'metabolite+reaction.json')), expected)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from features import change_features, ratio_features, reported_reactions
+from reaction_sets import input_hashes, reusable_columns, write_input_hashes
+
+# An incremental feature run (--changed_reactions_path) must give the same
+# output as a full rebuild, also when preprocess-metabolome.py was rerun and
+# re-imputed the inputs of reactions that are not in changed-reactions.tsv.
+
+MET_TO_ID = {'a[c]': 'M1', 'b[c]': 'M2', 'c[c]': 'M3', 'd[c]': 'M4'}
+METS = ['M1', 'M2', 'M3', 'M4']
+CONTRASTS = [('t1', 't2'), ('t2', 't3')]
+SAMPLES = pd.Index(range(5), name='sample')
+
+def reaction_set():
+    return pd.DataFrame({
+        'RXN_ID': ['R1', 'R2'],
+        'Measured_Substrate': [{'a[c]'}, {'c[c]'}],
+        'Measured_Product': [{'b[c]'}, {'d[c]'}],
+    })
+
+def run(build, changes, out_path, changed=None):
+    """Runs build like the compute-*-feature.py scripts, incrementally if changed is given."""
+    react_set_df = reaction_set()
+    react_ids = reported_reactions(react_set_df)
+    hashes = input_hashes(changes, METS, react_set_df, MET_TO_ID, react_ids)
+    reused_ids, reused_df = [], None
+    if(changed is not None):
+        reused_ids, reused_df = reusable_columns(out_path, react_ids, changed, SAMPLES, CONTRASTS, hashes)
+    df, _ = build(changes, SAMPLES, METS, react_set_df, MET_TO_ID, CONTRASTS, reused_ids, reused_df)
+    df.to_csv(out_path, sep='\t', index=True)
+    write_input_hashes(hashes, out_path)
+    return df, reused_ids
+
+@pytest.mark.parametrize('build', [change_features, ratio_features])
+def test_incremental_matches_full_rebuild(tmp_path, build):
+    rng = np.random.default_rng(0)
+    changes = rng.uniform(0.5, 2, size=(len(SAMPLES), len(CONTRASTS), len(METS)))
+    out_path = str(tmp_path / 'reaction.tsv')
+    run(build, changes, out_path)
+
+    # the rerun re-imputed a missing value of M3, an input of R2 only
+    rerun = changes.copy()
+    rerun[1, 0, 2] *= 1.5
+    incremental, reused_ids = run(build, rerun, out_path, changed=set())
+    full, _ = run(build, rerun, str(tmp_path / 'full.tsv'))
+
+    assert reused_ids == ['R1']
+    pd.testing.assert_frame_equal(incremental, full, check_names=False)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from sklearn.metrics import average_precision_score, roc_auc_score
+from resampling import auprc, auroc
+
+# The vectorized AUROC and AUPRC of the bootstrap must match sklearn on every
+# resample, also when scores are tied (the ridge and forest probabilities are).
+
+def resamples(tied):
+    rng = np.random.default_rng(0)
+    labels = rng.random((20, 30)) < 0.4
+    labels[:, :2] = [True, False]
+    scores = rng.random(labels.shape)
+    if(tied):
+        scores = np.round(scores, 1)
+    return labels, scores
+
+@pytest.mark.parametrize('tied', [False, True])
+def test_auroc_matches_sklearn(tied):
+    labels, scores = resamples(tied)
+    expected = [roc_auc_score(row_labels, row_scores) for row_labels, row_scores in zip(labels, scores)]
+    np.testing.assert_allclose(auroc(labels, scores), expected)
+
+@pytest.mark.parametrize('tied', [False, True])
+def test_auprc_matches_sklearn(tied):
+    labels, scores = resamples(tied)
+    expected = [average_precision_score(row_labels, row_scores) for row_labels, row_scores in zip(labels, scores)]
+    np.testing.assert_allclose(auprc(labels, scores), expected)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import Ridge
+from learners import ridge_loo
+
+# The closed-form LOO decision values of the ridge learner must be the ones of
+# refitting the ridge regression on the +/-1 targets without every sample.
+
+@pytest.mark.parametrize('n_features', [5, 40])
+def test_ridge_loo_matches_refits(n_features):
+    rng = np.random.default_rng(0)
+    Z = rng.normal(size=(20, n_features))
+    y_true = (Z[:, 0] + rng.normal(size=20) > 0).astype(int)
+    target = 2.0 * y_true - 1
+    alpha, loo, (coef, intercept) = ridge_loo(Z, y_true)
+
+    expected = np.empty(len(Z))
+    for idx in range(len(Z)):
+        train = np.arange(len(Z)) != idx
+        model = Ridge(alpha=alpha).fit(Z[train], target[train])
+        expected[idx] = model.predict(Z[idx:idx + 1])[0]
+    np.testing.assert_allclose(loo, expected, rtol=1e-6, atol=1e-8)
+
+    model = Ridge(alpha=alpha).fit(Z, target)
+    np.testing.assert_allclose(coef, model.coef_, rtol=1e-6, atol=1e-8)
+    assert intercept == pytest.approx(model.intercept_)
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+from screening import screen_features
+
+# The screening keeps the first of duplicate columns and drops the columns a
+# missing value or a constant makes useless, in the order of X.
+
+def test_screen_features_drops_useless_columns():
+    rng = np.random.default_rng(0)
+    informative = rng.normal(size=(6, 2))
+    X = pd.DataFrame({
+        'a': informative[:, 0],
+        'nan': [1.0, np.nan, 2, 3, 4, 5],
+        'inf': [1.0, np.inf, 2, 3, 4, 5],
+        'constant': np.full(6, 3.0),
+        'b': informative[:, 1],
+        'a_copy': informative[:, 0],
+        'b_copy': informative[:, 1],
+    })
+    screened, removed = screen_features(X)
+    assert screened.columns.tolist() == ['a', 'b']
+    pd.testing.assert_frame_equal(screened, X[['a', 'b']])
+    assert removed == {'non_finite': 2, 'zero_variance': 1, 'duplicate': 2}
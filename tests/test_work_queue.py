@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+import sys
+import time
+import work_queue
+from work_queue import lease_path, read_done, write_queue
+
+# Two workers sharing a queue run every task exactly once: a failed task skips
+# its dependents, and the expired lease of a worker that died is taken over.
+
+LEASE_TIMEOUT = 30
+
+def task(name, deps, runs_path, returncode=0):
+    """A task appending its name to runs_path and exiting with returncode."""
+    script = f'open({str(runs_path)!r}, "a").write({name!r} + "\\n"); raise SystemExit({returncode})'
+    return {
+        'deps': deps,
+        'command': [sys.executable, '-c', script],
+        'log_path': os.path.join('logs', name + '.log'),
+        'inputs': [],
+        'outputs': [],
+    }
+
+def test_two_workers_run_every_task_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runs_path = tmp_path / 'runs.txt'
+    tasks = {
+        'a': task('a', [], runs_path),
+        'failed': task('failed', [], runs_path, returncode=1),
+        'child': task('child', ['failed'], runs_path),
+        'grandchild': task('grandchild', ['child'], runs_path),
+        'expired': task('expired', [], runs_path),
+        'b': task('b', ['a', 'expired'], runs_path),
+    }
+    for name in ['c', 'd', 'e']:
+        tasks[name] = task(name, ['a'], runs_path)
+    queue_dir = str(tmp_path / 'queue')
+    write_queue(tasks, queue_dir)
+
+    # the lease of a worker that died while running the task, not renewed since
+    dead_lease = lease_path(queue_dir, 'expired')
+    with open(dead_lease, 'w') as f:
+        f.write('dead-host:1:0\nnonce\n')
+    past = time.time() - 2 * LEASE_TIMEOUT
+    os.utime(dead_lease, (past, past))
+
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=work_queue.work, args=(queue_dir, 2, LEASE_TIMEOUT)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+        assert worker.exitcode == 0
+
+    runs = runs_path.read_text().split()
+    assert sorted(runs) == sorted(['a', 'failed', 'expired', 'b', 'c', 'd', 'e'])
+    done = read_done(queue_dir)
+    assert set(done) == set(tasks)
+    assert done['failed']['returncode'] == 1
+    assert done['child']['returncode'] is None
+    assert done['grandchild']['returncode'] is None
+    assert done['expired']['returncode'] == 0
+    assert not done['expired']['worker'].startswith('dead-host')
+    assert os.listdir(os.path.join(queue_dir, 'leases')) == []